@@ -17,18 +17,49 @@ hermsが起動されると、アプリケーション全体を表す :class:`.Ap
 """
 
 
-from .query import Query
-from .handler import apply, use
-from .job import Job
-from .node import Node
-from .nodetype import NodeType
-from .app import App
-from .cli import CliApp
-from .repository import Repository,RepositoryConfig
-from .service import Service
-from .tag import Tag
-from .state import State
-from .config import Json,JsonObject,JsonSchema
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .query import Query
+    from .handler import apply, use
+    from .job import Job
+    from .node import Node
+    from .nodetype import NodeType
+    from .app import App
+    from .cli import CliApp
+    from .repository import Repository,RepositoryConfig
+    from .service import Service
+    from .tag import Tag
+    from .state import State
+    from .config import Json,JsonObject,JsonSchema
+
+# コマンドラインの起動を速くするため、最初に使われたときに読み込む(PEP 562)
+_exports={
+    "Query":".query",
+    "apply":".handler","use":".handler",
+    "Job":".job",
+    "Node":".node",
+    "NodeType":".nodetype",
+    "App":".app",
+    "CliApp":".cli",
+    "Repository":".repository","RepositoryConfig":".repository",
+    "Service":".service",
+    "Tag":".tag",
+    "State":".state",
+    "Json":".config","JsonObject":".config","JsonSchema":".config",
+}
+
+def __getattr__(name:str)->Any:
+    module=_exports.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value=getattr(import_module(module,__name__),name)
+    globals()[name]=value
+    return value
+
+def __dir__()->list[str]:
+    return sorted({*globals(),*_exports})
 
 __all__ = [
     "App",
@@ -1,5 +1,6 @@
-from .cli import CliApp
+import sys
 
-if __name__=='__main__':
-    CliApp().cli().run()
+from .client import main
 
+if __name__=='__main__':
+    sys.exit(main())
@@ -7,6 +7,7 @@ if TYPE_CHECKING:
 OWNER=TypeVar("OWNER")
 
 class OwnedBy(Generic[OWNER]):
+    __slots__=("name","owner")
     name: str
     description: str = ""
     owner:OWNER
@@ -25,7 +26,7 @@ class OwnedBy(Generic[OWNER]):
         return self.name
 
 class InRepository(OwnedBy["Repository"]):
-    pass
+    __slots__=()
 
 T=TypeVar("T")
 class OwnedDict(dict[str,T],Generic[T,OWNER]):
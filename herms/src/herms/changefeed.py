@@ -0,0 +1,202 @@
+"""
+Nodeの変更に連番(リビジョン)をつけて記録します。
+
+:class:`.WriteBuffer` がNodeをストレージに書き込むたびに、変更されたNodeとリビジョンを
+``data_dir/changes.jsonl`` に追記します。書き込みはスレッドで行われるので、記録もそのスレッドから行われます。
+他のRepository(例えば :class:`~herms.module.sync.SyncService` の同期元)は、
+あるリビジョン以降に変更されたNodeだけを :meth:`ChangeFeed.since` で求められます。
+
+ファイルは追記するだけなので、同じNodeの記録がたまっていきます。
+一定以上たまった場合は、Nodeごとに最後の記録だけを残して書き直します。
+
+複数のプロセス(CLIとデーモンなど)が同じファイルに記録できます。
+追記と書き直しは ``changes.jsonl.lock`` のロック( :mod:`.filelock` )の中で行い、
+その前に他のプロセスの記録を読み込んで、リビジョンが重ならないようにします。
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, TypedDict, cast
+
+from . import filelock
+
+if TYPE_CHECKING:
+    from .storage import NodeKey
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeRecord(TypedDict, total=False):
+    rev: int
+    type: str
+    name: str
+    deleted: bool
+
+
+class ChangeFeed:
+    """Nodeの変更の記録です。"""
+    FILE = "changes.jsonl"
+    COMPACT_SIZE = 1000
+    """書き直しを考える記録の数"""
+
+    path: Path
+    revision: int
+    """最後の変更のリビジョン"""
+    revisions: dict[NodeKey, int]
+    """各Nodeが最後に変更されたリビジョン"""
+    deleted: set[NodeKey]
+    """削除されたNode"""
+    _lines: int
+    _offset: int
+    _inode: int | None
+    _file: IO[str] | None
+    _lockfile: IO[bytes] | None
+    _lock: threading.Lock
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+        self._lockfile = None
+        self._lock = threading.Lock()
+        self._reset()
+        self.load()
+
+    def _reset(self) -> None:
+        self.revision = 0
+        self.revisions = {}
+        self.deleted = set()
+        self._lines = 0
+        self._offset = 0
+        self._inode = None
+
+    def load(self) -> list[NodeKey]:
+        """他のプロセスが追記した記録を読み込み、変更されたNodeを返します。
+
+        ファイルが書き直されていた場合は、最初から読み込み直します。
+        """
+        with self._lock:
+            return self._load()
+
+    def _load(self) -> list[NodeKey]:
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return []
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._reset()
+            self._inode = st.st_ino
+            if self._file is not None:
+                # 他のプロセスが書き直した
+                self._file.close()
+                self._file = None
+        ret: list[NodeKey] = []
+        with self.path.open("rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # 書き込み中
+                self._offset += len(line)
+                try:
+                    r = cast(ChangeRecord, json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning("%s: ignoring a broken record", self.path)
+                    continue
+                key = (r["type"], r["name"])
+                self._apply(key, r["rev"], r.get("deleted", False))
+                ret.append(key)
+        return ret
+
+    def _apply(self, key: NodeKey, rev: int, deleted: bool) -> None:
+        self.revision = max(self.revision, rev)
+        self.revisions[key] = rev
+        if deleted:
+            self.deleted.add(key)
+        else:
+            self.deleted.discard(key)
+        self._lines += 1
+
+    def record(self, changes: Iterable[tuple[NodeKey, bool]]) -> int:
+        """変更されたNodeと、削除されたかどうかを記録します。最後のリビジョンを返します。
+
+        他のプロセスが記録した変更は、先に読み込みます。
+        """
+        changes = list(changes)
+        if not changes:
+            return self.revision
+        with self._lock:
+            lockfile = self._lock_file()
+            filelock.lock(lockfile)
+            try:
+                self._load()
+                lines: list[str] = []
+                for key, deleted in changes:
+                    rev = self.revision + 1
+                    self._apply(key, rev, deleted)
+                    record: ChangeRecord = {"rev": rev, "type": key[0], "name": key[1]}
+                    if deleted:
+                        record["deleted"] = True
+                    lines.append(self._dump(record))
+                f = self._open()
+                if os.fstat(f.fileno()).st_size != self._offset:
+                    # 途中で終了したプロセスの書きかけの行を区切る
+                    lines.insert(0, "\n")
+                f.write("".join(lines))
+                f.flush()
+                self._offset = os.fstat(f.fileno()).st_size
+                if self._lines > max(self.COMPACT_SIZE, 2 * len(self.revisions)):
+                    self._compact()
+            finally:
+                filelock.unlock(lockfile)
+            return self.revision
+
+    @staticmethod
+    def _dump(record: ChangeRecord) -> str:
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def _lock_file(self) -> IO[bytes]:
+        if self._lockfile is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._lockfile = self.path.with_name(f"{self.path.name}.lock").open("ab")
+        return self._lockfile
+
+    def _open(self) -> IO[str]:
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.path.open("a", encoding="utf-8")
+            self._inode = os.fstat(self._file.fileno()).st_ino
+        return self._file
+
+    def _compact(self) -> None:
+        records = sorted(self.revisions.items(), key=lambda x: x[1])
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        data = "".join(self._dump({"rev": rev, "type": t, "name": n, "deleted": True} if (t, n) in self.deleted
+                                  else {"rev": rev, "type": t, "name": n}) for (t, n), rev in records)
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, self.path)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._inode = self.path.stat().st_ino
+        self._offset = len(data.encode("utf-8"))
+        self._lines = len(records)
+
+    def since(self, revision: int) -> list[tuple[NodeKey, bool]]:
+        """revisionより後に変更されたNodeと、削除されたかどうかを、変更された順に返します。"""
+        with self._lock:
+            keys = sorted((rev, key) for key, rev in self.revisions.items() if rev > revision)
+            return [(key, key in self.deleted) for _, key in keys]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lockfile is not None:
+                self._lockfile.close()
+                self._lockfile = None
@@ -2,24 +2,64 @@ from __future__ import annotations
 
 import argparse
 import asyncio
-import builtins
+import csv
+import io
 import json
 import logging
 import sys
+from collections.abc import Iterable, Iterator
 from typing import Any, Awaitable, Callable, Literal, TypeAlias, TypedDict, cast
 
 import yaml
 
 from .config import Json, JsonObject
-from .query import Executor
+from .node import Node
+from .query import Executor, Props
+from .repository import Repository
+from .repository_query import PropExecutor
+from .tag import Tag
 from .handler import apply
+from .storage import StorageConfig, copy_nodes, create_storage
 from .app import App
+from .client import socket_path
 
 CommandFunc: TypeAlias = Callable[
     [argparse.ArgumentParser], Callable[[argparse.Namespace], None|Awaitable[None]]
 ]
 
 
+_Dumper=cast(type[yaml.SafeDumper],getattr(yaml,"CSafeDumper",yaml.SafeDumper))
+
+LIST_BATCH=1000
+"""``list`` が出力を送り終わるのを待つ間隔(Nodeの数)"""
+
+
+class Column:
+    """``list`` の ``-p`` で指定された、プロパティのパスです。"""
+    name:str
+    executor:PropExecutor
+    multiple:bool
+
+    def __init__(self,path:str,repo:Repository):
+        props=Props.of(path,repo)
+        self.name=path
+        self.executor=PropExecutor(props)
+        self.multiple=props.multiple()
+
+    def __call__(self,node:Node)->Json:
+        values=[_plain(x) for x,_ in self.executor.value(node)]
+        if self.multiple:
+            return values
+        return values[0] if values else None
+
+def _plain(value:Any)->Json:
+    if isinstance(value,Node):
+        return value.name
+    elif isinstance(value,Tag):
+        return value.absname()
+    return value
+
+
 class CliAppConfig(TypedDict,total=False):
     loglevel: str | int
     """ログレベル"""
@@ -28,11 +68,16 @@ class CliAppConfig(TypedDict,total=False):
     """コマンドライン引数
     """
 
+    socket: str
+    """デーモンのソケットのパス"""
+
 
 class CliApp(App):
-    _parser: argparse.ArgumentParser
+    _parser: argparse.ArgumentParser | None = None
     _commands: dict[str, CommandFunc] = {}
     args: list[str] = []
+    socket: str = ""
+    """:mod:`.daemon` のソケットのパス"""
 
     CONFIG_SCHEMA={
         "allOf":[
@@ -45,7 +90,8 @@ class CliApp(App):
                  "args":{
                      "type":"array",
                      "items":{"type":"string"}
-                 }
+                 },
+                 "socket":{"type":"string"}
              }}
         ]
     }
@@ -57,12 +103,47 @@ class CliApp(App):
         cfg=cast(CliAppConfig,config)
         logging.basicConfig(level=cfg.get("loglevel",logging.WARNING))
         self.args = cfg.get("args",[])
+        self.socket = cfg.get("socket","")
 
     def run(self) -> None:
         """
         実行します。
         """
+        parser=self.parser()
+        args = parser.parse_args(self.args)
+        if args.func is not None:
+            async def _():
+                async with self.repository.run():
+                    await self._execute(args)
+            asyncio.run(_())
+        else:
+            parser.print_help()
 
+    async def execute(self, argv: list[str]) -> None:
+        """初期化済みのRepositoryに対して、コマンドを実行します。:class:`.Daemon` が使います。"""
+        parser=self.parser()
+        args = parser.parse_args(argv)
+        if args.func is not None:
+            await self._execute(args)
+        else:
+            parser.print_help()
+
+    async def _execute(self, args: argparse.Namespace) -> None:
+        if args.transaction:
+            async with self.repository.transaction():
+                ret=args.func(args)
+                if ret is not None:
+                    await ret
+        else:
+            ret=args.func(args)
+            if ret is not None:
+                await ret
+
+    def parser(self) -> argparse.ArgumentParser:
+        """コマンドを解析するArgumentParserを返します。最初に呼ばれたときにコマンドを登録します。"""
+        if self._parser is not None:
+            return self._parser
+        self._commands = {}
         for s in self.repository.services:
             apply(self, s)
         self.add_commands()
@@ -76,19 +157,12 @@ class CliApp(App):
 
         for name, cmd in self._commands.items():
             p = commands.add_parser(name)
+            p.set_defaults(transaction=False)
             f = cmd(p)
             p.set_defaults(func=f)
         parser.set_defaults(func=None)
-        args = parser.parse_args(self.args)
-        if args.func is not None:
-            async def _():
-                async with self.repository.run():
-                    ret=args.func(args)
-                    if ret is not None:
-                        await ret
-            asyncio.run(_())
-        else:
-            parser.print_help()
+        self._parser = parser
+        return parser
 
     #
     # protected interface
@@ -122,6 +196,7 @@ class CliApp(App):
         elif args.verbose:
             config["loglevel"] = logging.INFO
         config["args"] = args.args
+        config["socket"] = str(socket_path(args.config, args.repository))
         return config
 
     #
@@ -151,6 +226,7 @@ class CliApp(App):
         @self.command()
         def update(parser: argparse.ArgumentParser): # type: ignore
             parser.add_argument("-i", "--intensive", action="store_true", default=False)
+            parser.set_defaults(transaction=True)
             self.add_nodes_argument(parser)
 
             async def _(args: argparse.Namespace)->None:
@@ -165,19 +241,19 @@ class CliApp(App):
         @self.command()
         def list(parser: argparse.ArgumentParser): # type: ignore
             parser.add_argument(
-                "-f", "--format", choices=["csv", "json", "yaml"], default="yaml"
-            )  # TODO no text formatter
-            parser.add_argument("-p", "--property", action="append", default=[])
+                "-f", "--format", choices=["csv", "json", "jsonl", "yaml"], default="yaml"
+            )
+            parser.add_argument("-p", "--property", action="append", default=[],
+                                help="property path to show (e.g. num, ref.num, ~ref)")
             self.add_nodes_argument(parser)
 
             async def _(args:argparse.Namespace):
                 exec=self.get_nodes_from_args(args)
-                sys.stdout.write(
-                    self.format(
-                        builtins.list(map(lambda x: x.name,exec.items())),
-                        args.format,
-                    )
-                )
+                columns=[Column(x,self.repository) for x in args.property]
+                for i,text in enumerate(self.format_nodes(exec.items(),columns,args.format)):
+                    sys.stdout.write(text)
+                    if i%LIST_BATCH==LIST_BATCH-1:
+                        await self.drain()
 
             return _
 
@@ -186,6 +262,7 @@ class CliApp(App):
             parser.add_argument(
                 "state", choices=self.repository.states.keys()
             )
+            parser.set_defaults(transaction=True)
             self.add_nodes_argument(parser)
 
             async def _(args:argparse.Namespace):
@@ -194,6 +271,112 @@ class CliApp(App):
 
             return _
         @self.command()
+        def storage(parser: argparse.ArgumentParser): # type: ignore
+            parser.add_argument("direction", choices=["export", "import"],
+                                help="export: copy nodes to the storage\nimport: copy nodes from the storage")
+            parser.add_argument("type", help="storage type (file, sqlite or MODULE.CLASS)")
+            parser.add_argument("path", nargs="?", help="location relative to the config directory")
+
+            async def _(args:argparse.Namespace):
+                cfg:StorageConfig={"type":args.type}
+                if args.path:
+                    cfg["path"]=args.path
+                other=create_storage(self.repository,cfg)
+                try:
+                    if args.direction=="export":
+                        count=copy_nodes(self.repository.storage,other)
+                    else:
+                        count=copy_nodes(other,self.repository.storage)
+                finally:
+                    other.close()
+                logging.info("%d nodes copied.",count)
+
+            return _
+
+        @self.command()
+        def diff(parser: argparse.ArgumentParser): # type: ignore
+            parser.add_argument("target", help="name of a sync service, or path to the config of another repository")
+            parser.add_argument("-f", "--format", choices=["json", "yaml"], default="yaml")
+
+            async def _(args:argparse.Namespace):
+                service=self.repository.services.get(args.target)
+                if service is not None:
+                    if getattr(service,"remote",None) is not None:
+                        raise ValueError(f"{args.target}: The target of the sync service is remote and cannot be compared.")
+                    target=getattr(service,"target",None)
+                    if not isinstance(target,Repository):
+                        raise ValueError(f"{args.target}: Not a sync service.")
+                    d=self.repository.diff(target)
+                else:
+                    # 読むだけなので、ジャーナルや中断した移動には触れない
+                    other=Repository()
+                    other.configure(args.target,read_only=True)
+                    try:
+                        d=self.repository.diff(other)
+                    finally:
+                        await other.close()
+                logging.info("%d buckets compared.",d.buckets)
+                sys.stdout.write(self.format({
+                    "added":[f"{t}:{n}" for t,n in d.added],
+                    "removed":[f"{t}:{n}" for t,n in d.removed],
+                    "changed":[f"{t}:{n}" for t,n in d.changed],
+                },args.format))
+
+            return _
+
+        @self.command()
+        def relocate(parser: argparse.ArgumentParser): # type: ignore
+            parser.add_argument("-n", "--dry-run", action="store_true", help="show the moves without moving")
+            parser.add_argument("-f", "--format", choices=["json", "yaml"], default="yaml")
+            interrupted = parser.add_mutually_exclusive_group()
+            interrupted.add_argument("--resume", action="store_true", help="resume the interrupted moves")
+            interrupted.add_argument("--abort", action="store_true",
+                                     help="give up the interrupted moves (finished moves are kept)")
+            self.add_nodes_argument(parser)
+
+            async def _(args:argparse.Namespace):
+                if args.resume or args.abort:
+                    mover=self.repository.mover
+                    interrupted=await mover.resume() if args.resume else mover.abort()
+                    if interrupted is None:
+                        raise ValueError("No interrupted move.")
+                    sys.stdout.write(self.format([[str(s),str(d)] for s,d in interrupted.moves],args.format))
+                    return
+                exec=self.get_nodes_from_args_or_none(args)
+                nodes=() if exec is None else tuple(exec.items())
+                if exec is not None and not nodes:
+                    return
+                plan=await self.repository.relocate(*nodes,dry_run=args.dry_run)
+                sys.stdout.write(self.format([[str(s),str(d)] for s,d in plan.moves],args.format))
+
+            return _
+
+        @self.command()
+        def daemon(parser: argparse.ArgumentParser): # type: ignore
+            parser.add_argument("--stop", action="store_true", help="stop the running daemon")
+
+            async def _(args:argparse.Namespace):
+                from .daemon import Daemon
+                if args.stop:
+                    logging.warning("daemon is not running.")
+                    return
+                await Daemon(self, self.socket or socket_path(None, None)).serve()
+
+            return _
+
+        @self.command("serve-sync")
+        def serve_sync(parser: argparse.ArgumentParser): # type: ignore
+            parser.add_argument("address", help="tcp://HOST:PORT or unix://PATH (HOST defaults to localhost)")
+            parser.add_argument("--token", help="token clients must send (default: $HERMS_SYNC_TOKEN);"
+                                " required for a non-local HOST")
+
+            async def _(args:argparse.Namespace):
+                from .module.sync.protocol import SyncServer
+                await SyncServer(self.repository,args.token).serve(args.address)
+
+            return _
+
+        @self.command()
         def config(parser: argparse.ArgumentParser): # type: ignore
             sub = parser.add_subparsers()
 
@@ -226,6 +409,59 @@ class CliApp(App):
         else:
             return None
         
+    def format_nodes(self, nodes: Iterable[Node], columns: list[Column],
+                     type: Literal["json", "jsonl", "yaml", "csv"] = "jsonl") -> Iterator[str]:
+        """Nodeを1つずつ整形して返します。
+
+        columnsがなければNodeの名前を、あれば名前と各プロパティの値を持つオブジェクトを出力します。
+        yamlはリストの要素を、jsonは配列の要素を1つずつ出力します。
+        """
+        def row(node:Node)->Json:
+            if not columns:
+                return node.name
+            ret:JsonObject={"name":node.name}
+            for c in columns:
+                ret[c.name]=c(node)
+            return ret
+
+        if type == "jsonl":
+            for node in nodes:
+                yield json.dumps(row(node), ensure_ascii=False) + "\n"
+        elif type == "json":
+            sep = "["
+            for node in nodes:
+                yield sep + json.dumps(row(node), ensure_ascii=False)
+                sep = ","
+            yield "[]\n" if sep == "[" else "]\n"
+        elif type == "yaml":
+            empty = True
+            for node in nodes:
+                yield yaml.dump([row(node)], Dumper=_Dumper, allow_unicode=True, sort_keys=False)
+                empty = False
+            if empty:
+                yield "[]\n"
+        else:
+            buf = io.StringIO()
+            writer = csv.writer(buf, lineterminator="\n")
+            if columns:
+                writer.writerow(["name", *(c.name for c in columns)])
+            for node in nodes:
+                values = (c(node) for c in columns)
+                writer.writerow([node.name, *(",".join(map(str, v)) if isinstance(v, list) else "" if v is None else v
+                                              for v in values)])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            if buf.tell():
+                yield buf.getvalue()
+
+    @staticmethod
+    async def drain() -> None:
+        """標準出力がデーモンのクライアントに送られる場合は、送り終わるまで待ちます。"""
+        drain = getattr(sys.stdout, "drain", None)
+        if drain is not None:
+            await drain()
+
     def format(self, val: dict[Any,Any] | list[Any], type: Literal["json", "yaml", "csv"] = "json"):
         if type == "json":
             return json.dumps(val)
@@ -0,0 +1,94 @@
+"""
+コマンドラインの入口です。
+
+``herms daemon`` で起動した :class:`.Daemon` が動いていれば、コマンドをデーモンに転送します。
+動いていなければ、このプロセスで :class:`.CliApp` を実行します。
+
+起動を速くするため、このモジュールは標準ライブラリしか読み込みません。
+デーモンのソケットは、作業ディレクトリと ``-c`` 、 ``-r`` の値で決まります。
+同じ場所で同じ引数を指定して起動したデーモンにだけ転送されます。
+
+デーモンとの間では、1行に1つのJSONを送ります。
+
+* クライアントは ``{"argv":[...]}`` (または ``{"stop":true}`` )を送ります。
+  ``-v`` や ``-D`` を指定した場合は、``"loglevel"`` にログのレベルを加えます。
+* デーモンは出力を ``{"out":...}`` と ``{"err":...}`` で送り、最後に ``{"exit":終了コード}`` を送ります。
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, cast
+
+LOCAL_COMMANDS = ("daemon",)
+"""デーモンに転送しないコマンド"""
+
+DEBUG = 10
+INFO = 20
+"""ログのレベル( :mod:`logging` を読み込まないように値を書いておく)"""
+
+
+def socket_path(config: str | None, repository: str | None) -> Path:
+    """デーモンのソケットのパスを返します。"""
+    key = json.dumps([os.getcwd(), config and str(Path(config).resolve()), repository])
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+    dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return Path(dir) / f"herms-{os.getuid()}-{digest}.sock"
+
+
+def request(path: Path, msg: dict[str, Any]) -> int | None:
+    """デーモンにmsgを送り、出力を書き出して、終了コードを返します。デーモンが動いていなければNoneを返します。"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    with sock:
+        sock.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as f:
+            for line in f:
+                r = cast(dict[str, Any], json.loads(line))
+                if "out" in r:
+                    sys.stdout.write(r["out"])
+                elif "err" in r:
+                    sys.stderr.write(r["err"])
+                elif "exit" in r:
+                    sys.stdout.flush()
+                    return cast(int, r["exit"])
+    sys.stderr.write("herms: the daemon closed the connection.\n")
+    return 1
+
+
+def main(argv: list[str] | None = None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-c", "--config")
+    parser.add_argument("-r", "--repository")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("-D", "--debug", action="store_true")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args, unknown = parser.parse_known_args(argv)
+    if args.args and not unknown:
+        path = socket_path(args.config, args.repository)
+        code: int | None = None
+        if args.args[0] not in LOCAL_COMMANDS:
+            msg: dict[str, Any] = {"argv": args.args}
+            if args.debug or args.verbose:
+                msg["loglevel"] = DEBUG if args.debug else INFO
+            code = request(path, msg)
+        elif "--stop" in args.args[1:]:
+            code = request(path, {"stop": True})
+        if code is not None:
+            return code
+    from .cli import CliApp
+    CliApp.cli(argv).run()
+    return 0
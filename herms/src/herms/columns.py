@@ -0,0 +1,380 @@
+"""
+:class:`.Node` のプロパティの値を、:class:`.NodeType` ごとに列として保持します。
+
+各 :class:`.NodeType` は :class:`NodeStore` を1つ持ち、:class:`.Property` ごとに1つの列(:class:`Column`)があります。
+各Nodeは :attr:`.Node.id` で示される行を持ちます。
+
+* 整数・数値・真偽値のプロパティは :class:`array.array` に格納されます。
+* 文字列のプロパティはインターンした文字列を格納します。
+* それ以外のプロパティ(Nodeやタグ、リスト)はPythonのオブジェクトとして格納します。
+
+値がNoneのプロパティは、値がないものとして扱います。
+
+NumPyがインストールされている場合、:meth:`ArrayColumn.view` で数値の列をNumPyの配列として参照できます。
+
+NodeからNodeへの参照の逆引きは、:class:`ReferenceIndex` が行番号の列として保持します。
+"""
+
+from __future__ import annotations
+
+import bisect
+import sys
+from array import array
+from collections.abc import Iterable, Iterator, MutableMapping
+from typing import TYPE_CHECKING, Any
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore[assignment]
+
+if TYPE_CHECKING:
+    from .node import Node
+    from .nodetype import NodeType, Property
+
+
+class Column:
+    """1つのプロパティの値の列です。"""
+    __slots__ = ()
+
+    def append(self) -> None:
+        """値のない行を追加します。"""
+        raise NotImplementedError
+
+    def get(self, row: int) -> Any:
+        """値を返します。値がない場合はNoneを返します。"""
+        raise NotImplementedError
+
+    def has(self, row: int) -> bool:
+        raise NotImplementedError
+
+    def set(self, row: int, val: Any) -> bool:
+        """値を設定します。この列に格納できない値の場合はFalseを返します。"""
+        raise NotImplementedError
+
+    def clear(self, row: int) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+_MISSING: Any = object()
+
+
+class ObjectColumn(Column):
+    """任意のPythonオブジェクトを格納します。"""
+    __slots__ = ("values",)
+    values: list[Any]
+
+    def __init__(self, size: int = 0):
+        self.values = [_MISSING] * size
+
+    def append(self) -> None:
+        self.values.append(_MISSING)
+
+    def get(self, row: int) -> Any:
+        val = self.values[row]
+        return None if val is _MISSING else val
+
+    def has(self, row: int) -> bool:
+        return self.values[row] is not _MISSING
+
+    def set(self, row: int, val: Any) -> bool:
+        self.values[row] = _MISSING if val is None else val
+        return True
+
+    def clear(self, row: int) -> None:
+        self.values[row] = _MISSING
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class StringColumn(ObjectColumn):
+    """文字列をインターンして格納します。"""
+    __slots__ = ()
+
+    def set(self, row: int, val: Any) -> bool:
+        if isinstance(val, str):
+            val = sys.intern(val)
+        self.values[row] = _MISSING if val is None else val
+        return True
+
+
+class ArrayColumn(Column):
+    """数値を :class:`array.array` に格納します。
+
+    値があるかどうかは :attr:`present` に記録します。
+    """
+    __slots__ = ("values", "present", "kind")
+    values: array[Any]
+    present: bytearray
+    kind: type
+
+    TYPECODES: dict[type, str] = {int: "q", float: "d", bool: "b"}
+
+    def __init__(self, kind: type, size: int = 0):
+        self.kind = kind
+        self.values = array(self.TYPECODES[kind], bytes(array(self.TYPECODES[kind]).itemsize * size))
+        self.present = bytearray(size)
+
+    def append(self) -> None:
+        self.values.append(0)
+        self.present.append(0)
+
+    def get(self, row: int) -> Any:
+        if self.present[row]:
+            return self.kind(self.values[row])
+        return None
+
+    def has(self, row: int) -> bool:
+        return bool(self.present[row])
+
+    def set(self, row: int, val: Any) -> bool:
+        if val is None:
+            self.clear(row)
+            return True
+        if type(val) is not self.kind and not (self.kind is float and type(val) is int):
+            return False
+        try:
+            self.values[row] = val
+        except OverflowError:
+            return False
+        self.present[row] = 1
+        return True
+
+    def clear(self, row: int) -> None:
+        self.values[row] = 0
+        self.present[row] = 0
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    DTYPES: dict[str, str] = {"q": "int64", "d": "float64", "b": "int8"}
+
+    def view(self) -> tuple[Any, Any]:
+        """値と、値があるかどうかを表すNumPyの配列を返します。
+
+        配列はコピーせずに列のバッファを参照します。
+        参照している間は行を追加できないため、使い終わったらすぐに破棄してください。
+        """
+        assert np is not None
+        if not self.present:
+            return np.zeros(0, self.DTYPES[self.values.typecode]), np.zeros(0, np.bool_)
+        return (np.frombuffer(self.values, self.DTYPES[self.values.typecode]),
+                np.frombuffer(self.present, np.bool_))
+
+
+_ARRAY_KINDS: dict[str, type] = {"integer": int, "number": float, "boolean": bool}
+
+
+def column_for(prop: Property, size: int = 0) -> Column:
+    """プロパティに適した列を作成します。"""
+    if not prop.list and isinstance(prop.type, str):
+        t = DATA_TYPE_ALIAS.get(prop.type, prop.type)
+        kind = _ARRAY_KINDS.get(t)
+        if kind is not None:
+            return ArrayColumn(kind, size)
+        if t == "string":
+            return StringColumn(size)
+    return ObjectColumn(size)
+
+
+class NodeStore:
+    """1つの :class:`.NodeType` のNodeのプロパティを列ごとに保持します。"""
+    __slots__ = ("columns", "nodes", "size", "version", "_free")
+    columns: dict[Property, Column]
+    nodes: list[Node | None]
+    """行ごとのNode"""
+    size: int
+    """行の数"""
+    version: int
+    """行や値が変わるたびに増える番号"""
+    _free: list[int]
+
+    def __init__(self):
+        self.columns = {}
+        self.nodes = []
+        self.size = 0
+        self.version = 0
+        self._free = []
+
+    def add_column(self, prop: Property) -> None:
+        self.version += 1
+        self.columns[prop] = column_for(prop, self.size)
+
+    def alloc(self, node: Node) -> int:
+        """Nodeに行を割り当てます。"""
+        self.version += 1
+        if self._free:
+            row = self._free.pop()
+            self.nodes[row] = node
+            return row
+        row = self.size
+        self.size += 1
+        self.nodes.append(node)
+        for col in self.columns.values():
+            col.append()
+        return row
+
+    def release(self, row: int) -> None:
+        """行を解放します。"""
+        self.version += 1
+        for col in self.columns.values():
+            col.clear(row)
+        self.nodes[row] = None
+        self._free.append(row)
+
+    def set(self, prop: Property, row: int, val: Any) -> None:
+        self.version += 1
+        col = self.columns.get(prop)
+        if col is None:
+            col = ObjectColumn(self.size)
+            self.columns[prop] = col
+        if not col.set(row, val):
+            # 列に格納できない値のため、オブジェクトの列に変換する
+            obj = ObjectColumn(self.size)
+            for i in range(self.size):
+                obj.set(i, col.get(i))
+            self.columns[prop] = obj
+            obj.set(row, val)
+
+    def clear(self, prop: Property, row: int) -> None:
+        """行のプロパティの値を削除します。"""
+        self.version += 1
+        self.columns[prop].clear(row)
+
+
+class PropertyView(MutableMapping["Property", Any]):
+    """:class:`NodeStore` の1行を、プロパティから値への辞書として扱います。"""
+    __slots__ = ("store", "row")
+    store: NodeStore
+    row: int
+
+    def __init__(self, store: NodeStore, row: int):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, prop: Property) -> Any:
+        col = self.store.columns.get(prop)
+        if col is None or not col.has(self.row):
+            raise KeyError(prop)
+        return col.get(self.row)
+
+    def get(self, prop: Property, default: Any = None) -> Any:
+        col = self.store.columns.get(prop)
+        if col is None or not col.has(self.row):
+            return default
+        return col.get(self.row)
+
+    def __contains__(self, prop: object) -> bool:
+        col = self.store.columns.get(prop)  # type: ignore[call-overload]
+        return col is not None and col.has(self.row)
+
+    def __setitem__(self, prop: Property, val: Any) -> None:
+        self.store.set(prop, self.row, val)
+
+    def __delitem__(self, prop: Property) -> None:
+        if prop not in self:
+            raise KeyError(prop)
+        self.store.clear(prop, self.row)
+
+    def __iter__(self) -> Iterator[Property]:
+        row = self.row
+        for prop, col in self.store.columns.items():
+            if col.has(row):
+                yield prop
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+type _RefKey = tuple[NodeType, Property]
+
+
+class ReferenceIndex:
+    """Nodeのプロパティによる参照の逆引きを行います。
+
+    参照先のNodeとプロパティから、参照元のNodeの行番号をソートした列で引きます。
+    参照元のNodeは、プロパティを持つ :class:`.NodeType` の :class:`NodeStore` の行です。
+    """
+    __slots__ = ("_refs",)
+    _refs: dict[tuple[NodeStore, int], dict[_RefKey, array[int]]]
+
+    def __init__(self):
+        self._refs = {}
+
+    def add(self, prop: Property, target: Node, source: Node) -> None:
+        props = self._refs.setdefault((target.type.store, target.id), {})
+        key = (prop.owner, prop)
+        rows = props.get(key)
+        if rows is None:
+            props[key] = array("q", [source.id])
+            return
+        i = bisect.bisect_left(rows, source.id)
+        if i == len(rows) or rows[i] != source.id:
+            rows.insert(i, source.id)
+
+    def discard(self, prop: Property, target: Node, source: Node) -> None:
+        tkey = (target.type.store, target.id)
+        props = self._refs.get(tkey)
+        if props is None:
+            return
+        key = (prop.owner, prop)
+        rows = props.get(key)
+        if rows is None:
+            return
+        i = bisect.bisect_left(rows, source.id)
+        if i < len(rows) and rows[i] == source.id:
+            del rows[i]
+            if not rows:
+                del props[key]
+                if not props:
+                    del self._refs[tkey]
+
+    def build(self, refs: Iterable[tuple[Property, Node, Node]]) -> None:
+        """(プロパティ, 参照先, 参照元)の組をまとめて追加します。"""
+        pending: dict[tuple[NodeStore, int], dict[_RefKey, list[int]]] = {}
+        for prop, target, source in refs:
+            pending.setdefault((target.type.store, target.id), {}).setdefault((prop.owner, prop), []).append(source.id)
+        for tkey, props in pending.items():
+            cur = self._refs.setdefault(tkey, {})
+            for key, ids in props.items():
+                old = cur.get(key)
+                if old is not None:
+                    ids.extend(old)
+                cur[key] = array("q", sorted(set(ids)))
+
+    def sources(self, prop: Property, target: Node) -> list[Node]:
+        """targetをpropで参照しているNodeを返します。"""
+        props = self._refs.get((target.type.store, target.id))
+        if props is None:
+            return []
+        rows = props.get((prop.owner, prop))
+        if rows is None:
+            return []
+        nodes = prop.owner.store.nodes
+        return [n for n in (nodes[r] for r in rows) if n is not None]
+
+    def referenced(self, target: Node) -> bool:
+        """targetが参照されているかどうかを返します。"""
+        return (target.type.store, target.id) in self._refs
+
+    def referrers(self, target: Node) -> list[tuple[Property, Node]]:
+        """targetを参照しているプロパティとNodeの組を返します。"""
+        props = self._refs.get((target.type.store, target.id))
+        if props is None:
+            return []
+        return [(prop, n) for (_, prop) in props for n in self.sources(prop, target)]
+
+    def drop(self, target: Node) -> None:
+        """targetへの参照をすべて削除します。"""
+        self._refs.pop((target.type.store, target.id), None)
+
+    def clear(self) -> None:
+        self._refs.clear()
+
+
+# datatypeはnodetypeを経由してこのモジュールを読み込むので、最後に読み込む
+from .datatype import DATA_TYPE_ALIAS
@@ -1,4 +1,7 @@
 import json
+import os
+import shutil
+import threading
 from pathlib import Path
 from typing import ClassVar, Iterable, Protocol, Type, TypeVar, TypedDict, cast
 
@@ -37,29 +40,124 @@ def load_config_file(file: Path, schema: JsonSchema) -> Json:
 
     拡張子にあわせて、JSONまたはYAMLを読み込みます。
     """
-    ret: Json
     f = config_file_of(file)
     if f is None:
-        ret = {}
-    elif f.suffix == ".json":
-        with open(f, "r") as f:
+        ret:Json = {}
+        jsonschema.validate(ret,schema)
+        return ret
+    return read_config_file(f,schema)
+
+def read_config_file(file: Path, schema: JsonSchema) -> Json:
+    """設定ファイルを読み込みます。
+
+    :func:`load_config_file` と異なり、fileは存在するファイルでなくてはなりません。
+    """
+    ret: Json
+    if file.suffix == ".json":
+        with open(file, "r") as f:
             ret = json.load(f)
     else:
-        with open(f, "rb") as f:
+        with open(file, "rb") as f:
             ret = yaml.safe_load(f)
     jsonschema.validate(ret,schema)
     return ret
 
 def dump_config_file(file:Path,val:Json)->None:
+    """設定ファイルを書き込みます。
+
+    fileに拡張子がついていない場合は、既存の設定ファイルに書き込みます。
+    """
     f = config_file_of(file)
     if f is None:
         f=file
-    if f.suffix == ".json":
-        with open(f, "w",encoding='utf-8') as f:
-            json.dump(val,f)
-    else:
-        with open(f, "w",encoding='utf-8') as f:
-            yaml.safe_dump(val,f)
+    write_config_file(f,val)
+
+def write_config_file(f:Path,val:Json)->None:
+    """設定ファイルを書き込みます。
+
+    一時ファイルに書き込んでから置き換えるため、書き込み途中の内容が読まれることはありません。
+    """
+    tmp=f.with_name(f".{f.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "w",encoding='utf-8') as out:
+            if f.suffix == ".json":
+                json.dump(val,out)
+            else:
+                yaml.safe_dump(val,out)
+        try:
+            shutil.copymode(f,tmp)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp,f)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+class DirectorySnapshot:
+    """ディレクトリの内容を記録し、ファイルの存在の判定をメモリ上で行います。
+
+    各ディレクトリは、最初に参照されたときに :func:`os.scandir` で1回だけ読み込まれます。
+    スナップショットを作った後にファイルを作成・削除した場合は、:meth:`add` や :meth:`remove` で反映させます。
+    """
+    _dirs:dict[Path,dict[str,bool]]
+
+    def __init__(self):
+        self._dirs={}
+
+    def entries(self,dir:Path)->dict[str,bool]:
+        """ディレクトリ内のエントリの名前と、それがディレクトリかどうかの辞書を返します。"""
+        ret=self._dirs.get(dir)
+        if ret is None:
+            ret={}
+            try:
+                with os.scandir(dir) as it:
+                    for entry in it:
+                        try:
+                            ret[entry.name]=entry.is_dir()
+                        except OSError:
+                            ret[entry.name]=False
+            except (FileNotFoundError,NotADirectoryError):
+                pass
+            self._dirs[dir]=ret
+        return ret
+
+    def exists(self,path:Path)->bool:
+        return path.name in self.entries(path.parent)
+
+    def is_dir(self,path:Path)->bool:
+        return self.entries(path.parent).get(path.name,False)
+
+    def is_file(self,path:Path)->bool:
+        return self.entries(path.parent).get(path.name)==False
+
+    def config_file_of(self,file:Path)->Path|None:
+        """:func:`config_file_of` と同じ判定を、スナップショットを使って行います。"""
+        entries=self.entries(file.parent)
+        if is_config_file(file) and entries.get(file.name)==False:
+            return file
+        for suffix in SUFFIXES:
+            f = file.with_suffix(suffix)
+            if entries.get(f.name)==False:
+                return f
+        return None
+
+    def add(self,path:Path,is_dir:bool=False)->None:
+        """作成したファイルを反映させます。"""
+        entries=self._dirs.get(path.parent)
+        if entries is not None:
+            entries[path.name]=is_dir
+
+    def remove(self,path:Path)->None:
+        """削除したファイルを反映させます。"""
+        entries=self._dirs.get(path.parent)
+        if entries is not None:
+            entries.pop(path.name,None)
+        self._dirs.pop(path,None)
+
+    def forget(self,dir:Path)->None:
+        """ディレクトリの記録を破棄します。次に参照されたときに読み込み直されます。"""
+        self._dirs.pop(dir,None)
 
 
 class TypedConfig(TypedDict):
@@ -0,0 +1,183 @@
+"""
+Repositoryを読み込んだまま常駐し、:mod:`.client` から転送されたコマンドを実行します。
+
+設定ディレクトリは :class:`.RepositoryWatcher` で監視され、変更はすぐに反映されます。
+コマンドは1つずつ順に実行され、設定ディレクトリの変更はコマンドの間に反映されます。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+from contextvars import ContextVar
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, TextIO, cast
+
+if TYPE_CHECKING:
+    from .cli import CliApp
+
+logger = logging.getLogger(__name__)
+
+
+class _Output(io.TextIOBase):
+    """書き込まれた文字列を、クライアントに送ります。"""
+
+    def __init__(self, writer: asyncio.StreamWriter, key: str):
+        self.writer = writer
+        self.key = key
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        if s and not self.writer.is_closing():
+            self.writer.write((json.dumps({self.key: s}, ensure_ascii=False) + "\n").encode("utf-8"))
+        return len(s)
+
+    async def drain(self) -> None:
+        """送り終わるまで待ちます。"""
+        if not self.writer.is_closing():
+            await self.writer.drain()
+
+
+_outputs: ContextVar[tuple[_Output, _Output] | None] = ContextVar("herms_daemon_outputs", default=None)
+"""実行中のコマンドの標準出力と標準エラー出力"""
+
+
+class _Redirect(io.TextIOBase):
+    """コマンドの実行中は、そのコマンドのクライアントに書き込みます。それ以外は元のファイルに書き込みます。"""
+
+    def __init__(self, orig: TextIO, index: int):
+        self.orig = orig
+        self.index = index
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        outputs = _outputs.get()
+        if outputs is None:
+            return self.orig.write(s)
+        return outputs[self.index].write(s)
+
+    def flush(self) -> None:
+        if _outputs.get() is None:
+            self.orig.flush()
+
+    async def drain(self) -> None:
+        outputs = _outputs.get()
+        if outputs is not None:
+            await outputs[self.index].drain()
+
+
+class Daemon:
+    """:class:`.CliApp` のRepositoryを保持して、コマンドを実行します。"""
+    app: CliApp
+    path: Path
+    """ソケットのパス"""
+    server: asyncio.Server | None
+    _lock: asyncio.Lock
+    _stopped: asyncio.Event
+
+    def __init__(self, app: CliApp, path: str | Path):
+        self.app = app
+        self.path = Path(path)
+        self.server = None
+        self._lock = asyncio.Lock()
+        self._stopped = asyncio.Event()
+
+    async def start(self) -> asyncio.Server:
+        """接続の受け付けを開始します。"""
+        if self.path.exists():
+            try:
+                _, writer = await asyncio.open_unix_connection(str(self.path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 前回のデーモンが残したソケット
+                self.path.unlink(missing_ok=True)
+            else:
+                writer.close()
+                raise RuntimeError(f"{self.path}: A daemon is already running.")
+        self.server = await asyncio.start_unix_server(self.handle, str(self.path))
+        os.chmod(self.path, 0o600)
+        sys.stdout = _Redirect(sys.stdout, 0)
+        sys.stderr = _Redirect(sys.stderr, 1)
+        return self.server
+
+    async def serve(self) -> None:
+        """:meth:`stop` されるまで、コマンドを受け付けます。"""
+        await self.start()
+        logger.info("daemon for %s listening on %s", self.app.repository.config_dir, self.path)
+        # 変更の反映は、コマンドの実行中には行わない
+        watcher = asyncio.create_task(self.app.repository.watch(self._lock).run())
+        try:
+            await self._stopped.wait()
+        finally:
+            watcher.cancel()
+            await self.close()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            self.path.unlink(missing_ok=True)
+            if isinstance(sys.stdout, _Redirect):
+                sys.stdout = sys.stdout.orig
+            if isinstance(sys.stderr, _Redirect):
+                sys.stderr = sys.stderr.orig
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            req = cast(dict[str, Any], json.loads(line))
+            if req.get("stop"):
+                code = 0
+                self.stop()
+            else:
+                code = await self._run(cast(list[str], req.get("argv", [])), writer, cast(int | None, req.get("loglevel")))
+            writer.write((json.dumps({"exit": code}) + "\n").encode("utf-8"))
+            await writer.drain()
+        except (ConnectionError, json.JSONDecodeError) as e:
+            logger.debug("connection closed: %r", e)
+        finally:
+            writer.close()
+
+    async def _run(self, argv: list[str], writer: asyncio.StreamWriter, loglevel: int | None = None) -> int:
+        async with self._lock:
+            err = _Output(writer, "err")
+            token = _outputs.set((_Output(writer, "out"), err))
+            root = logging.getLogger()
+            level = root.level
+            handler: logging.Handler | None = None
+            if loglevel is not None:
+                # クライアントの -v や -D の指定にしたがって、ログもクライアントに送る
+                handler = logging.StreamHandler(err)
+                handler.setLevel(loglevel)
+                root.addHandler(handler)
+                root.setLevel(min(level, loglevel))
+            try:
+                await self.app.execute(argv)
+            except SystemExit as e:
+                # argparseのエラーとヘルプ
+                return e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+            except Exception as e:
+                logger.exception("command failed: %s", " ".join(argv))
+                err.write(f"herms: {e}\n")
+                return 1
+            finally:
+                if handler is not None:
+                    root.removeHandler(handler)
+                    root.setLevel(level)
+                _outputs.reset(token)
+                # ジャーナルだけに記録した変更も、次のコマンドまでにストレージに書き込む
+                self.app.repository.checkpoint()
+            return 0
@@ -38,7 +38,9 @@ def schema_of(type:DataType)->JsonSchema:
     else:
         return {"type":"string"}
 
-def to_type(name:str,repo:Repository)->DataType:
+def to_type(name:str|None,repo:Repository)->DataType:
+    if name is None:
+        return None
     if name in repo.types:
         return repo.types[name]
     tag=repo.tag(name)
@@ -46,13 +48,20 @@ def to_type(name:str,repo:Repository)->DataType:
         return tag
     return name
 
+def converter_of(type:DataType)->DataTypeConverter:
+    """型に対応する変換器を返します。"""
+    return _converter_of(type)
+
 #
 # further implementation
 #
-from .nodetype import NodeType
-from .node import Node
+# nodetypeはdatatypeを読み込むので、モジュールとして参照する
+from . import nodetype
 from .tag import Tag
 if TYPE_CHECKING:
+    from .config import JsonObject
+    from .node import Node
+    from .nodetype import NodeType
     from .repository import Repository
 
 class _StringConverter(DataTypeConverter):
@@ -87,7 +96,7 @@ class _NodeConverter(DataTypeConverter):
     def __init__(self,type:NodeType|None=None):
         self.type=type
     def encode(self,val:Any,type:DataType)->Json:
-        node=cast(Node,val)
+        node=cast("Node",val)
         if self.type==None or self.type!=node.type:
             return node.type.name+":"+node.name
         else:
@@ -107,7 +116,7 @@ DATA_TYPE_CONVERTER:dict[str,DataTypeConverter]={
 }
 
 def _converter_of(type:DataType)->DataTypeConverter:
-    if isinstance(type,NodeType):
+    if isinstance(type,nodetype.NodeType):
         return _NodeConverter(type)
     t:str
     if type is None:
@@ -120,15 +129,86 @@ def _converter_of(type:DataType)->DataTypeConverter:
     return DATA_TYPE_CONVERTER[t]
 
 def is_node(type:DataType)->bool:
-    return type=='node' or isinstance(type,NodeType)
+    return type=='node' or isinstance(type,nodetype.NodeType)
 
 def is_tag(type:DataType)->bool:
     return type=='tag' or isinstance(type,Tag)
 
 def decode(data:Json,type:DataType,repo:Repository,create:bool=False)->Any:
+    if data is None:
+        return None
     return _converter_of(type).decode(data,type,repo,create)
 
 def encode(val:Any,type:DataType,repo:Repository)->Json:
     return _converter_of(type).encode(type,val)
 def register(name:str,conv:DataTypeConverter):
-    DATA_TYPE_CONVERTER[name]=conv
\ No newline at end of file
+    DATA_TYPE_CONVERTER[name]=conv
+
+class ReferenceResolver:
+    """読み込み時に、Nodeとタグへの参照をまとめて解決します。
+
+    まず :meth:`collect` ですべての設定から参照を集め、:meth:`resolve` で名前の索引を使って一度に解決します。
+    その後、:meth:`node` や :meth:`tag` で解決済みの値を取り出します。
+    """
+    repo:Repository
+    nodes:dict[tuple[str,NodeType|None],Node|None]
+    tags:dict[str,Tag|None]
+    node_tags:dict[str,Tag|None]
+
+    def __init__(self,repo:Repository):
+        self.repo=repo
+        self.nodes={}
+        self.tags={}
+        self.node_tags={}
+
+    def collect(self,type:NodeType,config:JsonObject)->None:
+        """Nodeの設定に含まれる参照を集めます。"""
+        for name in cast(list[str],config.get("tags",[])):
+            self.node_tags[name]=None
+        props=cast(dict[str,Json],config.get("properties") or {})
+        for name,prop in type.properties.items():
+            val=props.get(name)
+            if val is None:
+                continue
+            vals=cast(list[Json],val) if prop.list else [val]
+            if prop.is_node():
+                t=prop.type if isinstance(prop.type,nodetype.NodeType) else None
+                for x in vals:
+                    self.nodes[(cast(str,x),t)]=None
+            elif prop.is_tag():
+                for x in vals:
+                    self.tags[cast(str,x)]=None
+
+    def resolve(self)->None:
+        """集めた参照を解決します。"""
+        index:dict[str,list[Node]]|None=None
+        for key in self.nodes:
+            text,type=key
+            sep=text.find(":")
+            if sep>=0:
+                type=self.repo.types[text[0:sep]]
+                text=text[sep+1:]
+            if type is not None:
+                self.nodes[key]=self.repo.nodes.find(type,text)
+                continue
+            if index is None:
+                index={}
+                for node in self.repo.nodes.iterate():
+                    index.setdefault(node.name,[]).append(node)
+            found=index.get(text,[])
+            if len(found)>1:
+                raise KeyError(text+": ambiguous name (in "+found[0].type.name+" and "+found[1].type.name+").")
+            self.nodes[key]=found[0] if found else None
+        for name in self.tags:
+            self.tags[name]=self.repo.tag(name)
+        for name in self.node_tags:
+            self.node_tags[name]=self.repo.tag_or_create(name,None)
+
+    def node(self,text:str,type:DataType)->Node|None:
+        return self.nodes[(text,type if isinstance(type,nodetype.NodeType) else None)]
+
+    def tag(self,text:str)->Tag|None:
+        return self.tags[text]
+
+    def node_tag(self,text:str)->Tag:
+        return cast(Tag,self.node_tags[text])
\ No newline at end of file
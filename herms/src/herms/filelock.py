@@ -0,0 +1,43 @@
+"""
+複数のプロセスで共有するファイルのためのロックです。
+
+POSIXでは :func:`fcntl.flock` を、Windowsでは :func:`msvcrt.locking` を使います。
+ロックには、対象のファイルとは別の、``.lock`` をつけたファイルを使います。
+"""
+
+from __future__ import annotations
+
+import sys
+from typing import IO
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def lock(f: IO[bytes], blocking: bool = True) -> bool:
+        """fの排他ロックを取ります。blockingがFalseで、すでにロックされている場合はFalseを返します。"""
+        f.seek(0)
+        try:
+            # LK_LOCKは、取れるまで何度か試す
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            if blocking:
+                raise
+            return False
+        return True
+
+    def unlock(f: IO[bytes]) -> None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def lock(f: IO[bytes], blocking: bool = True) -> bool:
+        """fの排他ロックを取ります。blockingがFalseで、すでにロックされている場合はFalseを返します。"""
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def unlock(f: IO[bytes]) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,261 @@
+"""
+時間のかかる処理(ジョブ)を、優先度をつけて非同期に実行します。
+
+:class:`JobRunner` は優先度つきのキューを持ち、決まった数のワーカーでジョブを取り出して実行します。
+各ジョブは :class:`Job` で表され、進み具合、結果、エラーを持ちます。実行前や実行中のジョブは取り消せます。
+
+ジョブの中からさらにジョブを実行した場合、キューには入れずにその場で実行します。
+ワーカーがすべて子のジョブを待って止まってしまうことを防ぐためです。
+
+ジョブは、投入したときのコンテキスト( :mod:`contextvars` )で実行されます。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import itertools
+import logging
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Any, Literal
+
+logger = logging.getLogger(__name__)
+
+type JobState = Literal["pending", "running", "done", "failed", "cancelled"]
+type JobFunc[T] = Callable[[Job[T]], Awaitable[T]]
+type JobListener = Callable[[Job[Any]], None]
+
+_current: contextvars.ContextVar[Job[Any] | None] = contextvars.ContextVar("herms_job", default=None)
+
+
+def current() -> Job[Any] | None:
+    """実行中のジョブを返します。ジョブの外ではNoneです。"""
+    return _current.get()
+
+
+class Job[T]:
+    """1つのジョブです。
+
+    ``await job`` で終了を待ち、結果を受け取れます。失敗した場合は例外が送出されます。
+    """
+    name: str
+    priority: int
+    """小さいほど先に実行されます"""
+    state: JobState
+    progress: float
+    """進み具合(0から1)"""
+    message: str
+    """進み具合の説明"""
+    result: T | None
+    error: BaseException | None
+    parent: Job[Any] | None
+    """このジョブを実行したジョブ"""
+
+    _func: JobFunc[T]
+    _future: asyncio.Future[T]
+    _task: asyncio.Task[Any] | None
+    _cancelling: bool
+    _context: contextvars.Context
+    _waiters: int
+    _runner: JobRunner
+
+    def __init__(self, runner: JobRunner, func: JobFunc[T], name: str = "", priority: int = 0):
+        self._runner = runner
+        self._func = func
+        self.name = name
+        self.priority = priority
+        self.state = "pending"
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.parent = _current.get()
+        self._future = asyncio.get_running_loop().create_future()
+        self._task = None
+        self._cancelling = False
+        self._context = contextvars.copy_context()
+        self._waiters = 0
+
+    def report(self, progress: float, message: str = "") -> None:
+        """進み具合を報告します。"""
+        self.progress = min(max(progress, 0.0), 1.0)
+        self.message = message
+        self._runner._notify(self)
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def cancel(self) -> bool:
+        """ジョブを取り消します。すでに終わっている場合はFalseを返します。"""
+        if self.done():
+            return False
+        if self._task is not None:
+            self._cancelling = True
+            self._task.cancel()
+        else:
+            self._finish("cancelled")
+        return True
+
+    async def wait(self) -> T:
+        """終了を待ち、結果を返します。
+
+        待っているすべてのタスクが取り消された場合は、ジョブも取り消します。
+        """
+        self._waiters += 1
+        try:
+            return await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            if self._waiters == 1:
+                self.cancel()
+            raise
+        finally:
+            self._waiters -= 1
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    async def _run(self) -> None:
+        if self.done():
+            return
+        self.state = "running"
+        self._runner._notify(self)
+        token = _current.set(self)
+        try:
+            self._task = asyncio.current_task()
+            result = await self._func(self)
+        except asyncio.CancelledError:
+            self._finish("cancelled")
+            if not self._cancelling:
+                raise
+            # このジョブだけを取り消したので、実行しているタスクは続ける
+            task = asyncio.current_task()
+            if task is not None:
+                task.uncancel()
+        except Exception as e:
+            self._finish("failed", error=e)
+        else:
+            self._finish("done", result=result)
+        finally:
+            _current.reset(token)
+            self._task = None
+
+    def _finish(self, state: JobState, result: T | None = None, error: BaseException | None = None) -> None:
+        if self._future.done():
+            return
+        self.state = state
+        if state == "done":
+            self.result = result
+            self.progress = 1.0
+            self._future.set_result(result)  # type: ignore[arg-type]
+        elif state == "failed":
+            assert error is not None
+            self.error = error
+            self._future.set_exception(error)
+            self._future.exception()  # 待つ人がいなくても警告を出さない
+        else:
+            self._future.cancel()
+        self._runner._notify(self)
+
+    def __str__(self) -> str:
+        return f"{self.name}({self.state}, {self.progress:.0%})"
+
+
+class JobRunner:
+    """ジョブを優先度の順に、決まった数のワーカーで実行します。
+
+    ワーカーは最初にジョブを投入したときに起動します。
+    """
+    workers: int
+    """同時に実行するジョブの数"""
+    jobs: list[Job[Any]]
+    """実行前と実行中のジョブ"""
+    history: deque[Job[Any]]
+    """終了したジョブ(新しいものから一定の数)"""
+    listeners: list[JobListener]
+    """ジョブの状態や進み具合が変わったとき呼ばれます"""
+
+    _queue: asyncio.PriorityQueue[tuple[int, int, Job[Any]]] | None
+    _tasks: list[asyncio.Task[None]]
+    _counter: itertools.count[int]
+
+    def __init__(self, workers: int = 4, history: int = 100):
+        self.workers = workers
+        self.jobs = []
+        self.history = deque(maxlen=history)
+        self.listeners = []
+        self._queue = None
+        self._tasks = []
+        self._counter = itertools.count()
+
+    def submit[T](self, func: JobFunc[T], name: str = "", priority: int = 0) -> Job[T]:
+        """ジョブをキューに入れます。"""
+        job = Job(self, func, name, priority)
+        self.jobs.append(job)
+        self._start().put_nowait((priority, next(self._counter), job))
+        self._notify(job)
+        return job
+
+    async def run[T](self, func: JobFunc[T], name: str = "", priority: int = 0) -> T:
+        """ジョブを実行し、結果を返します。
+
+        ジョブの中から呼ばれた場合は、キューに入れずにその場で実行します。
+        呼び出し側が取り消された場合(タイムアウトを含む)は、ジョブも取り消します。
+        """
+        if _current.get() is None:
+            return await self.submit(func, name, priority)
+        job = Job(self, func, name, priority)
+        self.jobs.append(job)
+        await job._run()
+        return await job
+
+    def failed(self) -> list[Job[Any]]:
+        """失敗したジョブを返します。"""
+        return [x for x in self.history if x.state == "failed"]
+
+    async def join(self) -> None:
+        """キューのジョブがすべて終わるまで待ちます。"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self) -> None:
+        """実行前のジョブを取り消し、ワーカーを止めます。"""
+        for job in list(self.jobs):
+            if job.state == "pending":
+                job.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def _start(self) -> asyncio.PriorityQueue[tuple[int, int, Job[Any]]]:
+        loop = asyncio.get_running_loop()
+        if self._queue is None or any(t.get_loop() is not loop for t in self._tasks):
+            self._queue = asyncio.PriorityQueue()
+            self._tasks = [loop.create_task(self._worker(self._queue), name=f"herms-job-{i}")
+                           for i in range(self.workers)]
+        return self._queue
+
+    async def _worker(self, queue: asyncio.PriorityQueue[tuple[int, int, Job[Any]]]) -> None:
+        while True:
+            _, _, job = await queue.get()
+            try:
+                # 投入したタスクのコンテキストで実行する
+                await asyncio.create_task(job._run(), name=f"herms-job:{job.name}", context=job._context)
+            except asyncio.CancelledError:
+                # 子のジョブが取り消された場合は、ワーカーは止めない
+                task = asyncio.current_task()
+                if task is None or task.cancelling():
+                    raise
+            finally:
+                queue.task_done()
+
+    def _notify(self, job: Job[Any]) -> None:
+        if job.done() and job in self.jobs:
+            self.jobs.remove(job)
+            self.history.appendleft(job)
+            if job.state == "failed":
+                logger.debug("job %s failed: %r", job.name, job.error)
+        for listener in self.listeners:
+            listener(job)
@@ -0,0 +1,203 @@
+"""
+Nodeの変更を追記していくジャーナルです。
+
+:class:`.WriteBuffer` は、Nodeを保存するとき、まずジャーナルに追記してfsyncします。
+ストレージへの書き込み(チェックポイント)は、後でまとめてバックグラウンドで行われます。
+チェックポイントが終わった記録はジャーナルから取り除かれます。
+
+途中で終了した場合は、次に :meth:`.Repository.configure` したとき、
+ジャーナルに残っている変更をストレージに書き込みます(:meth:`Journal.replay`)。
+
+ジャーナルに書き込めるのは、``journal.jsonl.lock`` のロックを取った1つのプロセス(所有者)だけです。
+他のプロセスはジャーナルを書き換えず、読み込んだ内容に反映するだけにします(:meth:`Journal.overlay`)。
+
+ジャーナルは ``data_dir/journal.jsonl`` に、1行に1つの変更をJSONで記録します。
+各記録には連番(``seq``)がつきます。
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, TypedDict, cast
+
+from . import filelock
+
+if TYPE_CHECKING:
+    from .changefeed import ChangeFeed
+    from .config import JsonObject
+    from .storage import NodeDocument, NodeKey, Storage
+
+logger = logging.getLogger(__name__)
+
+type Change = tuple[str, str, JsonObject | None]
+"""NodeType名、Node名、Nodeの設定の組です。設定がNoneのときは削除を表します。"""
+
+
+class JournalRecord(TypedDict, total=False):
+    seq: int
+    type: str
+    name: str
+    doc: JsonObject
+    """Nodeの設定。ないときは削除を表します。"""
+
+
+class Journal:
+    """追記のみのジャーナルファイルです。"""
+    FILE = "journal.jsonl"
+
+    path: Path
+    seq: int
+    """最後に追記した記録の連番"""
+    _file: IO[str] | None
+    _lockfile: IO[bytes] | None
+    _lock: threading.Lock
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+        self._lockfile = None
+        self._lock = threading.Lock()
+        self.seq = max((r["seq"] for r in self.records()), default=0)
+
+    @property
+    def owner(self) -> bool:
+        """このプロセスがジャーナルの所有者かどうか"""
+        return self._lockfile is not None
+
+    def acquire(self) -> bool:
+        """ジャーナルの所有者になります。他のプロセスが所有している場合はFalseを返します。
+
+        ロックは :meth:`close` まで持ち続けます。
+        """
+        with self._lock:
+            return self._acquire()
+
+    def _acquire(self) -> bool:
+        if self._lockfile is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            f = self.path.with_name(f"{self.path.name}.lock").open("ab")
+            if not filelock.lock(f, blocking=False):
+                f.close()
+                return False
+            self._lockfile = f
+            # 前の所有者が追記した記録の続きから番号をつける
+            self.seq = max((r["seq"] for r in self.records()), default=0)
+        return True
+
+    def records(self) -> list[JournalRecord]:
+        """ジャーナルの記録を返します。
+
+        途中で書き込みが途切れた行は無視します。
+        """
+        ret: list[JournalRecord] = []
+        try:
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        ret.append(cast(JournalRecord, json.loads(line)))
+                    except json.JSONDecodeError:
+                        logger.warning("%s: ignoring a broken record", self.path)
+        except FileNotFoundError:
+            pass
+        return ret
+
+    def append(self, changes: Iterable[Change]) -> int:
+        """変更をまとめて追記し、fsyncします。最後の記録の連番を返します。"""
+        with self._lock:
+            lines: list[str] = []
+            for type, name, doc in changes:
+                self.seq += 1
+                record: JournalRecord = {"seq": self.seq, "type": type, "name": name}
+                if doc is not None:
+                    record["doc"] = doc
+                lines.append(self._dump(record))
+            if lines:
+                f = self._open()
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+            return self.seq
+
+    @staticmethod
+    def _dump(record: JournalRecord) -> str:
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def _open(self) -> IO[str]:
+        self._own()
+        if self._file is None:
+            self._file = self.path.open("a", encoding="utf-8")
+        return self._file
+
+    def _own(self) -> None:
+        if not self._acquire():
+            raise RuntimeError(f"{self.path}: The journal is used by another process.")
+
+    def truncate(self, seq: int) -> None:
+        """連番がseq以下の記録を取り除きます。"""
+        with self._lock:
+            self._own()
+            rest = [r for r in self.records() if r["seq"] > seq]
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if not rest:
+                if self.path.exists():
+                    self.path.write_bytes(b"")
+                return
+            tmp = self.path.with_name(f".{self.path.name}.tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                f.write("".join(self._dump(r) for r in rest))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+    def latest(self) -> dict[NodeKey, JsonObject | None]:
+        """ジャーナルに残っている、各Nodeの最後の変更を返します。"""
+        ret: dict[NodeKey, JsonObject | None] = {}
+        for r in self.records():
+            ret[(r["type"], r["name"])] = r.get("doc")
+        return ret
+
+    def overlay(self, docs: Iterable[NodeDocument]) -> Iterator[NodeDocument]:
+        """ストレージから読み込んだdocsに、ジャーナルに残っている変更を反映して返します。ジャーナルは変更しません。"""
+        latest = self.latest()
+        for t, n, doc in docs:
+            if (t, n) not in latest:
+                yield t, n, doc
+        for (t, n), changed in latest.items():
+            if changed is not None:
+                yield t, n, changed
+
+    def replay(self, storage: Storage, feed: ChangeFeed | None = None) -> int:
+        """ジャーナルに残っている変更をストレージに書き込み、ジャーナルを空にします。所有者だけが呼べます。
+
+        feedを指定した場合は、書き込んだNodeをそこに記録します。書き込んだ変更の数を返します。
+        """
+        with self._lock:
+            self._own()
+        latest = self.latest()
+        if not latest:
+            return 0
+        storage.save((t, n, d) for (t, n), d in latest.items() if d is not None)
+        storage.delete(k for k, d in latest.items() if d is None)
+        if feed is not None:
+            feed.record((k, d is None) for k, d in latest.items())
+        self.truncate(self.seq)
+        logger.info("%s: replayed %d changes", self.path, len(latest))
+        return len(latest)
+
+    def close(self) -> None:
+        """ファイルを閉じ、所有者でなくなります。"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lockfile is not None:
+                filelock.unlock(self._lockfile)
+                self._lockfile.close()
+                self._lockfile = None
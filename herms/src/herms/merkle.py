@@ -0,0 +1,170 @@
+"""
+Nodeの :meth:`~.Node.fingerprint` をまとめたハッシュの木(Merkle tree)です。
+
+Nodeは、NodeTypeごとに、名前のハッシュで :data:`BUCKETS` 個のバケツに分けられます。
+バケツのハッシュはその中のNodeの名前とfingerprintから、NodeTypeのハッシュはバケツのハッシュから求めます。
+Nodeが変更されると、そのNodeのバケツだけが再計算の対象になります。
+
+2つの木を比べるときは、ハッシュの異なる部分だけをたどります(:func:`diff`)。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import zlib
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from .node import Node
+    from .storage import NodeKey
+
+BUCKETS = 256
+"""NodeTypeごとのバケツの数。比べる木どうしで同じでなければなりません。"""
+
+_EMPTY = b""
+
+
+def bucket_of(name: str) -> int:
+    return zlib.crc32(name.encode("utf-8")) % BUCKETS
+
+
+def _hash(*parts: bytes) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for x in parts:
+        h.update(len(x).to_bytes(4, "little"))
+        h.update(x)
+    return h.digest()
+
+
+class _TypeTree:
+    __slots__ = ("buckets", "hashes", "hash")
+    buckets: list[dict[str, Node]]
+    hashes: list[bytes | None]
+    """バケツのハッシュ。Noneは再計算が必要なことを示します。"""
+    hash: bytes | None
+
+    def __init__(self):
+        self.buckets = [{} for _ in range(BUCKETS)]
+        self.hashes = [_EMPTY] * BUCKETS
+        self.hash = _EMPTY
+
+    def bucket_hash(self, i: int) -> bytes:
+        h = self.hashes[i]
+        if h is None:
+            bucket = self.buckets[i]
+            if bucket:
+                h = _hash(*(x for name in sorted(bucket) for x in (name.encode("utf-8"), bucket[name].fingerprint())))
+            else:
+                h = _EMPTY
+            self.hashes[i] = h
+        return h
+
+    def type_hash(self) -> bytes:
+        if self.hash is None:
+            hashes = [self.bucket_hash(i) for i in range(BUCKETS)]
+            self.hash = _EMPTY if not any(hashes) else _hash(*hashes)
+        return self.hash
+
+
+class MerkleTree:
+    """RepositoryのNodeのハッシュの木です。
+
+    :meth:`.Repository.track` などから :meth:`touch` が呼ばれ、変更のあったバケツが記録されます。
+    ハッシュは必要になったときに再計算されます。
+    """
+    types: dict[str, _TypeTree]
+    _root: bytes | None
+
+    def __init__(self):
+        self.types = {}
+        self._root = _EMPTY
+
+    def clear(self) -> None:
+        self.types.clear()
+        self._root = _EMPTY
+
+    def _tree(self, type: str) -> _TypeTree:
+        tree = self.types.get(type)
+        if tree is None:
+            tree = _TypeTree()
+            self.types[type] = tree
+        return tree
+
+    def _invalidate(self, tree: _TypeTree, i: int) -> None:
+        tree.hashes[i] = None
+        tree.hash = None
+        self._root = None
+
+    def add(self, node: Node) -> None:
+        tree = self._tree(node.type.name)
+        i = bucket_of(node.name)
+        tree.buckets[i][node.name] = node
+        self._invalidate(tree, i)
+
+    def touch(self, node: Node) -> None:
+        """Nodeの内容が変わったことを記録します。"""
+        tree = self.types.get(node.type.name)
+        if tree is not None:
+            i = bucket_of(node.name)
+            if tree.buckets[i].get(node.name) is node:
+                self._invalidate(tree, i)
+
+    def discard(self, node: Node) -> None:
+        tree = self.types.get(node.type.name)
+        if tree is not None:
+            i = bucket_of(node.name)
+            if tree.buckets[i].get(node.name) is node:
+                del tree.buckets[i][node.name]
+                self._invalidate(tree, i)
+
+    def root(self) -> bytes:
+        """木全体のハッシュを返します。"""
+        if self._root is None:
+            hashes = [(name, tree.type_hash()) for name, tree in sorted(self.types.items())]
+            self._root = _hash(*(x for name, h in hashes if h for x in (name.encode("utf-8"), h)))
+        return self._root
+
+
+class TreeDiff(NamedTuple):
+    """2つの木の違いです。"""
+    added: list[NodeKey]
+    """後の木にだけあるNode"""
+    removed: list[NodeKey]
+    """前の木にだけあるNode"""
+    changed: list[NodeKey]
+    """内容の異なるNode"""
+    buckets: int
+    """調べたバケツの数"""
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+def diff(a: MerkleTree, b: MerkleTree) -> TreeDiff:
+    """aとbの違いを返します。ハッシュの異なる部分だけを調べます。"""
+    ret = TreeDiff([], [], [], 0)
+    if a.root() == b.root():
+        return ret
+    count = 0
+    empty = _TypeTree()
+    for type in sorted(set(a.types) | set(b.types)):
+        ta = a.types.get(type, empty)
+        tb = b.types.get(type, empty)
+        if ta.type_hash() == tb.type_hash():
+            continue
+        for i in range(BUCKETS):
+            if ta.bucket_hash(i) == tb.bucket_hash(i):
+                continue
+            count += 1
+            ba = ta.buckets[i]
+            bb = tb.buckets[i]
+            for name in sorted(ba.keys() | bb.keys()):
+                na = ba.get(name)
+                nb = bb.get(name)
+                if na is None:
+                    ret.added.append((type, name))
+                elif nb is None:
+                    ret.removed.append((type, name))
+                elif na.fingerprint() != nb.fingerprint():
+                    ret.changed.append((type, name))
+    return ret._replace(buckets=count)
@@ -4,8 +4,10 @@
 環境構築を提供するモジュールです。
 """
 
+from .importer import Importer
 from .service import SyncService
 
 __all__ = [
+    "Importer",
     "SyncService",
 ]
\ No newline at end of file
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import copy
+import datetime
+import decimal
+from collections.abc import Mapping
+from pathlib import PurePath
+from typing import Any, cast
+
+from herms import Node, NodeType, Repository, Service, State, Tag
+from herms.nodetype import Property
+
+IMMUTABLE:tuple[type,...]=(str,int,float,complex,bool,bytes,type(None),frozenset,
+                           decimal.Decimal,datetime.date,datetime.time,datetime.timedelta,PurePath)
+"""変換せずにそのまま共有する値の型"""
+
+
+class Importer:
+    """他のRepositoryの値を、repoの値に変換します。
+
+    Tag、NodeType、Nodeなどの対応は表に記録して使い回します。
+    文字列などの変更できない値はコピーせずに共有し、リストと辞書は新しく作ります。
+    表は元のオブジェクトの同一性で引くので、元のRepositoryが変更されたら作り直してください。
+    """
+    repo:Repository
+    table:dict[int,tuple[Any,Any]]
+    """元のオブジェクトのidから、元のオブジェクトと変換後のオブジェクトへの表"""
+
+    def __init__(self,repo:Repository):
+        self.repo=repo
+        self.table={}
+
+    def __call__(self,obj:Any)->Any:
+        if isinstance(obj,IMMUTABLE):
+            return obj
+        entry=self.table.get(id(obj))
+        if entry is not None:
+            return entry[1]
+        if isinstance(obj,list):
+            return [self(x) for x in cast(list[Any],obj)]
+        elif isinstance(obj,tuple):
+            items=tuple(self(x) for x in cast(tuple[Any,...],obj))
+            return obj if all(a is b for a,b in zip(items,obj)) else items
+        elif isinstance(obj,Mapping):
+            return {self(k):self(x) for k,x in cast(Mapping[Any,Any],obj).items()}
+        ret=self._convert(obj)
+        self.table[id(obj)]=(obj,ret)
+        return ret
+
+    def _convert(self,obj:Any)->Any:
+        repo=self.repo
+        if isinstance(obj,Tag):
+            parent=obj.parent
+            if parent is not None:
+                parent=self(parent)
+            return repo.tag_or_create(obj.absname(),parent)
+        elif isinstance(obj,NodeType):
+            return repo.types[obj.name]
+        elif isinstance(obj,Property):
+            return self(obj.owner).properties[obj.name]
+        elif isinstance(obj,Node):
+            return repo.nodes[self(obj.type)][obj.name]
+        elif isinstance(obj,Service):
+            return repo.services[obj.name]
+        elif isinstance(obj,State):
+            return repo.states[obj.name]
+        else:
+            return copy.deepcopy(obj)
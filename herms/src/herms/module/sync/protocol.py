@@ -0,0 +1,321 @@
+"""
+ネットワーク越しに同期するためのプロトコルです。
+
+メッセージはJSONをzlibで圧縮し、先頭に4バイト(ビッグエンディアン)の長さをつけて送ります。
+1つの接続で、何回でも同期できます。同期は次の順に行われます。
+
+1. クライアントが ``{"op":"sync","since":ウォーターマーク,"condition":条件,"token":トークン}`` を送ります。
+   ウォーターマークがnullの場合は、すべてのNodeが対象になります。
+   サーバーにトークンが設定されている場合、異なるトークンを送ったクライアントの接続は閉じられます。
+2. サーバーは、条件に合い、ウォーターマークより後に変更されたNodeの
+   ``[type,name,fingerprint]`` を ``{"op":"digest","nodes":[...]}`` で :data:`BATCH_SIZE` ずつ送り、
+   最後に ``{"op":"digest-end","revision":リビジョン}`` を送ります。
+3. クライアントは、手元の内容とfingerprintが異なるNodeだけを ``{"op":"fetch","keys":[[type,name],...]}`` で要求します。
+4. サーバーはその設定を ``{"op":"nodes","nodes":[[type,name,doc],...]}`` で :data:`BATCH_SIZE` ずつ送り、
+   最後に ``{"op":"end"}`` を送ります。
+
+エラーの場合、サーバーは ``{"op":"error","message":...}`` を送ります。
+
+アドレスは ``tcp://HOST:PORT`` または ``unix://PATH`` の形式で指定します。
+HOSTを省略した場合はlocalhostで待ち受けます。localhost以外で待ち受けるには、トークンが必要です。
+トークンを指定しない場合は、環境変数 :data:`TOKEN_ENV` の値を使います。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import struct
+import zlib
+from collections.abc import Callable, Iterable
+from typing import TYPE_CHECKING, Any, cast
+from urllib.parse import urlsplit
+
+from herms import Query
+
+if TYPE_CHECKING:
+    from herms import Node, Repository
+    from herms.storage import NodeDocument, NodeKey
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+"""1つのメッセージに入れるNodeの数"""
+
+MAX_MESSAGE = 64 << 20
+"""メッセージの長さの上限(圧縮前と圧縮後のそれぞれ)"""
+
+SCHEMES = ("tcp", "unix")
+
+TOKEN_ENV = "HERMS_SYNC_TOKEN"
+"""トークンを指定しない場合に使う環境変数"""
+
+type Message = dict[str, Any]
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def is_remote(address: str) -> bool:
+    """addressがネットワーク越しの同期元を示すかどうかを返します。"""
+    return address.split("://", 1)[0] in SCHEMES and "://" in address
+
+
+async def send(writer: asyncio.StreamWriter, msg: Message) -> None:
+    data = zlib.compress(json.dumps(msg, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    writer.write(struct.pack(">I", len(data)) + data)
+    await writer.drain()
+
+
+async def receive(reader: asyncio.StreamReader) -> Message | None:
+    """メッセージを受け取ります。接続が閉じられた場合はNoneを返します。"""
+    try:
+        header = await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("Connection closed in the middle of a message.") from e
+    (size,) = struct.unpack(">I", header)
+    if size > MAX_MESSAGE:
+        raise ProtocolError(f"Message too large: {size} bytes.")
+    data = await reader.readexactly(size)
+    d = zlib.decompressobj()
+    try:
+        text = d.decompress(data, MAX_MESSAGE)
+    except zlib.error as e:
+        raise ProtocolError(f"Broken message: {e}") from e
+    if d.unconsumed_tail:
+        raise ProtocolError(f"Message too large: more than {MAX_MESSAGE} bytes after decompression.")
+    if not d.eof:
+        raise ProtocolError("Broken message: incomplete data.")
+    return cast(Message, json.loads(text))
+
+
+async def open_connection(address: str) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    url = urlsplit(address)
+    if url.scheme == "unix":
+        return await asyncio.open_unix_connection(url.path)
+    elif url.scheme == "tcp":
+        if url.hostname is None or url.port is None:
+            raise ValueError(f"{address}: Address must be tcp://HOST:PORT.")
+        return await asyncio.open_connection(url.hostname, url.port)
+    raise ValueError(f"{address}: Unknown scheme.")
+
+
+def _is_local(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class SyncServer:
+    """Repositoryの内容を、:class:`RemoteTarget` に送ります。"""
+    repo: Repository
+    token: str | None
+    """クライアントが送らなければならないトークン"""
+    server: asyncio.Server | None
+    sent: int
+    """送ったNodeの設定の数"""
+
+    def __init__(self, repo: Repository, token: str | None = None):
+        self.repo = repo
+        self.token = token or os.environ.get(TOKEN_ENV) or None
+        self.server = None
+        self.sent = 0
+
+    async def start(self, address: str) -> asyncio.Server:
+        """addressで接続の受け付けを開始します。
+
+        localhost以外で待ち受ける場合、:attr:`token` がなければ :class:`ValueError` になります。
+        """
+        url = urlsplit(address)
+        if url.scheme == "unix":
+            self.server = await asyncio.start_unix_server(self.handle, url.path)
+            os.chmod(url.path, 0o600)
+        elif url.scheme == "tcp":
+            host = url.hostname or "127.0.0.1"
+            if not _is_local(host) and self.token is None:
+                raise ValueError(f"{address}: A token is required to serve on a non-local address.")
+            self.server = await asyncio.start_server(self.handle, host, url.port)
+        else:
+            raise ValueError(f"{address}: Unknown scheme.")
+        return self.server
+
+    def addresses(self) -> list[str]:
+        """受け付けているアドレスを返します。"""
+        if self.server is None:
+            return []
+        ret: list[str] = []
+        for sock in self.server.sockets:
+            name = sock.getsockname()
+            if isinstance(name, str):
+                ret.append(f"unix://{name}")
+            else:
+                ret.append(f"tcp://{name[0]}:{name[1]}")
+        return ret
+
+    async def serve(self, address: str) -> None:
+        """addressで接続を受け付け続けます。"""
+        server = await self.start(address)
+        logger.info("serving %s on %s", self.repo.config_dir, ", ".join(self.addresses()))
+        async with server:
+            await server.serve_forever()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while (msg := await receive(reader)) is not None:
+                if self.token is not None and not hmac.compare_digest(str(msg.get("token", "")), self.token):
+                    logger.warning("rejected a sync request with an invalid token")
+                    await send(writer, {"op": "error", "message": "Invalid token."})
+                    break
+                try:
+                    if msg.get("op") != "sync":
+                        raise ProtocolError(f"Unexpected message: {msg.get('op')}")
+                    await self._sync(msg, reader, writer)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    logger.warning("sync request failed: %r", e)
+                    await send(writer, {"op": "error", "message": str(e)})
+        except (ConnectionError, ProtocolError, asyncio.IncompleteReadError) as e:
+            logger.debug("connection closed: %r", e)
+        finally:
+            writer.close()
+
+    def _changed(self, since: int | None) -> Iterable[Node]:
+        repo = self.repo
+        feed = repo.feed
+        keys = feed.load()
+        if keys:
+            # 他のプロセスが変更したNodeを読み込み直す
+            repo.reload_nodes(keys)
+        if since is None or since > feed.revision:
+            return repo.nodes.iterate()
+        types = repo.types
+        return (n for (t, name), _ in feed.since(since)
+                if t in types and (n := repo.nodes.find(types[t], name)) is not None)
+
+    async def _sync(self, msg: Message, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        repo = self.repo
+        # このプロセスで保存待ちの変更を書き込み、フィードに記録させる
+        await repo.flush()
+        since = cast(int | None, msg.get("since"))
+        exec = repo.query(Query(cast(str, msg.get("condition", "")), repo))
+        nodes = self._changed(since)
+        found = exec.items() if since is None else (x for x in nodes if exec.match(x))
+        revision = repo.feed.revision
+        for batch in itertools.batched(found, BATCH_SIZE):
+            await send(writer, {"op": "digest", "nodes": [[x.type.name, x.name, x.fingerprint().hex()] for x in batch]})
+        await send(writer, {"op": "digest-end", "revision": revision})
+        req = await receive(reader)
+        if req is None or req.get("op") != "fetch":
+            raise ProtocolError("Expected fetch.")
+        for keys in itertools.batched(cast(list[list[str]], req.get("keys", [])), BATCH_SIZE):
+            docs: list[list[Any]] = []
+            for t, name in keys:
+                type = repo.types.get(t)
+                node = repo.nodes.find(type, name) if type is not None else None
+                if node is not None:
+                    docs.append([t, name, node.dump()])
+            self.sent += len(docs)
+            await send(writer, {"op": "nodes", "nodes": docs})
+        await send(writer, {"op": "end"})
+
+
+class RemoteTarget:
+    """:class:`SyncServer` から同期するクライアントです。接続は使い回されます。"""
+    address: str
+    token: str | None
+    """サーバーに送るトークン"""
+    received: int
+    """受け取ったNodeの設定の数"""
+    _conn: tuple[asyncio.StreamReader, asyncio.StreamWriter] | None
+    _lock: asyncio.Lock | None
+
+    def __init__(self, address: str, token: str | None = None):
+        self.address = address
+        self.token = token or os.environ.get(TOKEN_ENV) or None
+        self.received = 0
+        self._conn = None
+        self._lock = None
+
+    async def _connection(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self._conn is not None and self._conn[1].is_closing():
+            self._conn = None
+        if self._conn is None:
+            self._conn = await open_connection(self.address)
+        return self._conn
+
+    async def pull(self, since: int | None, condition: str,
+                   fingerprint: Callable[[NodeKey], str | None]) -> tuple[int, list[NodeDocument]]:
+        """sinceより後に変更され、条件に合うNodeのうち、fingerprintが手元と異なるものの設定を受け取ります。
+
+        fingerprintは、手元のNodeのfingerprint(16進数)を返す関数です。
+        サーバーのリビジョンと、Nodeの設定を返します。
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            try:
+                return await self._pull(since, condition, fingerprint)
+            except BaseException:
+                await self.close()
+                raise
+
+    async def _pull(self, since: int | None, condition: str,
+                    fingerprint: Callable[[NodeKey], str | None]) -> tuple[int, list[NodeDocument]]:
+        reader, writer = await self._connection()
+        msg: Message = {"op": "sync", "since": since, "condition": condition}
+        if self.token is not None:
+            msg["token"] = self.token
+        await send(writer, msg)
+        keys: list[NodeKey] = []
+        while True:
+            msg = self._check(await receive(reader))
+            if msg["op"] == "digest-end":
+                revision = cast(int, msg["revision"])
+                break
+            for t, name, fp in msg["nodes"]:
+                if fingerprint((t, name)) != fp:
+                    keys.append((t, name))
+        await send(writer, {"op": "fetch", "keys": keys})
+        docs: list[NodeDocument] = []
+        while True:
+            msg = self._check(await receive(reader))
+            if msg["op"] == "end":
+                break
+            docs.extend((t, name, doc) for t, name, doc in msg["nodes"])
+        self.received += len(docs)
+        return revision, docs
+
+    def _check(self, msg: Message | None) -> Message:
+        if msg is None:
+            raise ProtocolError(f"{self.address}: Connection closed.")
+        if msg.get("op") == "error":
+            raise ProtocolError(f"{self.address}: {msg.get('message')}")
+        return msg
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            writer = self._conn[1]
+            self._conn = None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
@@ -1,11 +1,22 @@
 
 from __future__ import annotations
 
-import copy
+import asyncio
+import itertools
+import json
 import logging
-from typing import Any, Iterable, Required, TypedDict, cast
+import os
+import threading
+import time
+import weakref
+from collections.abc import Iterator, Sequence
+from typing import Any, ClassVar, Iterable, NamedTuple, Required, TypedDict, cast
 
-from herms import Repository, Service,Node, Json, JsonSchema,RepositoryConfig,Query,Tag,NodeType,State
+from herms import Repository, Service,Node, Json, JsonSchema,RepositoryConfig,Query
+from herms import job
+from herms.storage import NodeKey
+from .importer import Importer
+from .protocol import RemoteTarget, is_remote
 
 logger = logging.getLogger(__name__)
 
@@ -13,8 +24,39 @@ logger = logging.getLogger(__name__)
 class SyncServiceConfig(TypedDict,total=False):
     target:Required[str|RepositoryConfig]
     condition:str
+    token:str
+
+class SyncStats(NamedTuple):
+    """1回の同期の結果です。"""
+    nodes:int
+    """条件に合った同期元のNode"""
+    modified:int
+    """追加または変更したNode"""
+    conflicts:int
+    """他の同期元と衝突したNode"""
+    seconds:float
+
 
 class SyncService(Service):
+    """他のRepositoryのNodeを取り込みます。
+
+    前回同期したときの同期元のリビジョン(ウォーターマーク)を ``data_path()/watermark.json`` に記録し、
+    次回はそれ以降に変更されたNodeだけを調べます。
+    ``intensive`` を指定した場合や、ウォーターマークがない場合は、すべてのNodeを調べ直します。
+
+    ``condition`` は同期元のRepositoryに対して解釈され、同期元のインデックスを使って条件に合うNodeを探します。
+
+    同期元は :meth:`init` でスレッドを使って読み込まれるので、複数の同期元は並行に読み込まれます。
+    同期も同期元ごとに並行に行われます。同じ回の同期で、複数の同期元が同じNodeを異なる内容にしようとした場合は、
+    先に処理した同期元の内容を残し、衝突として :attr:`conflicts` に記録します。
+
+    ``target`` に ``tcp://HOST:PORT`` や ``unix://PATH`` を指定した場合は、``herms serve-sync`` で起動した
+    サーバーから :mod:`.protocol` で同期します。このとき、条件はサーバー側で解釈されます。
+    サーバーがトークンを求める場合は、``token`` に指定します。
+    """
+    WATERMARK_FILE="watermark.json"
+    BATCH_SIZE=500
+    """一度に処理するNodeの数。各バッチの間で他の処理に制御を渡します。"""
     CONFIG_SCHEMA={
         "type":"object",
         "properties":{
@@ -24,105 +66,290 @@ class SyncService(Service):
                     Repository.CONFIG_SCHEMA
                 ]
             },
-            "condition":{"type":"string"}
+            "condition":{"type":"string"},
+            "token":{"type":"string"}
         },
         "required":["target"]
     }
-    target:Repository
     condition:Query
+    """同期するNodeの条件。同期元のRepositoryで解釈されます。"""
+    conflicts:list[tuple[Node,str]]
+    """最後の同期で衝突したNodeと、先に同期した同期元のサービスの名前"""
+    stats:SyncStats|None
+    """最後の同期の結果"""
+    remote:RemoteTarget|None
+    """ネットワーク越しの同期元"""
+    _importers:dict[Repository,Importer]
+    _target:Repository|None
+    _target_config:Json
+    _condition:str
+    _lock:threading.Lock
+
+    _claims:ClassVar[weakref.WeakKeyDictionary[Repository,tuple[int,dict[Node,tuple[SyncService,bytes]]]]]=weakref.WeakKeyDictionary()
+    """同期先ごとの、処理の単位(:attr:`.Repository.cycle`)と、その中で各Nodeを同期した同期元とその内容"""
 
     def node_config_schema(self) -> JsonSchema:
         return {"type":"object"}
 
     def __init__(self):
         super().__init__()
+        self._importers={}
+        self._target=None
+        self._lock=threading.Lock()
+        self.conflicts=[]
+        self.stats=None
+        self.remote=None
 
     def configure(self, data: Json) -> None:
-        """設定を適用します。"""
+        """設定を適用します。同期元はまだ読み込みません。"""
         super().configure(data)
         cfg=cast(SyncServiceConfig,data)
-        target=Repository()
-        target.configure(cast(Json,cfg["target"]))
-        self.target=target
-        self.condition=Query(cfg.get("condition",""),self.owner)
+        self._target_config=cast(Json,cfg["target"])
+        self._condition=cfg.get("condition","")
+        self._target=None
+        target=cfg["target"]
+        self.remote=RemoteTarget(target,cfg.get("token")) if isinstance(target,str) and is_remote(target) else None
+
+    @property
+    def target(self)->Repository:
+        """同期元のRepository。:meth:`init` より前に参照された場合は、その場で読み込みます。"""
+        if self.remote is not None:
+            raise AttributeError(f"{self.name}: The target is remote ({self.remote.address}).")
+        return self._load_target()
+
+    def _load_target(self)->Repository:
+        with self._lock:
+            if self._target is None:
+                start=time.perf_counter()
+                target=Repository()
+                target.configure(self._target_config,read_only=True)
+                self.condition=Query(self._condition,target)
+                self._target=target
+                logger.info("%s: loaded %s in %.2fs",self.name,target.config_dir,time.perf_counter()-start)
+            return self._target
 
     async def init(self):
         """
         初期化をします。
 
-        起動時に1回呼ばれます。
+        起動時に1回呼ばれます。同期元をスレッドで読み込みます。
         """
-        await self.target.init()
+        if self.remote is not None:
+            return
+        target=await asyncio.to_thread(self._load_target)
+        await target.init()
 
     async def update(self, *nodes:Node,intensive:bool=False)->Iterable[Node]:
-        modified:set[Node]=set()
-        if not nodes:
-            condition=self.owner.query(self.condition)
-            newnodes:list[tuple[Node,Node]]=[]
-            for node in self.target.nodes.iterate():
-                if condition.match(node):
-                    mynode=self.owner.node(node.name,node.type)
-                    if mynode is None:
-                        mynode=Node(self._import(node.type,None))
-                        mynode.name=node.name
-                        self.owner.nodes.add(mynode)
-                        newnodes.append((node,mynode))
-                    else:
-                        if self._merge(node,mynode):
-                            modified.add(node)
-            for node,newnode in newnodes:
-                self.clone(node,newnode)
-            new_nodes=[x[1] for x in newnodes]
-            self.owner.init_nodes(*new_nodes)
-            modified.update(new_nodes)
+        self._importers.clear()
+        self.conflicts=[]
+        if self.remote is not None:
+            # ネットワーク越しの場合は、nodesを指定しても変更されたNodeをすべて受け取る
+            return await self._pull(intensive)
+        target=self.target
+        revision:int|None=None
+        changed:list[NodeKey]|None
+        if nodes:
+            # 指定されたNodeだけを同期する。ウォーターマークは変えない
+            changed=[(x.type.name,x.name) for x in nodes]
+        else:
+            feed=target.feed
+            feed.load()
+            revision=feed.revision
+            watermark=None if intensive else self.watermark()
+            if watermark is None or watermark>revision:
+                changed=None
+            else:
+                changed=[key for key,_ in feed.since(watermark)]
+        if changed is None:
+            batches=self.matching()
         else:
-            for node in nodes:
-                remotenode=self._import(node,self.target)
-                if self._merge(remotenode,node):
-                    modified.add(node)
+            target.reload_nodes(changed)
+            types=target.types
+            batches=self.matching(n for t,name in changed if t in types and (n:=target.nodes.find(types[t],name)) is not None)
+        start=time.perf_counter()
+        modified,count=await self._sync(batches)
+        if revision is not None:
+            self.save_watermark(revision)
+        self.stats=SyncStats(count,len(modified),len(self.conflicts),time.perf_counter()-start)
+        logger.info("%s: %d nodes matched, %d modified, %d conflicts in %.2fs",self.name,*self.stats)
+        return modified
+
+    async def _pull(self,intensive:bool)->set[Node]:
+        assert self.remote is not None
+        start=time.perf_counter()
+        owner=self.owner
+        def fingerprint(key:tuple[str,str])->str|None:
+            type=owner.types.get(key[0])
+            node=owner.nodes.find(type,key[1]) if type is not None else None
+            return node.fingerprint().hex() if node is not None else None
+        watermark=None if intensive else self.watermark()
+        revision,docs=await self.remote.pull(watermark,self._condition,fingerprint)
+        modified=set(owner.apply_documents(docs))
+        self.save_watermark(revision)
+        self.stats=SyncStats(len(docs),len(modified),0,time.perf_counter()-start)
+        logger.info("%s: %d nodes received, %d modified in %.2fs",self.name,len(docs),len(modified),self.stats.seconds)
         return modified
+
+    def matching(self,nodes:Iterable[Node]|None=None)->Iterator[Sequence[Node]]:
+        """同期元のNodeのうち、条件に合うものを :attr:`BATCH_SIZE` ずつ返します。
+
+        nodesを指定しない場合は、同期元のクエリで条件に合うNodeだけを取り出します。
+        nodesを指定した場合は、その中から条件に合うものを選びます。
+        """
+        exec=self.target.query(self.condition)
+        if nodes is None:
+            found:Iterable[Node]=exec.items()
+        else:
+            found=(x for x in nodes if exec.match(x))
+        return itertools.batched(found,self.BATCH_SIZE)
+
+    def _claim(self,node:Node,remote:Node)->bool:
+        """このサービスがnodeを同期することを記録します。
+
+        同じ回にすでに他の同期元が同期している場合はFalseを返します。内容が異なる場合は衝突として記録します。
+        """
+        owner=self.owner
+        cycle,claims=self._claims.get(owner,(None,{}))
+        if cycle!=owner.cycle:
+            claims={}
+            self._claims[owner]=(owner.cycle,claims)
+        fingerprint=remote.fingerprint()
+        other=claims.get(node)
+        if other is None:
+            claims[node]=(self,fingerprint)
+            return True
+        service,theirs=other
+        if service is self:
+            return True
+        if theirs==fingerprint:
+            # 同じ内容で、他の同期元が同期する(作成したNodeはまだ複製していないことがある)
+            return False
+        logger.warning("%s: %s was already synchronized by %s",self.name,node.name,service.name)
+        self.conflicts.append((node,service.name))
+        return False
+
+    async def _sync(self,batches:Iterable[Sequence[Node]])->tuple[set[Node],int]:
+        # 参照先が後のバッチにあってもよいように、先にNodeをすべて作る
+        pairs:list[tuple[Node,Node,bool]]=[]
+        count=0
+        for batch in batches:
+            for node in batch:
+                count+=1
+                type=self._import(node.type,None)
+                mynode=self.owner.nodes.find(type,node.name)
+                new=mynode is None
+                if mynode is None:
+                    mynode=Node(type)
+                    mynode.name=node.name
+                if not self._claim(mynode,node):
+                    if new:
+                        type.store.release(mynode.id)
+                    continue
+                if new:
+                    self.owner.add_node(mynode)
+                pairs.append((node,mynode,new))
+            await asyncio.sleep(0)
+        modified:set[Node]=set()
+        current=job.current()
+        done=0
+        for chunk in itertools.batched(pairs,self.BATCH_SIZE):
+            for node,mynode,new in chunk:
+                if new:
+                    self.clone(node,mynode,link=False)
+                elif self._merge(node,mynode):
+                    modified.add(mynode)
+            done+=len(chunk)
+            if current is not None:
+                current.report(done/len(pairs),f"{done}/{len(pairs)} nodes")
+            await asyncio.sleep(0)
+        new_nodes=[mynode for _,mynode,new in pairs if new]
+        self.owner.link_nodes(*new_nodes)
+        self.owner.init_nodes(*new_nodes)
+        modified.update(new_nodes)
+        return modified,count
+
+    def watermark(self)->int|None:
+        """前回同期したときの同期元のリビジョンを返します。"""
+        try:
+            data=json.loads((self.data_path() / self.WATERMARK_FILE).read_text(encoding="utf-8"))
+            return int(data["revision"])
+        except (OSError,ValueError,KeyError,TypeError):
+            return None
+
+    def save_watermark(self,revision:int)->None:
+        dir=self.data_path()
+        dir.mkdir(parents=True,exist_ok=True)
+        tmp=dir / f".{self.WATERMARK_FILE}.tmp"
+        tmp.write_text(json.dumps({"revision":revision}),encoding="utf-8")
+        os.replace(tmp,dir / self.WATERMARK_FILE)
     async def close(self):
-        await self.target.close()
+        if self.remote is not None:
+            await self.remote.close()
+        if self._target is not None:
+            await self._target.close()
         await super().close()
 
-    def _merge(self,remote:Node,local:Node):
-        pass
+    def _merge(self,remote:Node,local:Node)->bool:
+        """remoteの内容をlocalに反映します。内容が同じ場合は何もしません。
 
-    def _import(self,obj:Any,repo:Repository|None)->Any:
+        変更された値だけを設定し直します。localを変更した場合はTrueを返します。
+        """
+        if remote.fingerprint()==local.fingerprint():
+            return False
+        repo=local.owner
+        before=local.fingerprint()
+        if local.description!=remote.description:
+            local.description=remote.description
+        state=self._import(remote.state,repo)
+        if local.state!=state:
+            local.state=state
+        remote_props=remote.type.properties
+        for name,prop in local.type.properties.items():
+            rprop=remote_props.get(name)
+            if rprop is None:
+                continue
+            val=self._import(remote.properties.get(rprop,[] if rprop.list else None),repo)
+            if local.properties.get(prop,[] if prop.list else None)!=val:
+                local.set_prop(prop,val)
+        local.set_tags([self._import(t,repo) for t in remote.tags])
+        for service,config in remote.service_configs.items():
+            myservice=repo.services.get(service.name)
+            if myservice is not None and local.service_configs.get(myservice)!=config:
+                local.set_service_config(myservice,self._import(config,repo))
+        return local.fingerprint()!=before
+
+    def importer(self,repo:Repository|None=None)->Importer:
+        """repoへの :class:`.Importer` を返します。同じ :meth:`update` の間は使い回されます。"""
         if repo is None:
             repo=self.owner
-        if isinstance(obj,Tag):
-            tag=obj
-            parent=tag.parent
-            if parent is not None:
-                parent=self._import(parent,repo)
-            return repo.tag_or_create(tag.absname(),parent)
-        elif isinstance(obj,NodeType):
-            return repo.types[obj.name]
-        elif isinstance(obj,Node):
-            return repo.nodes[self._import(obj.type,repo)][obj.name]
-        elif isinstance(obj,Service):
-            return repo.services[obj.name]
-        elif isinstance(obj,State):
-            return repo.states[obj.name]
-        elif isinstance(obj,list):
-            return [self._import(x,repo) for x in cast(list[Any],obj)]
-        elif isinstance(obj,dict):
-            return {self._import(k,repo):self._import(x,repo) for k,x in cast(dict[Any,Any],obj).items()}
-        else:
-            return copy.deepcopy(obj)
+        ret=self._importers.get(repo)
+        if ret is None:
+            ret=Importer(repo)
+            self._importers[repo]=ret
+        return ret
 
-    def clone(self,src:Node,dest:Node):
+    def _import(self,obj:Any,repo:Repository|None)->Any:
+        return self.importer(repo)(obj)
+
+    def clone(self,src:Node,dest:Node,link:bool=True):
+        """srcの内容をdestに複製します。
+
+        参照の逆引きは :meth:`.Repository.link_nodes` で登録します。
+        linkがFalseの場合は、呼び出し側でまとめて登録する必要があります。
+        """
         repo=dest.owner
+        imp=self.importer(repo)
         dest.description=src.description
-        dest.state=self._import(src.state,repo)
-        dest.tags=[self._import(t,repo) for t in src.tags]
+        dest.state=imp(src.state)
+        dest.tags=[imp(t) for t in src.tags]
         service_configs={}
         for service,config in src.service_configs.items():
             myservice=repo.services.get(service.name)
             if myservice is not None:
-                service_configs[myservice]=self._import(config,repo)
+                service_configs[myservice]=imp(config)
         dest.service_configs=service_configs
-        dest.properties=self._import(src.properties,repo)
-        dest.properties_rev=self._import(src.properties_rev,repo)
+        dest.unlink()
+        dest.properties=imp(src.properties)
+        if link:
+            repo.link_nodes(dest)
 
@@ -0,0 +1,340 @@
+"""
+ディレクトリをまとめて移動します。
+
+:class:`MovePlan` は、移動元と移動先の組から、移動の順序を決めます。
+
+* 移動先が重なる場合や、移動先に移動しないファイルがある場合は :class:`MoveError` になります。
+* 親ディレクトリの移動に含まれる移動は省きます。
+* 移動先が他の移動の移動元である場合は、その移動の後に行います。
+  循環している場合は、一時的な名前を経由します。
+
+:class:`Mover` は、互いに依存しない移動をスレッドプールで並行して実行します。
+別のデバイスへの移動は、コピーしてから削除します。
+進み具合は ``data_dir/moves.jsonl`` に記録され、中断した場合は :meth:`Mover.resume` で続きから実行できます。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import errno
+import json
+import logging
+import os
+import shutil
+import threading
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, NamedTuple, cast
+
+logger = logging.getLogger(__name__)
+
+TEMP_SUFFIX = ".herms-move"
+"""循環する移動で経由する一時的な名前の接尾辞"""
+COPY_SUFFIX = ".herms-copy"
+"""別のデバイスへコピーしている途中の名前の接尾辞"""
+
+
+class MoveError(Exception):
+    pass
+
+
+class Move(NamedTuple):
+    src: Path
+    dest: Path
+
+
+def _exists(path: Path) -> bool:
+    return path.exists() or path.is_symlink()
+
+
+class MovePlan:
+    """移動の計画です。"""
+    moves: list[Move]
+    deps: list[set[int]]
+    """各移動の前に終わっていなければならない移動"""
+    _parents: list[int | None]
+    """移動元を含むディレクトリの移動"""
+
+    def __init__(self, moves: Iterable[tuple[Path, Path]] = ()):
+        self.moves = []
+        self.deps = []
+        self._parents = []
+        self._plan({Path(s): Path(d) for s, d in moves if Path(s) != Path(d)})
+
+    @classmethod
+    def load(cls, moves: list[Move], deps: list[set[int]]) -> MovePlan:
+        """記録された計画を復元します。"""
+        ret = cls()
+        ret.moves = moves
+        ret.deps = deps
+        ret._parents = [None] * len(moves)
+        return ret
+
+    def __len__(self) -> int:
+        return len(self.moves)
+
+    def __bool__(self) -> bool:
+        return bool(self.moves)
+
+    def _plan(self, moves: dict[Path, Path]) -> None:
+        dests: set[Path] = set()
+        for dest in moves.values():
+            if dest in dests:
+                raise MoveError(f"{dest}: Multiple directories move to the same path.")
+            dests.add(dest)
+        # 親ディレクトリから順に調べ、親の移動に含まれる移動は、親の移動先からの移動にする
+        origins: dict[Path, int] = {}
+        for orig in sorted(moves, key=lambda x: len(x.parts)):
+            src = orig
+            dest = moves[orig]
+            if dest.is_relative_to(src):
+                raise MoveError(f"{src}: Cannot move a directory into itself.")
+            base = next((x for x in orig.parents if x in origins), None)
+            parent = None
+            if base is not None:
+                parent = origins[base]
+                src = self.moves[parent].dest / orig.relative_to(base)
+                if src == dest:
+                    continue
+            origins[orig] = len(self.moves)
+            self.moves.append(Move(src, dest))
+            self._parents.append(parent)
+        for _ in range(len(self.moves) + 1):
+            if not self._resolve():
+                return
+        raise MoveError("Cannot order the moves.")
+
+    def _resolve(self) -> bool:
+        """依存関係を求めます。循環があれば1つを一時的な名前で分けて、Trueを返します。"""
+        srcs = {m.src: i for i, m in enumerate(self.moves)}
+        dests = {m.dest: i for i, m in enumerate(self.moves)}
+        self.deps = []
+        for i, (src, dest) in enumerate(self.moves):
+            deps: set[int] = set()
+            parent = self._parents[i]
+            if parent is not None:
+                deps.add(parent)
+            vacated = False
+            for x in (dest, *dest.parents):
+                j = srcs.get(x)
+                if j is not None and j != i and self._parents[j] != i:
+                    # 移動先か、それを含むディレクトリが空くのを待つ
+                    deps.add(j)
+                    vacated = True
+            for x in dest.parents:
+                j = dests.get(x)
+                if j is not None:
+                    # 移動先を含むディレクトリが移動してくるのを待つ
+                    deps.add(j)
+                    if not vacated and _exists(self.moves[j].src / dest.relative_to(x)):
+                        raise MoveError(f"{dest}: Already exists.")
+            if not vacated and _exists(dest):
+                raise MoveError(f"{dest}: Already exists.")
+            self.deps.append(deps)
+        cycle = self._cycle()
+        if cycle is None:
+            return False
+        # 移動先が空くのを待っている移動を選び、一時的な名前に移動してから移動先に移動する
+        split = next((x for x, y in zip(cycle, cycle[1:] + cycle[:1]) if self._parents[x] != y), None)
+        if split is None:
+            # 親ディレクトリの移動だけで循環している
+            raise MoveError(f"{self.moves[cycle[0]].src}: Cannot order the moves.")
+        src, dest = self.moves[split]
+        tmp = src.with_name(f".{src.name}{TEMP_SUFFIX}")
+        self.moves[split] = Move(tmp, dest)
+        self.moves.append(Move(src, tmp))
+        self._parents.append(self._parents[split])
+        self._parents[split] = len(self.moves) - 1
+        return True
+
+    def _cycle(self) -> list[int] | None:
+        """循環している移動を、依存する順に返します。"""
+        state = [0] * len(self.moves)  # 0:未訪問 1:訪問中 2:完了
+        for start in range(len(self.moves)):
+            if state[start]:
+                continue
+            stack = [(start, iter(self.deps[start]))]
+            state[start] = 1
+            while stack:
+                i, it = stack[-1]
+                j = next(it, None)
+                if j is None:
+                    state[i] = 2
+                    stack.pop()
+                elif state[j] == 1:
+                    path = [x for x, _ in stack]
+                    return path[path.index(j):]
+                elif state[j] == 0:
+                    state[j] = 1
+                    stack.append((j, iter(self.deps[j])))
+        return None
+
+    def order(self) -> list[int]:
+        """依存する移動が先になる順に、移動の番号を返します。"""
+        ret: list[int] = []
+        done: set[int] = set()
+
+        def visit(i: int) -> None:
+            stack = [(i, iter(self.deps[i]))]
+            while stack:
+                k, it = stack[-1]
+                j = next(it, None)
+                if j is None:
+                    stack.pop()
+                    if k not in done:
+                        done.add(k)
+                        ret.append(k)
+                elif j not in done:
+                    stack.append((j, iter(self.deps[j])))
+
+        for i in range(len(self.moves)):
+            visit(i)
+        return ret
+
+
+class Mover:
+    """:class:`MovePlan` を実行します。"""
+    FILE = "moves.jsonl"
+
+    path: Path
+    """ジャーナルのパス"""
+    workers: int | None
+    _lock: threading.Lock
+
+    def __init__(self, path: Path, workers: int | None = None):
+        self.path = path
+        self.workers = workers
+        self._lock = threading.Lock()
+
+    async def run(self, plan: MovePlan) -> None:
+        """planを実行します。
+
+        前回の移動が終わっていない場合は :class:`MoveError` になります。先に :meth:`resume` を呼んでください。
+        """
+        if not plan:
+            return
+        if self.path.exists():
+            raise MoveError(f"{self.path}: An interrupted move remains. Resume it first.")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        header = {"moves": [[str(s), str(d)] for s, d in plan.moves], "deps": [sorted(x) for x in plan.deps]}
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        tmp.write_text(self._dump(header), encoding="utf-8")
+        os.replace(tmp, self.path)
+        await self._execute(plan, set(), set())
+
+    async def resume(self) -> MovePlan | None:
+        """中断した移動の続きを実行します。中断した移動がなければNoneを返します。
+
+        失敗した場合、ジャーナルは残ります。原因を取り除いてからもう一度呼ぶか、:meth:`abort` してください。
+        """
+        loaded = self._load()
+        if loaded is None:
+            return None
+        plan, done, copied = loaded
+        logger.info("resuming %d of %d moves", len(plan) - len(done), len(plan))
+        await self._execute(plan, done, copied)
+        return plan
+
+    def abort(self) -> MovePlan | None:
+        """中断した移動を取りやめます。中断した移動がなければNoneを返します。
+
+        終わっていない移動は行わず、ジャーナルを削除します。移動し終わったディレクトリは戻しません。
+        """
+        loaded = self._load()
+        if loaded is None:
+            return None
+        plan, done, _ = loaded
+        self.path.unlink()
+        logger.warning("aborted %d of %d moves", len(plan) - len(done), len(plan))
+        return plan
+
+    def _load(self) -> tuple[MovePlan, set[int], set[int]] | None:
+        try:
+            lines = self.path.read_text(encoding="utf-8").splitlines()
+        except FileNotFoundError:
+            return None
+        header = cast(dict[str, Any], json.loads(lines[0]))
+        plan = MovePlan.load([Move(Path(s), Path(d)) for s, d in header["moves"]],
+                             [set(x) for x in header["deps"]])
+        done: set[int] = set()
+        copied: set[int] = set()
+        for line in lines[1:]:
+            try:
+                r = cast(dict[str, int], json.loads(line))
+            except json.JSONDecodeError:
+                continue  # 書き込み中に中断した
+            if "done" in r:
+                done.add(r["done"])
+            elif "copied" in r:
+                copied.add(r["copied"])
+        return plan, done, copied
+
+    async def _execute(self, plan: MovePlan, done: set[int], copied: set[int]) -> None:
+        loop = asyncio.get_running_loop()
+        tasks: dict[int, asyncio.Future[None]] = {}
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="herms-move") as pool:
+            async def run(i: int) -> None:
+                if plan.deps[i]:
+                    await asyncio.gather(*(tasks[j] for j in plan.deps[i]))
+                if i not in done:
+                    await loop.run_in_executor(pool, self._move, i, plan.moves[i], i in copied)
+
+            for i in plan.order():
+                tasks[i] = asyncio.ensure_future(run(i))
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        errors = [x for x in results if isinstance(x, BaseException)]
+        if errors:
+            # 依存する移動の失敗は、同じ例外が繰り返されるので最初のものを投げる
+            raise errors[0]
+        self.path.unlink()
+
+    def _move(self, i: int, move: Move, copied: bool) -> None:
+        src, dest = move
+        if copied:
+            # コピーは終わっていて、移動元の削除が終わっていない
+            self._remove(src)
+        elif not _exists(src):
+            if not _exists(dest):
+                raise MoveError(f"{src}: Not found.")
+            # 記録する前に中断した
+        else:
+            if _exists(dest):
+                raise MoveError(f"{dest}: Already exists.")
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.rename(src, dest)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                self._copy(i, src, dest)
+        self._write({"done": i})
+
+    def _copy(self, i: int, src: Path, dest: Path) -> None:
+        tmp = dest.with_name(f".{dest.name}{COPY_SUFFIX}")
+        self._remove(tmp)
+        if src.is_dir() and not src.is_symlink():
+            shutil.copytree(src, tmp, symlinks=True)
+        else:
+            shutil.copy2(src, tmp, follow_symlinks=False)
+        os.rename(tmp, dest)
+        self._write({"copied": i})
+        self._remove(src)
+
+    @staticmethod
+    def _remove(path: Path) -> None:
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        elif _exists(path):
+            path.unlink()
+
+    @staticmethod
+    def _dump(record: dict[str, Any]) -> str:
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def _write(self, record: dict[str, Any]) -> None:
+        with self._lock:
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(self._dump(record))
+                f.flush()
+                os.fsync(f.fileno())
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from collections import defaultdict
+import hashlib
+import json
+from collections.abc import Mapping
 from typing import TYPE_CHECKING, Any, NotRequired, TypedDict, cast
 from pathlib import Path
 import jsonschema
@@ -9,11 +11,13 @@ from . import datatype,merge
 from .tag import Tag
 from .config import Json, JsonObject
 from .base import InRepository
+from .columns import PropertyView
 from .nodetype import NodeType,Property
 
 if TYPE_CHECKING:
     from .service import Service
     from .state import State
+    from .transition import Field
 
 class NodeConfig(TypedDict):
     description:NotRequired[str]
@@ -34,38 +38,149 @@ class Node(InRepository):
         },
         "required":["state"]
     }
+    __slots__=("type","id","_properties","tags","service_configs",
+               "node_path","node_service_path","dirty","_state","_description","_fingerprint","__weakref__")
     type: NodeType
     """ノードの種類"""
 
-    state:State
+    id: int
+    """:attr:`.NodeType.store` の中での行番号"""
 
-    properties: dict[Property, Any]
-    """ノードのプロパティ"""
-    properties_rev:dict[Property,set[Node]]
+    _properties: PropertyView
     tags:list[Tag]
     service_configs: dict[Service, Any]
 
     node_path: Path
     node_service_path: dict[Service,Path]
 
+    dirty: bool
+    """保存されていない変更があるかどうか"""
+
+    _state: State
+    _description: str
+    _fingerprint: bytes|None
+
     def __init__(self, type: NodeType):
         self.type = type
-        self.properties = {}
-        self.properties_rev = defaultdict(set)
+        self.id = type.store.alloc(self)
+        self._properties = PropertyView(type.store,self.id)
         self.service_configs = {}
         self.tags=[]
         self.node_service_path={}
+        self._description=""
+        self._fingerprint=None
+        self.dirty=True
+
+    @property
+    def properties(self)->PropertyView:
+        """ノードのプロパティ
+
+        値は :attr:`.NodeType.store` に格納されています。
+        """
+        return self._properties
+
+    @properties.setter
+    def properties(self,properties:Mapping[Property,Any])->None:
+        self._touch()
+        self._properties.clear()
+        self._properties.update(properties)
+        self._changed(None)
+
+    @property
+    def state(self)->State:
+        return self._state
+
+    @state.setter
+    def state(self,state:State)->None:
+        self._touch()
+        self._state=state
+        self._changed("state")
+
+    @property
+    def description(self)->str:  # type: ignore[override]
+        return self._description
+
+    @description.setter
+    def description(self,description:str)->None:
+        self._touch()
+        self._description=description
+        self._changed("description")
+
+    def _touch(self)->None:
+        """内容が変更される直前に呼ばれます。"""
+        owner=getattr(self,"owner",None)
+        if owner is not None:
+            owner.before_change(self)
+
+    def _changed(self,field:Field|None)->None:
+        """内容が変更されたとき呼ばれます。
+
+        fieldは変更された値です。Noneはすべての値が変更されたことを示します。
+        """
+        self.dirty=True
+        self._fingerprint=None
+        owner=getattr(self,"owner",None)
+        if owner is not None:
+            owner.track(self,field)
+
+    def fingerprint(self)->bytes:
+        """内容(状態、タグ、プロパティ、説明、サービスの設定)のハッシュを返します。
+
+        内容が同じなら、別のRepositoryのNodeでも同じ値になります。値は変更されるまでキャッシュされます。
+        """
+        if self._fingerprint is None:
+            data=json.dumps(self.dump(),sort_keys=True,ensure_ascii=False,separators=(",",":"),default=str)
+            self._fingerprint=hashlib.blake2b(data.encode("utf-8"),digest_size=16).digest()
+        return self._fingerprint
 
-    def configure(self, data: JsonObject) -> None:
-        """ノードを設定します。"""
+    def referrers(self,prop:Property)->list[Node]:
+        """このNodeをpropで参照しているNodeを返します。"""
+        return self.owner.refs.sources(prop,self)
+
+    def add_tag(self,tag:Tag)->None:
+        """タグを追加します。"""
+        if tag not in self.tags:
+            self._touch()
+            self.tags.append(tag)
+            self._changed("tags")
+
+    def set_tags(self,tags:list[Tag])->None:
+        """タグを置き換えます。"""
+        if tags!=self.tags:
+            self._touch()
+            self.tags[:]=tags
+            self._changed("tags")
+
+    def set_service_config(self,service:Service,config:Any)->None:
+        """サービスの設定を変更します。"""
+        self._touch()
+        self.service_configs[service]=config
+        self._changed("services")
+
+    def remove_tag(self,tag:Tag)->None:
+        """タグを削除します。"""
+        if tag in self.tags:
+            self._touch()
+            self.tags.remove(tag)
+            self._changed("tags")
+
+    def configure(self, data: JsonObject, resolver:datatype.ReferenceResolver|None=None) -> None:
+        """ノードを設定します。
+
+        resolverを指定した場合、参照はresolverで解決済みの値を使います。
+        このとき、:attr:`.Repository.refs` は更新されません。
+        呼び出し側で :meth:`.Repository.link_nodes` を呼ぶ必要があります。
+        """
         config=cast(NodeConfig,data)
         self.description=config.get("description","")
         self.state=self.owner.states[config.get("state","")]
         tags=config.get("tags",[])
         self.tags.clear()
         for name in tags:
-            tag=self.owner.tag_or_create(name,None)
-            self.tags.append(tag)
+            if resolver is None:
+                self.add_tag(self.owner.tag_or_create(name,None))
+            else:
+                self.add_tag(resolver.node_tag(name))
         props=config.get("properties",{})
         for name, prop in self.type.properties.items():
             cfg = props.get(name, None)
@@ -73,15 +188,34 @@ class Node(InRepository):
                 if cfg is None:
                     val=[]
                 else:
-                    val=[datatype.decode(x,prop.type,self.owner,True) for x in cfg]
+                    val=[self._decode(x,prop,resolver) for x in cfg]
             else:
-                val=datatype.decode(cfg,prop.type,self.owner,True)
-            self.set_prop(prop,prop.validate(val))
+                val=self._decode(cfg,prop,resolver)
+            val=prop.validate(val)
+            if resolver is None:
+                self.set_prop(prop,val)
+            else:
+                self.properties[prop]=val
+                if prop.is_tag() and val is not None:
+                    for tag in val if prop.list else [val]:
+                        self.add_tag(tag)
 
         service_configs=config.get("services",{})
         for name, service in self.owner.services.items():
-            cfg = service_configs.get(name, {})
-            self.service_configs[service] = jsonschema.validate(cfg,service.node_config_schema())
+            cfg = service_configs.get(name)
+            jsonschema.validate(cfg if cfg is not None else {},service.node_config_schema())
+            self.service_configs[service] = cfg
+        self._fingerprint=None
+
+    def _decode(self,val:Json,prop:Property,resolver:datatype.ReferenceResolver|None)->Any:
+        if val is None:
+            return None
+        if resolver is not None:
+            if prop.is_node():
+                return resolver.node(cast(str,val),prop.type)
+            elif prop.is_tag():
+                return resolver.tag(cast(str,val))
+        return prop.converter.decode(val,prop.type,self.owner,True)
 
     def dump(self)-> Json:
         """ノードの状態を設定オブジェクトにします。"""
@@ -105,38 +239,58 @@ class Node(InRepository):
         return ret
 
     def set_prop(self,prop:Property,val:Any)->None:
+        self._touch()
         if prop.is_node():
+            refs=self.owner.refs
+            rev=(True,prop)
+            def _discard(x:Node)->None:
+                refs.discard(prop,x,self)
+                self.owner.track(x,rev)
+            def _add(x:Node)->None:
+                refs.add(prop,x,self)
+                self.owner.track(x,rev)
             if prop.list:
                 oldnodes=cast(list[Node],self.properties.get(prop,[]))
                 nodes=cast(list[Node],val)
-                merge.modify_list(oldnodes,nodes,
-                                 lambda x:x.properties_rev[prop].remove(self),
-                                 lambda x:x.properties_rev[prop].add(self))
+                merge.modify_list(oldnodes,nodes,_discard,_add)
+                self.properties[prop]=nodes
             else:
                 oldnode=cast(Node|None,self.properties.get(prop))
-                node=cast(Node,val)
+                node=cast(Node|None,val)
                 if oldnode is not None:
-                    oldnode.properties_rev[prop].remove(self)
+                    _discard(oldnode)
                 self.properties[prop]=node
-                node.properties_rev[prop].add(self)
+                if node is not None:
+                    _add(node)
         elif prop.is_tag():
             if prop.list:
                 oldval=cast(list[Tag],self.properties.get(prop,[]))
                 newval=cast(list[Tag],val)
                 merge.modify_list(oldval,newval,
-                                 lambda x:self.tags.remove(x),
-                                 lambda x:self.tags.append(x))
-            else:
-                oldval=cast(Tag|None,self.properties.get(prop))
-                newval=cast(Tag,val)
-                if oldval is not None:
-                    self.tags.remove(oldval)
+                                 lambda x:self.remove_tag(x),
+                                 lambda x:self.add_tag(x))
                 self.properties[prop]=newval
-                self.tags.append(newval)
+            else:
+                oldtag=cast(Tag|None,self.properties.get(prop))
+                newtag=cast(Tag|None,val)
+                if oldtag is not None:
+                    self.remove_tag(oldtag)
+                self.properties[prop]=newtag
+                if newtag is not None:
+                    self.add_tag(newtag)
         else:
             self.properties[prop]=val
+        self._changed(prop)
+
+    def unlink(self)->None:
+        """他のNodeへの参照をすべて解除します。"""
+        for prop in self.type.properties.values():
+            if prop.is_node() and prop in self.properties:
+                self.set_prop(prop,[] if prop.list else None)
 
     def dump_prop(self,prop:Property,val:Any)->Json:
+        if val is None:
+            return None
         if prop.is_node():
             if prop.list:
                 return [x.name for x in cast(list[Node],val)]
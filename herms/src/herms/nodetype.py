@@ -4,8 +4,9 @@ from __future__ import annotations
 from collections.abc import Iterable
 from typing import TYPE_CHECKING, Any, ClassVar, TypedDict, cast
 
-from .datatype import DataType, schema_of, to_type
+from .datatype import DataType, DataTypeConverter, converter_of, schema_of, to_type
 from .base import InRepository, OwnedBy, OwnedDict
+from .columns import NodeStore
 from .tag import Tag
 
 if TYPE_CHECKING:
@@ -18,12 +19,17 @@ class PropertyConfig(TypedDict,total=False):
     default:Any
 
 class Property(OwnedBy["NodeType"]):
-    parent: NodeType
+    __slots__=("type","required","list","default","converter")
     name: str
     type: DataType
     required: bool
     list: bool
-    default: Any = None
+    default: Any
+    converter: DataTypeConverter
+    """値の変換器"""
+
+    def __init__(self):
+        self.default=None
 
     #
     # Accessors
@@ -115,17 +121,17 @@ class NodeType(InRepository):
     #
     base: NodeType | None = None
     properties: OwnedDict[Property,NodeType]
+    store: NodeStore
+    """このNodeTypeのNodeのプロパティの値"""
     
     #
     # Accessor
     #
     def ancestors(self)->Iterable[NodeType]:
-        t=self
-        while True:
+        t:NodeType|None=self
+        while t is not None:
             yield t
-            t=self.base
-            if t is None:
-                break
+            t=t.base
 
 
     #
@@ -133,6 +139,7 @@ class NodeType(InRepository):
     #
     def __init__(self):
         self.properties = OwnedDict(self)
+        self.store = NodeStore()
 
     def configure(self, data: Json) -> None:
         """ノードタイプを設定します。"""
@@ -151,9 +158,12 @@ class NodeType(InRepository):
             list:bool=False
             default=None
             if isinstance(cfg, str):
-                type = cfg
+                type = to_type(cfg,self.owner)
             else:
-                type = to_type(cfg.get("type", type),self.owner)
+                typename=cfg.get("type")
+                if typename is not None and not isinstance(typename,str):
+                    raise ValueError(f"{name}: Property type must be a type name.")
+                type = to_type(typename,self.owner)
                 required = cfg.get("required", required)
                 default=cfg.get("default",default)
                 list=cfg.get("list",list)
@@ -163,4 +173,6 @@ class NodeType(InRepository):
             prop.required = required
             prop.list=list
             prop.default=default
+            prop.converter=converter_of(type)
             self.properties[name] = prop
+            self.store.add_column(prop)
@@ -0,0 +1,86 @@
+"""
+CPU負荷の高い処理を、別のプロセスで実行します。
+
+サービスはイベントループの中で実行されるので、ハッシュの計算や解析などの重い処理をすると、
+その間ほかのサービスが止まってしまいます。:class:`ProcessPool` はそのような処理を
+:class:`~concurrent.futures.ProcessPoolExecutor` で実行し、結果をイベントループに返します。
+
+Nodeそのものはプロセス間で受け渡せないので、:meth:`.Node.dump` の結果を :class:`NodeData` にして渡します。
+実行する関数は、モジュールのトップレベルで定義された、pickleできるものでなければなりません。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+from collections.abc import Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Any, NamedTuple, cast
+
+if TYPE_CHECKING:
+    from .config import JsonObject
+    from .node import Node
+
+DEFAULT_CHUNK_SIZE=64
+"""1回にプロセスへ送るNodeの数の既定値"""
+
+
+class NodeData(NamedTuple):
+    """プロセスに渡すNodeの内容です。"""
+    type:str
+    name:str
+    doc:JsonObject
+    """:meth:`.Node.dump` の結果"""
+
+    @classmethod
+    def of(cls,node:Node)->NodeData:
+        return cls(node.type.name,node.name,cast("JsonObject",node.dump()))
+
+
+def _apply[R](func:Callable[[NodeData],R],chunk:list[NodeData])->list[R]:
+    return [func(x) for x in chunk]
+
+
+class ProcessPool:
+    """サービスが共有するプロセスプールです。
+
+    プロセスは最初に使われたときに起動します。
+    """
+    workers:int|None
+    """プロセスの数。Noneの場合はCPUの数"""
+    chunksize:int
+    _executor:ProcessPoolExecutor|None
+
+    def __init__(self,workers:int|None=None,chunksize:int=DEFAULT_CHUNK_SIZE):
+        self.workers=workers
+        self.chunksize=chunksize
+        self._executor=None
+
+    def executor(self)->ProcessPoolExecutor:
+        if self._executor is None:
+            # 書き込みのスレッドがあるので、forkは使わない
+            self._executor=ProcessPoolExecutor(self.workers,mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def call[R](self,func:Callable[...,R],*args:Any)->R:
+        """funcを別のプロセスで実行し、結果を返します。"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor(),func,*args)
+
+    async def map_nodes[R](self,func:Callable[[NodeData],R],nodes:Iterable[Node],chunksize:int|None=None)->list[R]:
+        """各Nodeについてfuncを別のプロセスで実行し、結果をNodeの順に返します。
+
+        Nodeはchunksizeずつまとめてプロセスに送られます。
+        """
+        size=chunksize or self.chunksize
+        data=[NodeData.of(x) for x in nodes]
+        if not data:
+            return []
+        chunks=[data[i:i+size] for i in range(0,len(data),size)]
+        results=await asyncio.gather(*(self.call(_apply,func,c) for c in chunks))
+        return [x for r in results for x in r]
+
+    def close(self)->None:
+        """プロセスを終了します。実行前の処理は取り消されます。"""
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor=None
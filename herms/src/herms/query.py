@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from abc import ABC, abstractmethod
 import sys
-from typing import  TYPE_CHECKING, Any, Callable, ClassVar, Generic, Iterable, Literal, TypeVar, cast, overload
+from typing import  TYPE_CHECKING, Any, Callable, ClassVar, Generic, Iterable, Literal, NamedTuple, TypeVar, cast, overload
 
 from lark import Lark, Token, Tree
 from . import datatype
@@ -12,6 +12,7 @@ from .nodetype import DataType, NodeType, Property
 if TYPE_CHECKING:
     from .repository import Repository
     from .state import State
+    from .tag import Tag
 
 class QueryFormatException(Exception):
     def __init__(self, msg: str = "Syntax error"):
@@ -243,6 +244,22 @@ class Props:
             else:
                 types=[x for x in newtypes if isinstance(x,NodeType)]
         self.props=ret
+
+    @classmethod
+    def of(cls,path:str,repo:Repository)->Props:
+        """``ref.num`` や ``~ref`` のようなプロパティのパスから作成します。"""
+        names=[(x.startswith("~"),x.removeprefix("~")) for x in path.removeprefix(".").split(".")]
+        if any(not name for _,name in names):
+            raise QueryFormatException(f"{path}: Invalid property path.")
+        return cls(names,repo,False)
+
+    def multiple(self)->bool:
+        """複数の値を返すことがあるかどうかを返します。"""
+        for rev,prop in self.props:
+            if rev or any(x.list for x in ([prop] if isinstance(prop,Property) else prop.values())):
+                return True
+        return False
+
     def type(self)->DataType:
         """このプロパティの返値の型を返します。
         
@@ -272,12 +289,31 @@ class Props:
 #
 # Executor
 #
+class Guard(NamedTuple):
+    """Nodeが条件に合うために必要な、NodeType、状態、タグのいずれかです。"""
+    kind:Literal["type","state","tag"]
+    value:Any
+    exact:bool
+    """これに合えば条件に合うかどうか"""
+
+    def check(self,type:NodeType,state:State,tags:Iterable[Tag])->bool:
+        if self.kind=="type":
+            return self.value in type.ancestors()
+        elif self.kind=="state":
+            return state==self.value
+        else:
+            return any(tag.isa(self.value) for tag in tags)
+
 class Executor:
     iterable:bool=False
 
     def match(self,node:Node)->bool:
         return True
 
+    def guard(self)->Guard|None:
+        """:class:`QuerySelector` が規則を振り分けるための :class:`Guard` を返します。"""
+        return None
+
     def len(self)->int:
         """要素のだいたいの数を返します。"""
         return sys.maxsize
@@ -468,12 +504,35 @@ class QuerySelector(list[tuple[Query,T]],Generic[T]):
             v[0].refresh(repo)
 
     def apply(self,qi:QueryInterface)->Callable[[Node],T]:
-        queries=[(q.apply(qi),v) for q,v in self]
+        """Nodeに対する値を返す関数を返します。
+
+        規則は、NodeTypeと状態とタグで振り分けられ、その組ごとに候補がキャッシュされます。
+        振り分けだけで決まる規則しかない場合は、条件を調べずに値を返します。
+        """
+        rules=[(x,x.guard(),v) for x,v in ((q.apply(qi),v) for q,v in self)]
+        tagged=any(g is not None and g.kind=="tag" for _,g,_ in rules)
+        cache:dict[tuple[NodeType,State,frozenset[Tag]|None],tuple[list[tuple[Executor,T]],T]]={}
+        def select(node:Node)->tuple[list[tuple[Executor,T]],T]:
+            candidates:list[tuple[Executor,T]]=[]
+            for x,g,v in rules:
+                if g is not None:
+                    if not g.check(node.type,node.state,node.tags):
+                        continue
+                    if g.exact:
+                        return candidates,v
+                candidates.append((x,v))
+            return candidates,self.default
         def _(node:Node)->T:
-            for q,v in queries:
-                if q.match(node):
+            key=(node.type,node.state,frozenset(node.tags) if tagged else None)
+            c=cache.get(key)
+            if c is None:
+                c=select(node)
+                cache[key]=c
+            candidates,default=c
+            for x,v in candidates:
+                if x.match(node):
                     return v
-            return self.default
+            return default
         return _
     def add(self,filter:Query,val:T):
         self.insert(0,(filter,val))
@@ -1,20 +1,41 @@
 from __future__ import annotations
 
+import asyncio
+import logging
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any, Callable, Iterable, Protocol, TypedDict, cast
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Protocol, TypedDict, cast
+
+import jsonschema
 
 from . import handler
 from .base import OwnedBy, OwnedDict
-from .config import Json, JsonObject, JsonSchema, config_file_of, dump_config_file, is_config_file, load_config_file, load_object, load_object_static
+from .changefeed import ChangeFeed
+from .columns import ReferenceIndex
+from .config import DirectorySnapshot, Json, JsonObject, JsonSchema, config_file_of, load_config_file, load_object, load_object_static
 from .node import Node
-from .nodetype import NodeType
+from .datatype import ReferenceResolver
+from .journal import Journal
+from .nodetype import NodeType, Property
+from .job import JobRunner
+from .merkle import MerkleTree, TreeDiff, diff
+from .mover import MovePlan, Mover
+from .offload import ProcessPool
+from .scheduler import DEFAULT_CONCURRENCY, ServiceScheduler
 from .service import Service
 from .tag import Tag, TagConfig
-from .query import Executor, Query, QueryCache, QuerySelector
+from .query import Executor, Query, QuerySelector
 from .repository_query import AllExecutor, AndExecutor, RepositoryQueryInterface
 from .state import State
+from .storage import NodeDocument, NodeKey, Storage, StorageConfig, WriteBuffer, create_storage
+from .transaction import Transaction
+from .transition import Field, TransitionTable
+
+if TYPE_CHECKING:
+    from .watcher import RepositoryWatcher
+
+logger = logging.getLogger(__name__)
 
 class RepositoryConfig(TypedDict,total=False):
     config_path:str
@@ -27,6 +48,10 @@ class RepositoryConfig(TypedDict,total=False):
     types:dict[str,Json]
     services:dict[str,str|JsonObject]
     states:dict[str,Json]
+    storage:str|StorageConfig
+    concurrency:int
+    journal:bool
+    processes:int
 
 
 class Repository:
@@ -73,13 +98,31 @@ class Repository:
         "states":{
             "type":"object",
             "additionalProperties": State.CONFIG_SCHEMA
-        }
+        },
+        "storage":Storage.CONFIG_SCHEMA,
+        "concurrency":{"type":"integer","minimum":1},
+        "journal":{"type":"boolean"},
+        "processes":{"type":"integer","minimum":1}
     }
 
     nodes:NodeDict
+    refs:ReferenceIndex
+    """Nodeの参照の逆引き"""
+    merkle:MerkleTree
+    """Nodeのfingerprintのハッシュの木"""
+    changes:dict[Node,set[Field]|None]
+    """自動遷移をまだ調べていない変更。Noneはすべての値が変更されたことを示します。"""
 
     services: OwnedDict[Service,"Repository"]
     """サービスの辞書"""
+    scheduler: ServiceScheduler
+    """サービスの処理を実行する順序"""
+    jobs: JobRunner
+    """時間のかかる処理を実行するジョブのキュー"""
+    processes: ProcessPool
+    """CPU負荷の高い処理を実行するプロセスプール"""
+    mover: Mover
+    """ディレクトリをまとめて移動します"""
 
     types: OwnedDict[NodeType,"Repository"]
     """ノードタイプの辞書"""
@@ -88,6 +131,22 @@ class Repository:
 
     states:OwnedDict[State,"Repository"]
 
+    storage:Storage
+    """Nodeの保存先"""
+
+    writer:WriteBuffer
+    """Nodeの書き込みバッファ"""
+
+    journal:Journal|None=None
+    """Nodeの変更を記録するジャーナル"""
+
+    read_only:bool=False
+    """読むだけのRepositoryかどうか。ジャーナルの所有者にならず、残っている変更をストレージに書き込みません。
+    :meth:`init` で中断した移動の続きも実行しません。"""
+
+    feed:ChangeFeed
+    """Nodeの変更のリビジョンの記録"""
+
     #
     # Accessors
     #
@@ -115,11 +174,11 @@ class Repository:
             type=self.types[arg[0:sep]]
             arg=arg[sep+1:]
         if type is not None:
-            return self.nodes[type].get(arg,None)
+            return self.nodes.find(type,arg)
         else:
             ret:Node|None=None
             for type in self.types.values():
-                n=self.nodes[type].get(arg,None)
+                n=self.nodes.find(type,arg)
                 if n is not None:
                     if ret is not None:
                         raise KeyError(arg+": ambiguous name (in "+ret.type.name+" and "+type.name+").")
@@ -134,10 +193,42 @@ class Repository:
             raise KeyError(str(arg) + ": Node of that name is not found.")
         return ret
 
+    def add_node(self,node:Node)->None:
+        """Nodeを追加します。"""
+        self.nodes.add(node)
+        self.merkle.add(node)
+        if self._transaction is not None:
+            self._transaction.added.append(node)
+
+    def remove_node(self,node:Node)->None:
+        """Nodeを削除します。
+
+        削除するNodeから他のNodeへの参照も解除されます。
+        トランザクションの中で削除した場合、取り消すとNodeは元に戻り、ストレージからも削除されません。
+        """
+        if self._transaction is not None:
+            self._transaction.remove(node)
+        self.discard_node(node)
+        self.writer.delete(node)
+        if self._depth==0:
+            self.writer.flush()
+
+    def discard_node(self,node:Node)->None:
+        """Nodeをメモリ上から取り除きます。ストレージからは削除しません。"""
+        node.unlink()
+        del self.nodes[node.type][node.name]
+        self.changes.pop(node,None)
+        self.refs.drop(node)
+        self.merkle.discard(node)
+        node.type.store.release(node.id)
+
     #
     # Paths
     #
     config_dir: Path=Path()
+    config_file: Path|None=None
+    snapshot: DirectorySnapshot
+    """設定ディレクトリの内容のスナップショット。一連の処理の開始時に作り直されます。"""
     data_dir: Path=Path()
     dir: Path=Path()
     service_path: dict[str,str]
@@ -190,7 +281,7 @@ class Repository:
         return self.node_path.resolver(self)
     
     def node_service_path_resolver(self,service:Service)->Callable[[Node],Path]:
-        return self.node_path.resolver(self,{"service":service.name})
+        return self.node_service_path.resolver(self,{"service":service.name})
 
     #
     # Initialization and configuration
@@ -202,23 +293,35 @@ class Repository:
         self.tags = TagDict(self)
         self.states=OwnedDict(self)
         self.nodes=NodeDict(self)
+        self.refs=ReferenceIndex()
+        self.merkle=MerkleTree()
+        self.changes={}
+        self.jobs=JobRunner()
+        self.processes=ProcessPool()
+        self.scheduler=ServiceScheduler((),jobs=self.jobs)
+        self.snapshot=DirectorySnapshot()
         self.query_interface=RepositoryQueryInterface(self)
         self.service_path={}
         self.node_path=QueryPathSelector(self,None, self.DEFAULT_NODE_PATH)
         self.node_service_path=QueryPathSelector(self,None, self.DEFAULT_NODE_SERVICE_PATH)
 
-    def configure(self, data: Json = None) -> None:
+    def configure(self, data: Json = None, read_only: bool = False) -> None:
+        """設定を適用し、Nodeを読み込みます。
+
+        他のRepositoryを読むだけの場合(同期元など)は、read_onlyを指定します。
+        """
         config:RepositoryConfig
         if data is None:
             data = self.DEFAULT_CONFIG_DIR
         if isinstance(data, str):
             dir = Path(data)
             if dir.is_file():
-                dir = dir.parent
                 file = dir
+                dir = dir.parent
             else:
                 file = dir / self.DEFAULT_CONFIG_FILE
             config = cast(RepositoryConfig,load_config_file(file, Repository.CONFIG_SCHEMA))
+            self.config_file=config_file_of(file)
             if "config_path" not in config:
                 config["config_path"] = str(dir)
         else:
@@ -244,15 +347,34 @@ class Repository:
             self.service_path=sp
         self.node_path.add_dict(config.get("node_path"),self)
         self.node_service_path.add_dict(config.get("node_service_path"), self)
+        self.storage=create_storage(self,config.get("storage"))
+        self.read_only=read_only
+        if self.journal is not None:
+            self.journal.close()
+        if config.get("journal",False):
+            self.journal=Journal(self.data_dir / Journal.FILE)
+            if not read_only and not self.journal.acquire():
+                logger.warning("%s: The journal is used by another process. Nodes are saved without it.",self.journal.path)
+        else:
+            self.journal=None
+        self.feed=ChangeFeed(self.data_dir / ChangeFeed.FILE)
+        owned=self.journal if self.journal is not None and self.journal.owner else None
+        self.writer=WriteBuffer(self.storage,journal=owned,feed=self.feed)
+        self.processes.workers=config.get("processes")
+        self.mover=Mover(self.data_dir / Mover.FILE)
 
         # object creation
         self._create_tags(config.get("tags",None))
         self._create_nodetypes(config.get("types",None))
         self._create_services(config.get("services",None))
+        self.scheduler=ServiceScheduler(self.services.values(),config.get("concurrency",DEFAULT_CONCURRENCY),self.jobs)
         self._create_states(config.get("states",None))
+        self.refresh()
         handler.provide(self)
         for x in self.services.values():
             handler.provide(x)
+        if owned is not None:
+            owned.replay(self.storage,self.feed)
         self._create_nodes()
 
     def _create_nodetypes(self,config:dict[str,Json]|None)->None:
@@ -281,58 +403,270 @@ class Repository:
     def _create_nodes(self) -> None:
         """Nodeを作成します。"""
         cfgs: list[tuple[Node, JsonObject]] = []
+        for node in self.nodes.iterate():
+            node.type.store.release(node.id)
         self.nodes.clear()
-        for type in self.types.values():
-            path = self.config_dir / type.name
-            schema=type.node_config_schema()
-            if path.is_dir():
-                for p in path.iterdir():
-                    file:Path|None=None
-                    if is_config_file(p):
-                        file=p
-                    elif p.is_dir():
-                        file=config_file_of(p / type.name)
-                    if file is not None:
-                        cfg=cast(JsonObject,load_config_file(file,schema))
-                        node=Node(type)
-                        node.name=p.stem
-                        self.nodes.add(node)
-                        cfgs.append((node,cfg))
+        self.refs.clear()
+        self.merkle.clear()
+        self._transitions=None
+        self.snapshot=DirectorySnapshot()
+        schemas:dict[NodeType,JsonSchema]={}
+        docs=self.storage.load()
+        if self.journal is not None:
+            # ストレージにまだ書き込まれていない変更を反映する
+            docs=self.journal.overlay(docs)
+        for typename,name,cfg in docs:
+            type=self.types.get(typename)
+            if type is None:
+                continue
+            schema=schemas.get(type)
+            if schema is None:
+                schema=type.node_config_schema()
+                schemas[type]=schema
+            jsonschema.validate(cfg,schema)
+            node=Node(type)
+            node.name=name
+            self.add_node(node)
+            cfgs.append((node,cfg))
+        resolver=ReferenceResolver(self)
         for node, cfg in cfgs:
-            node.configure(cfg)
-        
+            resolver.collect(node.type,cfg)
+        resolver.resolve()
+        for node, cfg in cfgs:
+            node.configure(cfg,resolver)
+            node.dirty=False
+        self.link_nodes(*(node for node,_ in cfgs))
+        self.changes.clear()
+
         self.init_nodes(*self.nodes.iterate())
 
+    def apply_documents(self,docs:Iterable[NodeDocument])->list[Node]:
+        """ストレージの形式のNodeの設定を反映します。ないNodeは作成します。
+
+        参照はまとめて解決するので、互いに参照するNodeを一度に渡せます。
+        作成したNodeと内容が変わったNodeを返します。
+        """
+        cfgs:list[tuple[Node,JsonObject,bytes|None]]=[]
+        for typename,name,cfg in docs:
+            type=self.types.get(typename)
+            if type is None:
+                continue
+            jsonschema.validate(cfg,type.node_config_schema())
+            node=self.nodes.find(type,name)
+            if node is None:
+                node=Node(type)
+                node.name=name
+                self.add_node(node)
+                old=None
+            else:
+                old=node.fingerprint()
+                node.unlink()
+            cfgs.append((node,cfg,old))
+        resolver=ReferenceResolver(self)
+        for node,cfg,_ in cfgs:
+            resolver.collect(node.type,cfg)
+        resolver.resolve()
+        for node,cfg,_ in cfgs:
+            node.configure(cfg,resolver)
+        self.link_nodes(*(node for node,_,_ in cfgs))
+        self.init_nodes(*(node for node,_,old in cfgs if old is None))
+        return [node for node,_,old in cfgs if old is None or old!=node.fingerprint()]
+
+    def link_nodes(self,*nodes:Node)->None:
+        """Nodeからの参照を :attr:`refs` にまとめて登録します。"""
+        node_props:dict[NodeType,list[Property]]={}
+        refs:list[tuple[Property,Node,Node]]=[]
+        for node in nodes:
+            props=node_props.get(node.type)
+            if props is None:
+                props=[p for p in node.type.properties.values() if p.is_node()]
+                node_props[node.type]=props
+            for prop in props:
+                val=node.properties.get(prop)
+                if val is None:
+                    continue
+                if prop.list:
+                    refs.extend((prop,x,node) for x in cast(list[Node],val))
+                else:
+                    refs.append((prop,cast(Node,val),node))
+        self.refs.build(refs)
+
+    async def reload(self,*files:Path)->set[Node]:
+        """変更のあったファイルを読み込み直します。
+
+        Nodeの設定ファイルが変更された場合は、そのNodeだけを設定し直します。
+        Repositoryの設定ファイルが変更された場合は、NodeType、タグ、状態とすべてのNodeを作り直します。
+        その後、変更のあったNodeについて :meth:`modified` を呼びます。
+
+        変更のあったNodeを返します。
+        """
+        async with self._cycle():
+            if self.config_file is not None and any(
+                    f.resolve()==self.config_file.resolve() for f in files):
+                self.reload_config()
+                nodes=set(self.nodes.iterate())
+            else:
+                nodes=self._reload_nodes(files)
+            if nodes:
+                await self.modified(*nodes)
+            return nodes
+
+    def reload_config(self)->None:
+        """Repositoryの設定ファイルを読み込み直します。
+
+        サービスは作り直されません。
+        """
+        assert self.config_file is not None
+        config=cast(RepositoryConfig,load_config_file(self.config_file, Repository.CONFIG_SCHEMA))
+        self._create_tags(config.get("tags",None))
+        self._create_nodetypes(config.get("types",None))
+        self._create_states(config.get("states",None))
+        self.refresh()
+        self._create_nodes()
+
+    def _reload_nodes(self,files:Iterable[Path])->set[Node]:
+        keys:set[NodeKey]=set()
+        for file in files:
+            self.snapshot.forget(file.parent)
+            key=self.storage.node_of_file(file)
+            if key is not None:
+                keys.add(key)
+        removed:list[NodeKey]=[]
+        nodes=self.reload_nodes(keys,removed)
+        self.feed.record([*(((n.type.name,n.name),False) for n in nodes),*((k,True) for k in removed)])
+        return nodes
+
+    def reload_nodes(self,keys:Iterable[NodeKey],removed:list[NodeKey]|None=None)->set[Node]:
+        """指定したNodeをストレージから読み込み直します。
+
+        ストレージにないNodeはメモリ上から取り除かれ、removedに加えられます。内容が変わったNodeを返します。
+        """
+        if self._depth==0:
+            self.snapshot=DirectorySnapshot()
+        cfgs:list[tuple[Node,JsonObject,Json]]=[]
+        for typename,name in set(keys):
+            type=self.types.get(typename)
+            if type is None:
+                continue
+            node=self.nodes.find(type,name)
+            cfg=self.storage.load_node(type.name,name)
+            if cfg is None:
+                if node is not None:
+                    self.discard_node(node)
+                    if removed is not None:
+                        removed.append((typename,name))
+                continue
+            jsonschema.validate(cfg,type.node_config_schema())
+            if node is None:
+                node=Node(type)
+                node.name=name
+                self.add_node(node)
+                old=None
+            else:
+                old=node.dump()
+            cfgs.append((node,cfg,old))
+        for node,cfg,_ in cfgs:
+            node.configure(cfg)
+            node.dirty=False
+        nodes=[node for node,_,old in cfgs if old is None or old!=node.dump()]
+        self.init_nodes(*nodes)
+        return set(nodes)
+
+    def watch(self,lock:asyncio.Lock|None=None)->RepositoryWatcher:
+        """設定ディレクトリの変更を監視する :class:`.RepositoryWatcher` を作成します。
+
+        ``await repo.watch().run()`` で監視を開始します。
+        lockを指定すると、そのロックを取ってから変更を反映します。
+        """
+        from .watcher import RepositoryWatcher
+        return RepositoryWatcher(self,lock=lock)
+
+    def diff(self,other:Repository)->TreeDiff:
+        """otherとのNodeの違いを返します。
+
+        :attr:`merkle` のハッシュが異なる部分だけを調べます。
+        ``added`` はotherにだけあるNode、``removed`` はこのRepositoryにだけあるNodeです。
+        """
+        return diff(self.merkle,other.merkle)
+
+    def revision(self,node:Node)->int:
+        """Nodeが最後に保存されたときのリビジョンを返します。保存されていない場合は0です。"""
+        return self.feed.revisions.get((node.type.name,node.name),0)
+
     def init_nodes(self,*nodes:Node):
         np=self.node_path_resolver()
         for node in nodes:
             node.node_path=np(node)
-        for service in self.services.values():
-            nsp=self.node_service_path_resolver(service)
+        services=list(self.services.values())
+        if services:
+            # 規則はServiceによらないので、テンプレートはNodeごとに1回だけ求める
+            nsp=self.node_service_path.apply(self.query_interface)
             for node in nodes:
-                node.node_service_path[service]=nsp(node)
+                tmpl=nsp(node)
+                for service in services:
+                    node.node_service_path[service]=self.dir / tmpl.format(node=node.name,type=node.type.name,service=service.name)
+
+    async def relocate(self,*nodes:Node,dry_run:bool=False)->MovePlan:
+        """Nodeのパスを求め直し、変わったディレクトリを移動します。
+
+        :attr:`node_path` などの規則を変えた後に呼びます。nodeを指定しない場合は、すべてのNodeが対象です。
+        移動の計画を返します。計画を立てられない場合とdry_runの場合は、Nodeのパスは元のままです。
+        """
+        if not nodes:
+            nodes=tuple(self.nodes.iterate())
+        old=[(node,cast(Path|None,getattr(node,"node_path",None)),dict(node.node_service_path)) for node in nodes]
+        self.init_nodes(*nodes)
+        moves:list[tuple[Path,Path]]=[]
+        for node,path,service_paths in old:
+            if path is not None:
+                moves.append((path,node.node_path))
+            moves.extend((p,node.node_service_path[s]) for s,p in service_paths.items() if s in node.node_service_path)
+        def restore():
+            for node,path,service_paths in old:
+                if path is not None:
+                    node.node_path=path
+                node.node_service_path.update(service_paths)
+        try:
+            plan=await asyncio.to_thread(lambda:MovePlan((s,d) for s,d in moves if s!=d and s.exists()))
+        except BaseException:
+            restore()
+            raise
+        if dry_run:
+            restore()
+        else:
+            await self.mover.run(plan)
+        return plan
 
     def refresh(self):
         """NodeTypeの内容が変わったとき呼ばれます。"""
         self.node_path.refresh(self)
         self.node_service_path.refresh(self)
+        for state in self.states.values():
+            state.refresh(self)
+        self._transitions=None
 
     def consumers(self):
         return self.services.values()
 
     def save_nodes(self,*nodes:Node):
-        for node in nodes:
-            path = self.config_dir / node.type.name / node.name
-            if is_config_file(path):
-                file=path
-            elif path.is_dir():
-                file=config_file_of(path / node.type.name)
-            else:
-                file=None
-            if file is None:
-                file=path.with_suffix(".yaml")
-            dump_config_file(file,node.dump())
-        
+        """Nodeを保存します。
+
+        変更のあったNodeだけが保存されます。:meth:`update` などの処理中に呼ばれた場合、
+        書き込みは最も外側の処理が終わったときにまとめてバックグラウンドで行われます。
+        """
+        self.writer.add(*nodes)
+        if self._depth==0:
+            self.writer.flush()
+
+    async def flush(self):
+        """保存待ちのNodeをすべて書き込み、終了を待ちます。"""
+        await self.writer.wait()
+
+    def checkpoint(self)->None:
+        """保存待ちのNodeと、ジャーナルに記録した変更の、ストレージへの書き込みを開始します。終了は待ちません。"""
+        self.writer.flush()
+        self.writer.checkpoint()
+
     #
     # Queries
     #
@@ -357,28 +691,128 @@ class Repository:
         await self.close()
 
     async def init(self):
-        """実行前に呼びます。"""
-        for s in self.services.values():
-            await s.init()
+        """実行前に呼びます。
+
+        中断したディレクトリの移動があれば、続きを実行します。失敗した場合はログに残し、移動はそのままにします。
+        :attr:`read_only` の場合は移動しません。
+        """
+        if not self.read_only:
+            try:
+                await self.mover.resume()
+            except Exception:
+                logger.exception("%s: failed to resume the interrupted move; run 'herms relocate --resume' or '--abort'",
+                                 self.mover.path)
+        await self.scheduler.run(lambda s:s.init(),name="init")
 
     async def close(self):
         """実行終了時に呼びます。"""
-        for s in self.services.values():
-            await s.close()
+        await self.scheduler.run(lambda s:s.close(),reverse=True,name="close")
+        await self.jobs.close()
+        self.processes.close()
+        await self.flush()
+        self.writer.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.feed.close()
+        self.storage.close()
+
+    _depth:int=0
+    cycle:int=0
+    """一連の処理の番号。最も外側の処理の開始時に1つ増えます。"""
+
+    @asynccontextmanager
+    async def _cycle(self):
+        """一連の処理の単位です。
+
+        最も外側の処理の開始時に :attr:`snapshot` を作り直して :attr:`cycle` を増やし、
+        終了時に変更されたNodeの書き込みを開始します(:meth:`checkpoint`)。
+        """
+        if self._depth==0:
+            self.snapshot=DirectorySnapshot()
+            self.cycle+=1
+        self._depth+=1
+        try:
+            yield
+        finally:
+            self._depth-=1
+            if self._depth==0:
+                self.checkpoint()
 
     async def update(self, *arg: Node, intensive:bool=False):
-        """各サービスで必要とする処理をします。"""
+        """各サービスで必要とする処理をします。
 
-        nodes=set(arg)
-        while True:
-            modified:set[Node]=set()
-            for s in self.services.values():
-                modified.update(await s.update(*nodes))
-            if not modified:
-                break
-            nodes=await self.modified(*modified)
-            if not nodes:
-                break
+        依存関係のないサービスは並行に実行されます。
+        全体が1つのジョブとして :attr:`jobs` で実行されます。
+        """
+        await self.jobs.run(lambda job:self._update(*arg,intensive=intensive),"update")
+
+    async def _update(self, *arg: Node, intensive:bool=False):
+        async with self._cycle():
+            nodes=set(arg)
+            while True:
+                modified=await self.scheduler.collect(lambda s:s.update(*nodes,intensive=intensive),"update")
+                if not modified:
+                    break
+                nodes=await self._modified(*modified)
+                if not nodes:
+                    break
+
+    _transitions:TransitionTable|None=None
+
+    @property
+    def transitions(self)->TransitionTable:
+        """状態遷移の表。NodeTypeや状態が変わったとき作り直されます。"""
+        if self._transitions is None:
+            self._transitions=TransitionTable(self)
+        return self._transitions
+
+    _transaction:Transaction|None=None
+
+    @asynccontextmanager
+    async def transaction(self):
+        """一連の変更をまとめて行うときにwith文で使います。
+
+        中で行ったプロパティ、タグ、状態の変更と、Nodeの追加は、例外が起きると取り消されます。
+        中で呼ばれた :meth:`modified` は、最後に変更のあったNodeすべてについて1回だけ実行されます。
+        保存は最後にまとめて行われます。入れ子にした場合は、外側と1つのトランザクションになります。
+        """
+        if self._transaction is not None:
+            yield self._transaction
+            return
+        async with self._cycle():
+            txn=Transaction(self)
+            self._transaction=txn
+            try:
+                yield txn
+                txn.committing=True
+                await self._modified(*txn.nodes())
+            except BaseException:
+                self._transaction=None
+                txn.rollback()
+                raise
+            finally:
+                self._transaction=None
+
+    def before_change(self,node:Node)->None:
+        """Nodeの内容が変更される直前に呼ばれます。"""
+        if self._transaction is not None:
+            self._transaction.record(node)
+
+    def track(self,node:Node,field:Field|None)->None:
+        """Nodeの変更を :attr:`changes` に記録します。
+
+        自動遷移の条件が読み取らない値の変更は記録しません。
+        """
+        self.merkle.touch(node)
+        if field is not None and self._transitions is not None and field not in self._transitions.fields:
+            return
+        if field is None:
+            self.changes[node]=None
+        else:
+            fields=self.changes.get(node,set())
+            if fields is not None:
+                fields.add(field)
+                self.changes[node]=fields
 
     async def state(self,*nodes:Node,state:State|None=None)->list[Node]:
         """
@@ -388,59 +822,83 @@ class Repository:
 
         状態を変更できたNodeを返します。
         """
-        cache=QueryCache(self.query_interface)
-        rets:list[tuple[Node,State]]=[]
-        for node in nodes:
+        return await self.jobs.run(lambda job:self._state(*nodes,state=state),"state")
+
+    async def _state(self,*nodes:Node,state:State|None=None)->list[Node]:
+        async with self._cycle():
             if state is None:
-                for next,tr in node.state.transitions.items():
-                    if tr.auto and cache(tr.condition,node):
-                        state=next
-                        break
-                if state is None:
-                    continue
+                for node in nodes:
+                    if node not in self.changes:
+                        self.changes[node]=None
+                succeeds=await self._auto_transit()
             else:
-                tr=node.state.transitions.get(state)
-                if tr is None:
-                    continue
-                if not cache(tr.condition,node):
-                    continue
-            rets.append((node,state))
-        if rets:
-            gens:list[AsyncGenerator[Iterable[Node],Iterable[Node]]]=[]
-            count:dict[Node,int]={}
-            for service in self.services.values():
-                gen=service.state(*((node,state.services.get(service,"")) for node,state in rets))
-                for n in await anext(gen):
-                    count[n]=count.get(n,0)+1
-                gens.append(gen)
-            succeeds=[n for n,c in count.items() if c==len(self.services)]
-            for node,state in rets:
-                node.state=state
-            for gen in gens:
-                try:
-                    await gen.asend(succeeds)
-                except StopAsyncIteration:
-                    pass
+                table=self.transitions
+                succeeds=await self._transit([(node,state) for node in nodes if table.can_transit(node,state)])
             await self.modified(*succeeds)
             return succeeds
-        else:
+
+    async def _auto_transit(self)->list[Node]:
+        """:attr:`changes` に記録された変更によって条件を満たした自動遷移を実行します。"""
+        table=self.transitions
+        changes=self.changes
+        self.changes={}
+        rets:list[tuple[Node,State]]=[]
+        for node,trs in table.candidates(changes).items():
+            next=table.next_state(node,trs)
+            if next is not None:
+                rets.append((node,next))
+        return await self._transit(rets)
+
+    async def _transit(self,rets:list[tuple[Node,State]])->list[Node]:
+        if not rets:
             return []
+        gens:list[AsyncGenerator[Iterable[Node],Iterable[Node]]]=[]
+        count:dict[Node,int]={}
+        for service in self.services.values():
+            gen=service.state(*((node,state.services.get(service,"")) for node,state in rets))
+            for n in await anext(gen):
+                count[n]=count.get(n,0)+1
+            gens.append(gen)
+        succeeds=[node for node,_ in rets if count.get(node,0)==len(self.services)]
+        ok=set(succeeds)
+        for node,state in rets:
+            if node in ok:
+                node.state=state
+        for gen in gens:
+            try:
+                await gen.asend(succeeds)
+            except StopAsyncIteration:
+                pass
+        return succeeds
 
     async def modified(self,*nodes:Node)->set[Node]:
         """
         内容に変更があったとき呼びます。
 
+        変更された値が記録されていないNodeは、すべての値が変更されたものとして自動遷移を調べます。
+        :meth:`transaction` の中で呼ばれた場合は、トランザクションの最後にまとめて実行されます。
+
         さらに内容に変化のあった:class:Nodeを返します。
         """
-        _nodes:list[Node]=list(nodes)
-        modified:set[Node]=set()
-        while _nodes:
-            for service in self.services.values():
-                modified.update(await service.modified(*_nodes))
-            _nodes=await self.state(*_nodes)
-            modified.update(_nodes)
-        self.save_nodes(*nodes)
-        return modified
+        txn=self._transaction
+        if txn is not None and not txn.committing:
+            txn.modified.update((n,None) for n in nodes)
+            return set()
+        return await self._modified(*nodes)
+
+    async def _modified(self,*nodes:Node)->set[Node]:
+        async with self._cycle():
+            for node in nodes:
+                if node not in self.changes:
+                    self.changes[node]=None
+            _nodes:list[Node]=list(nodes)
+            modified:set[Node]=set()
+            while _nodes:
+                modified.update(await self.scheduler.collect(lambda s:s.modified(*_nodes),"modified"))
+                _nodes=await self._auto_transit()
+                modified.update(_nodes)
+            self.save_nodes(*nodes)
+            return modified
 
 class QueryPathSelector(QuerySelector[str]):
     def resolver(self,repo:Repository,args:dict[str,Any]={}):
@@ -522,6 +980,11 @@ class NodeDict(dict[NodeType, OwnedDict[Node,Repository]]):
         else:
             return self[type].values()
 
+    def find(self,type:NodeType,name:str)->Node|None:
+        """typeのNodeのうち、名前がnameのものを返します。"""
+        dic=self.get(type)
+        return None if dic is None else dic.get(name)
+
     def add(self,node:Node):
         dic=self.get(node.type)
         if dic is None:
@@ -1,14 +1,16 @@
 
 from __future__ import annotations
 from collections.abc import Iterable
+from functools import reduce
 import sys
 from typing import TYPE_CHECKING, Any, cast
 
+from .columns import ArrayColumn, NodeStore, np
 from .datatype import DataType
 from .tag import Tag
 from .nodetype import NodeType,Property
 from .node import Node
-from .query import Props, ApplyExpr, Executor, NameExpr, NodeTypeExpr, Value, QueryFormatException, QueryInterface, LogicalExpr, RelExpr, StateExpr
+from .query import Props, ApplyExpr, Executor, Guard, NameExpr, NodeTypeExpr, Value, QueryFormatException, QueryInterface, LogicalExpr, RelExpr, StateExpr
 
 if TYPE_CHECKING:
     from .repository import Repository
@@ -18,6 +20,12 @@ class AndExecutor(Executor):
     first:Executor
     args:list[Executor]
     def __init__(self,first:Executor,args:list[Executor]):
+        if isinstance(first,VectorExecutor):
+            # 同じNodeStoreに対する条件は、マスクの論理積でまとめて求める
+            vecs=[x for x in args if isinstance(x,VectorExecutor) and x.store is first.store]
+            if vecs:
+                first=VectorAndExecutor(first.store,[first,*vecs])
+                args=[x for x in args if x not in vecs]
         self.first=first
         self.args=args
         self.iterable=self.first.iterable
@@ -36,6 +44,13 @@ class AndExecutor(Executor):
     def _match_args(self,node:Node)->bool:
         return all((x.match(node) for x in self.args))
 
+    def guard(self)->Guard|None:
+        for x in (self.first,*self.args):
+            g=x.guard()
+            if g is not None:
+                return g._replace(exact=False)
+        return None
+
 class OrExecutor(Executor):
     args:list[Executor]
     cond_args:list[Executor]
@@ -111,6 +126,9 @@ class NodeTypeExecutor(Executor):
 
     def match(self, node: Node) -> bool:
         return self.nodetype in node.type.ancestors()
+
+    def guard(self)->Guard|None:
+        return Guard("type",self.nodetype,True)
     
     def len(self) -> int:
         return self._len
@@ -138,12 +156,18 @@ class StateExecutor(Executor):
         self.state=state
     def match(self, node: Node) -> bool:
         return node.state==self.state
+
+    def guard(self)->Guard|None:
+        return Guard("state",self.state,True)
 class TagExecutor(Executor):
     tag:Tag
     def __init__(self,tag:Tag):
         self.tag=tag
     def match(self, node: Node) -> bool:
         return any((tag.isa(self.tag) for tag in node.tags))
+
+    def guard(self)->Guard|None:
+        return Guard("tag",self.tag,True)
 class PropExecutor(Executor):
     props:Props
     def __init__(self,props:Props):
@@ -156,7 +180,7 @@ class PropExecutor(Executor):
             for n in nodes:
                 v=self._value_of(n,rev,props)
                 values.extend(v)
-            nodes=[x for x in values if isinstance(x,Node)]
+            nodes=[x for x,_ in values if isinstance(x,Node)]
         return values
     def _value_of(self,node:Node,rev:bool,prop:Property|dict[NodeType|None,Property])->Iterable[tuple[Any,DataType]]:
         if rev:
@@ -164,10 +188,9 @@ class PropExecutor(Executor):
                 props=[prop]
             else:
                 props=prop.values()
+            refs=node.owner.refs
             for p in props:
-                ret=node.properties_rev.get(p)
-                if ret is not None:
-                    yield from ((x,p.type) for x in ret)
+                yield from ((x,p.owner) for x in refs.sources(p,node))
         else:
             p=prop if isinstance(prop,Property) else prop.get(node.type)
             if p is not None:
@@ -191,9 +214,9 @@ class ApplyExecutor(PropExecutor):
     def match(self,node:Node)->bool:
         values=self.value(node)
         if self.op=='&':
-            return all((self.cond.match(x[0]) for x in values if isinstance(x,Node)))
+            return all((self.cond.match(x) for x,_ in values if isinstance(x,Node)))
         else:
-            return any((self.cond.match(x[0]) for x in values if isinstance(x,Node)))
+            return any((self.cond.match(x) for x,_ in values if isinstance(x,Node)))
 
 class RelExecutor(PropExecutor):
     op:str
@@ -225,6 +248,89 @@ class RelExecutor(PropExecutor):
             else:
                 return value[0]<val or (eq and value[0]==val)
 
+class VectorExecutor(Executor):
+    """:class:`.NodeStore` の行のマスクを求めて、条件に合うNodeを列挙します。
+
+    NumPyがある場合にだけ使われます。:meth:`match` は1つずつ評価します。
+    """
+    store:NodeStore
+    _mask:Any
+    _version:int
+    """_maskを求めたときの :attr:`.NodeStore.version`"""
+    def __init__(self,store:NodeStore):
+        self.store=store
+        self.iterable=True
+        self._mask=None
+        self._version=-1
+
+    def mask(self)->Any:
+        """各行が条件に合うかどうかの配列を返します。"""
+        if self._mask is None or self._version!=self.store.version:
+            self._mask=self._compute()
+            self._version=self.store.version
+        return self._mask
+
+    def _compute(self)->Any:
+        nodes=self.store.nodes
+        return np.fromiter((n is not None and self.match(n) for n in nodes),np.bool_,len(nodes))
+
+    def len(self)->int:
+        return int(np.count_nonzero(self.mask()))
+
+    def items(self)->Iterable[Node]:
+        nodes=self.store.nodes
+        for row in np.flatnonzero(self.mask()).tolist():
+            node=nodes[row]
+            if node is not None:
+                yield node
+
+class VectorAndExecutor(VectorExecutor):
+    args:list[VectorExecutor]
+    def __init__(self,store:NodeStore,args:list[VectorExecutor]):
+        super().__init__(store)
+        self.args=args
+
+    def match(self,node:Node)->bool:
+        return all((x.match(node) for x in self.args))
+
+    def _compute(self)->Any:
+        return reduce(np.logical_and,(x.mask() for x in self.args))
+
+class VectorRelExecutor(RelExecutor,VectorExecutor):
+    """数値のプロパティとの比較を、NumPyの配列に対してまとめて行います。"""
+    prop:Property
+    targets:list[Any]
+    def __init__(self,props:Props,op:str,val:list[Value],prop:Property,targets:list[Any]):
+        RelExecutor.__init__(self,props,op,val)
+        VectorExecutor.__init__(self,prop.owner.store)
+        self.prop=prop
+        self.targets=targets
+
+    def _compute(self)->Any:
+        col=self.store.columns.get(self.prop)
+        if not isinstance(col,ArrayColumn):
+            return super()._compute()
+        vals,present=col.view()
+        op=self.op.lstrip('|')
+        if op=='!=':
+            ret=present.copy()
+            for x in self.targets:
+                ret&=vals!=x
+        elif op=='=' or op=='==':
+            ret=present & np.isin(vals,self.targets)
+        else:
+            x=self.targets[0]
+            if op=='>':
+                ret=vals>x
+            elif op=='>=':
+                ret=vals>=x
+            elif op=='<':
+                ret=vals<x
+            else:
+                ret=vals<=x
+            ret&=present
+        return ret
+
 
 class RepositoryQueryInterface(QueryInterface):
     repo:Repository
@@ -248,8 +354,7 @@ class RepositoryQueryInterface(QueryInterface):
                 else:
                     if first is None:
                         first=c
-                if first!=c:
-                    args.append(c)
+                args.append(c)
             assert first is not None
             args=sorted((x for x in args if x!=first),key=lambda x: x.len())
             return AndExecutor(first,args)
@@ -284,4 +389,25 @@ class RepositoryQueryInterface(QueryInterface):
     def handle_apply_expr(self, query: ApplyExpr) -> Executor:
         return ApplyExecutor(query.props,query.op,query.condition.apply(self))
     def handle_rel_expr(self, query: RelExpr) -> Executor:
-        return RelExecutor(query.props,query.op,query.val)
\ No newline at end of file
+        if np is not None:
+            ret=self._vector_rel(query)
+            if ret is not None:
+                return ret
+        return RelExecutor(query.props,query.op,query.val)
+
+    def _vector_rel(self,query:RelExpr)->Executor|None:
+        """数値のプロパティとの単純な比較であれば、:class:`VectorRelExecutor` を返します。"""
+        if len(query.props.props)!=1 or query.op[0]=='&':
+            return None
+        rev,prop=query.props.props[0]
+        if rev or not isinstance(prop,Property) or prop.list:
+            return None
+        if not isinstance(prop.owner.store.columns.get(prop),ArrayColumn):
+            return None
+        try:
+            targets=[x.value(self.repo,prop.type) for x in query.val]
+        except (ValueError,TypeError):
+            return None
+        if not all((type(x) in (int,float,bool) for x in targets)):
+            return None
+        return VectorRelExecutor(query.props,query.op,query.val,prop,targets)
\ No newline at end of file
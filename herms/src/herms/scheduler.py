@@ -0,0 +1,96 @@
+"""
+:class:`.Service` の処理を、依存関係に従って並行に実行します。
+
+各サービスは、設定の ``after`` で先に実行すべきサービスを指定できます。
+依存関係のないサービスどうしは :func:`asyncio.gather` で同時に実行されます。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable, Iterable
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .job import JobRunner
+    from .node import Node
+    from .service import Service
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY=8
+"""同時に実行するサービスの数の既定値"""
+
+class ServiceScheduler:
+    """サービスを依存関係に従って実行します。"""
+    levels:list[list[Service]]
+    """同時に実行できるサービスのグループを、実行する順に並べたもの"""
+    limit:int
+    """同時に実行するサービスの数の上限"""
+    jobs:JobRunner|None
+    """各サービスの処理をジョブとして実行する場合のJobRunner"""
+
+    def __init__(self,services:Iterable[Service],limit:int=DEFAULT_CONCURRENCY,jobs:JobRunner|None=None):
+        self.limit=limit
+        self.jobs=jobs
+        self.levels=self._levels(list(services))
+
+    @staticmethod
+    def _levels(services:list[Service])->list[list[Service]]:
+        names={s.name:s for s in services}
+        deps:dict[Service,set[Service]]={}
+        for s in services:
+            deps[s]=set()
+            for name in s.after:
+                dep=names.get(name)
+                if dep is None:
+                    raise ValueError(f"{s.name}: Unknown service '{name}' in after.")
+                deps[s].add(dep)
+        levels:list[list[Service]]=[]
+        done:set[Service]=set()
+        while len(done)<len(services):
+            level=[s for s in services if s not in done and deps[s]<=done]
+            if not level:
+                rest=", ".join(s.name for s in services if s not in done)
+                raise ValueError(f"Circular dependency among services: {rest}")
+            levels.append(level)
+            done.update(level)
+        return levels
+
+    async def run[T](self,f:Callable[[Service],Awaitable[T]],reverse:bool=False,name:str="")->list[T]:
+        """各サービスについてfを実行し、結果を返します。
+
+        reverseがTrueの場合は、依存関係と逆の順に実行します。
+        :attr:`jobs` がある場合は、各サービスの処理は ``サービス名:name`` という名前のジョブになります。
+        いずれかのサービスが失敗した場合は、同じグループの残りのサービスの終了を待ってから、最初の例外を送出します。
+        """
+        sem=asyncio.Semaphore(self.limit)
+        jobs=self.jobs
+        async def _run(service:Service)->T:
+            async with sem:
+                try:
+                    async with asyncio.timeout(service.timeout):
+                        if jobs is None:
+                            return await f(service)
+                        return await jobs.run(lambda job:f(service),f"{service.name}:{name}")
+                except TimeoutError as e:
+                    raise TimeoutError(f"{service.name}: Timed out after {service.timeout} seconds.") from e
+        ret:list[T]=[]
+        for level in reversed(self.levels) if reverse else self.levels:
+            results=await asyncio.gather(*(_run(s) for s in level),return_exceptions=True)
+            errors=[x for x in results if isinstance(x,BaseException)]
+            for service,x in zip(level,results):
+                if isinstance(x,BaseException) and x is not errors[0]:
+                    logger.error("%s: %r",service.name,x)
+            if errors:
+                raise errors[0]
+            ret.extend(results)  # type: ignore[arg-type]
+        return ret
+
+    async def collect(self,f:Callable[[Service],Awaitable[Iterable[Node]]],name:str="")->set[Node]:
+        """各サービスについてfを実行し、返されたNodeをまとめて返します。"""
+        ret:set[Node]=set()
+        for nodes in await self.run(f,name=name):
+            ret.update(nodes)
+        return ret
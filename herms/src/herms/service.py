@@ -5,12 +5,18 @@ from __future__ import annotations
 
 import sys
 from pathlib import Path
-from typing import ClassVar, Iterable
+from typing import TYPE_CHECKING, ClassVar, Iterable, cast
 from collections.abc import AsyncGenerator
 from .config import Json, JsonSchema
 from .base import InRepository
+from .mover import MovePlan
 from .node import Node
 
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from .job import Job, JobFunc
+    from .offload import NodeData
+
 class Service(InRepository):
     """様々なサービスを提供します。
 
@@ -26,10 +32,17 @@ class Service(InRepository):
         "type":"object",
         "properties":{
             "type":{"type":"string"},
-            "description":{"type":"string"}
+            "description":{"type":"string"},
+            "after":{"type":"array","items":{"type":"string"}},
+            "timeout":{"type":"number"}
         }
     }
 
+    after:list[str]=[]
+    """このサービスより先に実行するサービスの名前"""
+    timeout:float|None=None
+    """各処理の制限時間(秒)"""
+
 
     def __init__(self):
         pass
@@ -41,7 +54,9 @@ class Service(InRepository):
 
     def configure(self, data: Json) -> None:
         """設定を適用します。"""
-        _=data
+        if isinstance(data,dict):
+            self.after=list(cast(list[str],data.get("after",[])))
+            self.timeout=cast(float|None,data.get("timeout"))
 
     def node_config_schema(self)->JsonSchema:
         return {"type":"object"}
@@ -66,7 +81,7 @@ class Service(InRepository):
     def _find_file_in(self, dir: Path, file: str | None) -> Path:
         if file is None:
             return dir
-        if dir.is_dir():
+        if self.owner.snapshot.is_dir(dir):
             return dir / file
         else:
             return dir.parent / (dir.name + "." + file)
@@ -113,6 +128,20 @@ class Service(InRepository):
     #
     # Utilities
     #
+    def submit[T](self,func:JobFunc[T],name:str="",priority:int=0)->Job[T]:
+        """時間のかかる処理をジョブとしてキューに入れます。
+
+        ジョブの名前は ``サービス名:name`` になります。
+        """
+        return self.owner.jobs.submit(func,f"{self.name}:{name}",priority)
+
+    async def map_nodes[R](self,func:Callable[[NodeData],R],nodes:Iterable[Node],chunksize:int|None=None)->list[R]:
+        """CPU負荷の高い処理を、各Nodeについて別のプロセスで実行し、結果をNodeの順に返します。
+
+        funcはpickleできる関数で、Nodeの内容を :class:`.NodeData` として受け取ります。
+        詳しくは :meth:`.ProcessPool.map_nodes` を見てください。
+        """
+        return await self.owner.processes.map_nodes(func,nodes,chunksize)
 
     #
     # interface that must be overriden
@@ -169,9 +198,7 @@ class Service(InRepository):
         """
         ノードに対するサービスのパスが変更されたとき呼ばれます。
 
-        実際に移動する処理をします。
+        実際に移動する処理をします。移動は :class:`.MovePlan` にまとめて :attr:`.Repository.mover` で実行します。
         """
-        for node,dest in args:
-            src=node.node_service_path[self]
-            if src!=dest:
-                src.rename(dest)
\ No newline at end of file
+        plan=MovePlan((node.node_service_path[self],dest) for node,dest in args)
+        await self.owner.mover.run(plan)
\ No newline at end of file
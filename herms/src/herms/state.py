@@ -58,13 +58,16 @@ class State(InRepository):
         }
     }
 
-    description:str=""
+    __slots__=("description","condition","transitions","services","lifecycle")
+    description:str
     condition:Query
     transitions:dict[State,Transition]
     services:dict[Service,str]
-    lifecycle:bool|None=None
+    lifecycle:bool|None
 
     def __init__(self):
+        self.description=""
+        self.lifecycle=None
         self.condition=Query()
         self.transitions={}
         self.services={}
@@ -106,6 +109,7 @@ class State(InRepository):
                         self.services[self.owner.services[s]]=val
 
 class Transition:
+    __slots__=("auto","condition","fromstate","tostate")
     auto:bool
     condition:Query
     fromstate:State
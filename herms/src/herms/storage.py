@@ -0,0 +1,530 @@
+"""
+:class:`.Node` の設定を保存する場所(ストレージ)を提供します。
+
+:class:`.Repository` は、Nodeの読み込みと保存を :class:`Storage` を通して行います。
+ストレージはRepositoryの設定の ``storage`` で指定します。
+
+* ``file`` : Nodeごとに1つのYAMLまたはJSONファイルに保存します(デフォルト)
+* ``sqlite`` : 1つのSQLiteデータベースに保存します
+
+ストレージ間でNodeを移すには :func:`copy_nodes` を使います。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, ClassVar, TypedDict, cast
+
+from .config import DirectorySnapshot, Json, JsonObject, JsonSchema, is_config_file, read_config_file, write_config_file
+from .loader import find_class
+
+if TYPE_CHECKING:
+    from .changefeed import ChangeFeed
+    from .journal import Journal
+    from .node import Node
+    from .repository import Repository
+
+logger = logging.getLogger(__name__)
+
+type NodeDocument = tuple[str, str, JsonObject]
+"""NodeType名、Node名、Nodeの設定オブジェクトの組です。"""
+
+type NodeKey = tuple[str, str]
+"""NodeType名とNode名の組です。"""
+
+
+class StorageConfig(TypedDict, total=False):
+    type: str
+    path: str
+
+
+class Storage(ABC):
+    """Nodeの設定を保存する場所です。"""
+
+    CONFIG_SCHEMA: ClassVar[JsonSchema] = {
+        "anyOf": [
+            {"type": "string"},
+            {"type": "object",
+             "properties": {
+                 "type": {"type": "string"},
+                 "path": {"type": "string"}
+             },
+             "required": ["type"]}
+        ]
+    }
+
+    repo: Repository
+
+    def __init__(self, repo: Repository):
+        self.repo = repo
+
+    def configure(self, data: StorageConfig) -> None:
+        """設定を適用します。"""
+        _ = data
+
+    @abstractmethod
+    def load(self) -> Iterable[NodeDocument]:
+        """すべてのNodeの設定を読み込みます。"""
+        ...
+
+    @abstractmethod
+    def load_node(self, type: str, name: str) -> JsonObject | None:
+        """1つのNodeの設定を読み込みます。存在しない場合はNoneを返します。"""
+        ...
+
+    @abstractmethod
+    def save(self, docs: Iterable[NodeDocument]) -> None:
+        """Nodeの設定を保存します。"""
+        ...
+
+    @abstractmethod
+    def delete(self, keys: Iterable[NodeKey]) -> None:
+        """Nodeの設定を削除します。"""
+        ...
+
+    def node_of_file(self, file: Path) -> NodeKey | None:
+        """ファイルのパスから、そのファイルに保存されているNodeを返します。
+
+        ファイルとNodeが対応しないストレージではNoneを返します。
+        """
+        return None
+
+    def prepare(self, docs: list[NodeDocument], keys: list[NodeKey]) -> Callable[[], None]:
+        """keysの削除とdocsの保存を行う関数を返します。
+
+        :class:`WriteBuffer` は、このメソッドをイベントループのスレッドで呼び、返された関数を書き込み用のスレッドで呼びます。
+        """
+        def write() -> None:
+            if keys:
+                self.delete(keys)
+            if docs:
+                self.save(docs)
+        return write
+
+    def close(self) -> None:
+        """ストレージを閉じます。"""
+        pass
+
+
+class FileStorage(Storage):
+    """Nodeごとに1つの設定ファイルに保存します。
+
+    設定ファイルは、``config_dir/<type>/<node>.yaml`` または ``config_dir/<type>/<node>/<type>.yaml``
+    に置かれます。拡張子は .json, .yaml, .yml のいずれかです。
+
+    ファイルの存在の確認には :attr:`.Repository.snapshot` を使います。
+    """
+
+    root: Path
+
+    def __init__(self, repo: Repository):
+        super().__init__(repo)
+        self.root = repo.config_dir
+
+    def configure(self, data: StorageConfig) -> None:
+        if "path" in data:
+            self.root = self.repo.config_dir / data["path"]
+
+    @property
+    def snapshot(self) -> DirectorySnapshot:
+        return self.repo.snapshot
+
+    def node_file(self, type: str, name: str) -> Path | None:
+        """Nodeの設定ファイルを返します。存在しない場合はNoneを返します。"""
+        path = self.root / type / name
+        file = self.snapshot.config_file_of(path)
+        if file is None and self.snapshot.is_dir(path):
+            file = self.snapshot.config_file_of(path / type)
+        return file
+
+    def node_of_file(self, file: Path) -> NodeKey | None:
+        try:
+            parts = file.resolve().relative_to(self.root.resolve()).parts
+        except ValueError:
+            return None
+        if not is_config_file(Path(parts[-1])):
+            return None
+        if len(parts) == 2:
+            return parts[0], Path(parts[1]).stem
+        elif len(parts) == 3 and Path(parts[2]).stem == parts[0]:
+            return parts[0], Path(parts[1]).stem
+        else:
+            return None
+
+    def load(self) -> Iterable[NodeDocument]:
+        snapshot = self.snapshot
+        for typename in self.repo.types.keys():
+            path = self.root / typename
+            for entry, is_dir in snapshot.entries(path).items():
+                p = path / entry
+                file: Path | None = None
+                if is_dir:
+                    file = snapshot.config_file_of(p / typename)
+                elif is_config_file(p):
+                    file = p
+                if file is not None:
+                    yield typename, p.stem, cast(JsonObject, read_config_file(file, {}))
+
+    def load_node(self, type: str, name: str) -> JsonObject | None:
+        file = self.node_file(type, name)
+        if file is None:
+            return None
+        return cast(JsonObject, read_config_file(file, {}))
+
+    def save(self, docs: Iterable[NodeDocument]) -> None:
+        self.prepare(list(docs), [])()
+
+    def delete(self, keys: Iterable[NodeKey]) -> None:
+        self.prepare([], list(keys))()
+
+    def prepare(self, docs: list[NodeDocument], keys: list[NodeKey]) -> Callable[[], None]:
+        # スナップショットはこのスレッドで更新し、書き込み用のスレッドではファイルだけを扱う
+        snapshot = self.snapshot
+        removes: list[Path] = []
+        for type, name in keys:
+            file = self.node_file(type, name)
+            if file is not None:
+                snapshot.remove(file)
+                removes.append(file)
+        writes: list[tuple[Path, JsonObject, bool]] = []
+        for type, name, doc in docs:
+            file = self.node_file(type, name)
+            created = file is None
+            if file is None:
+                file = (self.root / type / name).with_suffix(".yaml")
+                if not snapshot.is_dir(file.parent):
+                    snapshot.add(file.parent, True)
+                snapshot.add(file)
+            writes.append((file, doc, created))
+
+        def write() -> None:
+            for file in removes:
+                file.unlink(missing_ok=True)
+            for file, doc, created in writes:
+                if created:
+                    file.parent.mkdir(parents=True, exist_ok=True)
+                write_config_file(file, doc)
+        return write
+
+
+class SqliteStorage(Storage):
+    """1つのSQLiteデータベースに保存します。
+
+    Nodeの設定はJSONとして ``nodes`` テーブルに保存されます。
+    状態、タグ、スカラー値のプロパティは、それぞれインデックスのついた列にも保存されます。
+    読み込みと書き込みは、まとめて1つのトランザクションで行います。
+    """
+    DEFAULT_PATH = "nodes.db"
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes(
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT,
+    doc TEXT NOT NULL,
+    PRIMARY KEY(type, name));
+CREATE INDEX IF NOT EXISTS nodes_state ON nodes(state);
+CREATE TABLE IF NOT EXISTS node_tags(
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    tag TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS node_tags_tag ON node_tags(tag);
+CREATE INDEX IF NOT EXISTS node_tags_node ON node_tags(type, name);
+CREATE TABLE IF NOT EXISTS node_props(
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    prop TEXT NOT NULL,
+    value);
+CREATE INDEX IF NOT EXISTS node_props_value ON node_props(prop, value);
+CREATE INDEX IF NOT EXISTS node_props_node ON node_props(type, name);
+"""
+
+    path: Path
+    _conn: sqlite3.Connection | None = None
+
+    def __init__(self, repo: Repository):
+        super().__init__(repo)
+        self.path = repo.config_dir / self.DEFAULT_PATH
+        self._lock = threading.Lock()
+
+    def configure(self, data: StorageConfig) -> None:
+        if "path" in data:
+            self.path = self.repo.config_dir / data["path"]
+
+    def connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def load(self) -> Iterable[NodeDocument]:
+        with self._lock:
+            rows = self.connection().execute("SELECT type, name, doc FROM nodes").fetchall()
+        for type, name, doc in rows:
+            yield type, name, json.loads(doc)
+
+    def load_node(self, type: str, name: str) -> JsonObject | None:
+        with self._lock:
+            row = self.connection().execute(
+                "SELECT doc FROM nodes WHERE type=? AND name=?", (type, name)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(self, docs: Iterable[NodeDocument]) -> None:
+        nodes: list[tuple[str, str, Json, str]] = []
+        tags: list[tuple[str, str, str]] = []
+        props: list[tuple[str, str, str, Json]] = []
+        for type, name, doc in docs:
+            nodes.append((type, name, doc.get("state"), json.dumps(doc)))
+            for tag in cast(list[str], doc.get("tags", [])):
+                tags.append((type, name, tag))
+            for prop, val in cast(JsonObject, doc.get("properties", {})).items():
+                for v in val if isinstance(val, list) else [val]:
+                    if isinstance(v, (str, int, float, bool)):
+                        props.append((type, name, prop, v))
+        if not nodes:
+            return
+        keys = [(x[0], x[1]) for x in nodes]
+        with self._lock, self.connection() as conn:
+            conn.executemany("DELETE FROM node_tags WHERE type=? AND name=?", keys)
+            conn.executemany("DELETE FROM node_props WHERE type=? AND name=?", keys)
+            conn.executemany("INSERT OR REPLACE INTO nodes VALUES (?,?,?,?)", nodes)
+            conn.executemany("INSERT INTO node_tags VALUES (?,?,?)", tags)
+            conn.executemany("INSERT INTO node_props VALUES (?,?,?,?)", props)
+
+    def delete(self, keys: Iterable[NodeKey]) -> None:
+        keys = list(keys)
+        with self._lock, self.connection() as conn:
+            for table in ("nodes", "node_tags", "node_props"):
+                conn.executemany(f"DELETE FROM {table} WHERE type=? AND name=?", keys)
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+STORAGE_TYPES: dict[str, type[Storage]] = {
+    "file": FileStorage,
+    "sqlite": SqliteStorage,
+}
+
+
+def create_storage(repo: Repository, config: str | StorageConfig | None) -> Storage:
+    """設定にしたがってストレージを作成します。
+
+    型の名前には、``file`` や ``sqlite`` のほか、``MODULE.CLASS`` の形式でクラスを指定できます。
+    """
+    if config is None:
+        config = {"type": "file"}
+    elif isinstance(config, str):
+        config = {"type": config}
+    typename = config.get("type", "file")
+    cls = STORAGE_TYPES.get(typename)
+    if cls is None:
+        found = find_class(typename, object)
+        if not (isinstance(found, type) and issubclass(found, Storage)):
+            raise ValueError(f"{typename}: Not a storage class.")
+        cls = found
+    storage = cls(repo)
+    storage.configure(config)
+    return storage
+
+
+def register(name: str, cls: type[Storage]) -> None:
+    STORAGE_TYPES[name] = cls
+
+
+class WriteBuffer:
+    """Nodeの保存をまとめて、バックグラウンドで書き込みます。
+
+    :meth:`add` で渡されたNodeのうち、変更のあったもの(:attr:`.Node.dirty`)だけがバッファに入ります。
+    同じNodeが何度追加されても、:meth:`flush` で書き込まれるのは1回だけです。
+    書き込みはスレッドで行われます。同じNodeの書き込みは常に同じスレッドで行われるため、順序が入れ替わることはありません。
+
+    :class:`.Journal` を指定した場合、:meth:`flush` はジャーナルに追記するだけです。
+    ストレージへの書き込みは、ジャーナルにたまった変更が :attr:`checkpoint_size` を超えたときか、
+    :meth:`checkpoint` や :meth:`wait` のときにまとめて行われます。
+    :class:`.Repository` は、一連の処理が終わるたびに :meth:`checkpoint` を呼びます。
+
+    :class:`.ChangeFeed` を指定した場合、ストレージへの書き込みが終わったNodeをそこに記録します。
+    他のプロセスが記録を読んだときには、ストレージから新しい内容を読み込めます。
+    """
+
+    storage: Storage
+    journal: Journal | None
+    feed: ChangeFeed | None
+    checkpoint_size: int
+    """チェックポイントを行う、ストレージに書き込んでいない変更の数"""
+    _pending: dict[Node, None]
+    _deleted: dict[NodeKey, None]
+    _unsaved: dict[NodeKey, JsonObject | None]
+    """ジャーナルに記録し、まだストレージへの書き込みが終わっていない変更"""
+    _workers: int
+    _executors: list[ThreadPoolExecutor] | None
+    _futures: set[Future[None]]
+    _lock: threading.Lock
+
+    def __init__(self, storage: Storage, workers: int = 4, journal: Journal | None = None, checkpoint_size: int = 1000,
+                 feed: ChangeFeed | None = None):
+        self.storage = storage
+        self.journal = journal
+        self.feed = feed
+        self.checkpoint_size = checkpoint_size
+        self._pending = {}
+        self._deleted = {}
+        self._unsaved = {}
+        self._workers = workers
+        self._executors = None
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def add(self, *nodes: Node) -> None:
+        """Nodeを書き込み待ちにします。"""
+        for node in nodes:
+            if node.dirty:
+                self._pending[node] = None
+
+    def delete(self, *nodes: Node) -> None:
+        """Nodeを削除待ちにします。"""
+        for node in nodes:
+            self._pending.pop(node, None)
+            self._deleted[(node.type.name, node.name)] = None
+
+    def discard(self, *nodes: Node) -> None:
+        """Nodeを書き込み待ちと削除待ちから外します。"""
+        for node in nodes:
+            self._pending.pop(node, None)
+            self._deleted.pop((node.type.name, node.name), None)
+
+    def flush(self) -> None:
+        """書き込み待ちのNodeの書き込みを開始します。書き込みの終了は待ちません。"""
+        if not self._pending and not self._deleted:
+            return
+        changes: list[tuple[str, str, JsonObject | None]] = [(t, n, None) for t, n in self._deleted]
+        for node in self._pending:
+            changes.append((node.type.name, node.name, cast(JsonObject, node.dump())))
+            node.dirty = False
+        self._pending.clear()
+        self._deleted.clear()
+        if self.journal is None:
+            self._submit(changes)
+        else:
+            self._journal(changes)
+
+    def _journal(self, changes: list[tuple[str, str, JsonObject | None]]) -> None:
+        assert self.journal is not None
+        self.journal.append(changes)
+        with self._lock:
+            for t, n, doc in changes:
+                self._unsaved[(t, n)] = doc
+            full = len(self._unsaved) >= self.checkpoint_size
+        if full:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """ジャーナルに記録した変更の、ストレージへの書き込みを開始します。
+
+        書き込みが終わった変更だけが、ジャーナルから取り除かれます。
+        書き込みに失敗した変更は残り、次のチェックポイントで書き込み直されます。
+        """
+        if self.journal is None:
+            return
+        with self._lock:
+            if not self._unsaved:
+                return
+            changes = [(t, n, doc) for (t, n), doc in self._unsaved.items()]
+        journal = self.journal
+        seq = journal.seq
+        submitted = self._submit(changes)
+        remaining = len(submitted)
+        failed = False
+
+        def _done(future: Future[None], shard: list[tuple[str, str, JsonObject | None]]) -> None:
+            nonlocal remaining, failed
+            with self._lock:
+                if future.exception() is None:
+                    for t, n, doc in shard:
+                        # 書き込んでいる間に、さらに変更されたものは残す
+                        if (t, n) in self._unsaved and self._unsaved[(t, n)] is doc:
+                            del self._unsaved[(t, n)]
+                else:
+                    failed = True
+                remaining -= 1
+                if remaining == 0 and not failed:
+                    journal.truncate(seq)
+        for future, shard in submitted:
+            future.add_done_callback(functools.partial(_done, shard=shard))
+
+    def _submit(self, changes: list[tuple[str, str, JsonObject | None]]
+                ) -> list[tuple[Future[None], list[tuple[str, str, JsonObject | None]]]]:
+        if self._executors is None:
+            self._executors = [ThreadPoolExecutor(1, thread_name_prefix="herms-writer") for _ in range(self._workers)]
+        shards: list[list[tuple[str, str, JsonObject | None]]] = [[] for _ in self._executors]
+        for change in changes:
+            shards[zlib.crc32(f"{change[0]}\0{change[1]}".encode()) % len(shards)].append(change)
+        ret: list[tuple[Future[None], list[tuple[str, str, JsonObject | None]]]] = []
+        for executor, shard in zip(self._executors, shards):
+            if shard:
+                docs = [(t, n, doc) for t, n, doc in shard if doc is not None]
+                keys = [(t, n) for t, n, doc in shard if doc is None]
+                future = executor.submit(self._write, self.storage.prepare(docs, keys), shard)
+                self._futures.add(future)
+                future.add_done_callback(self._done)
+                ret.append((future, shard))
+        return ret
+
+    def _write(self, write: Callable[[], None], changes: list[tuple[str, str, JsonObject | None]]) -> None:
+        write()
+        if self.feed is not None:
+            self.feed.record(((t, n), doc is None) for t, n, doc in changes)
+
+    def _done(self, future: Future[None]) -> None:
+        self._futures.discard(future)
+        e = future.exception()
+        if e is not None:
+            logger.error("failed to save nodes", exc_info=e)
+
+    async def wait(self) -> None:
+        """書き込み待ちのNodeをすべて書き込み、終了を待ちます。"""
+        self.flush()
+        self.checkpoint()
+        futures = list(self._futures)
+        if futures:
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+
+    def close(self) -> None:
+        """すべての書き込みを終えて、スレッドを終了します。
+
+        閉じた後に書き込んだ場合は、スレッドを作り直します。
+        """
+        self.flush()
+        self.checkpoint()
+        if self._executors is not None:
+            for executor in self._executors:
+                executor.shutdown(wait=True)
+            self._executors = None
+        if self.journal is not None:
+            self.journal.close()
+
+
+def copy_nodes(src: Storage, dest: Storage) -> int:
+    """srcのすべてのNodeをdestに保存します。
+
+    保存したNodeの数を返します。
+    """
+    docs = list(src.load())
+    dest.save(docs)
+    return len(docs)
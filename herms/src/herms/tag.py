@@ -28,14 +28,21 @@ class Tag(InRepository):
         }
     }
 
-    index: int = 0
-    abstract: bool = False
-    expression: str | None = None
-    _query:Query|None=None
-    parent: Tag | None = None
+    __slots__=("description","index","abstract","expression","_query","parent","children")
+    index: int
+    abstract: bool
+    expression: str | None
+    _query:Query|None
+    parent: Tag | None
     children: dict[str, Tag]
 
     def __init__(self):
+        self.description = ""
+        self.index = 0
+        self.abstract = False
+        self.expression = None
+        self._query = None
+        self.parent = None
         self.children = {}
 
     def __str__(self) -> str:
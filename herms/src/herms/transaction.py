@@ -0,0 +1,122 @@
+"""
+:meth:`.Repository.transaction` で行われる変更をまとめ、失敗したときに元に戻します。
+
+Nodeの内容(プロパティ、タグ、状態、説明、サービスの設定)が最初に変更される直前に、その内容を記録します。
+取り消すときは、記録した内容に戻します。参照の逆引きは :meth:`.Node.set_prop` を通して戻されます。
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+
+from .columns import PropertyView
+
+if TYPE_CHECKING:
+    from .node import Node
+    from .nodetype import Property
+    from .repository import Repository
+    from .service import Service
+    from .state import State
+    from .tag import Tag
+    from .transition import Field
+
+
+class NodeRecord:
+    """変更前のNodeの内容です。"""
+    __slots__ = ("state", "description", "tags", "properties", "service_configs", "dirty")
+    state: State | None
+    description: str
+    tags: list[Tag]
+    properties: dict[Property, Any]
+    service_configs: dict[Service, Any]
+    dirty: bool
+
+    def __init__(self, node: Node):
+        self.state = getattr(node, "_state", None)
+        self.description = node.description
+        self.tags = list(node.tags)
+        self.properties = {p: list(v) if isinstance(v, list) else v for p, v in node.properties.items()}
+        self.service_configs = dict(node.service_configs)
+        self.dirty = node.dirty
+
+    def restore(self, node: Node) -> None:
+        props = node.properties
+        for prop in node.type.properties.values():
+            old = self.properties.get(prop)
+            if props.get(prop) != old:
+                node.set_prop(prop, old if old is not None else [] if prop.list else None)
+            if prop not in self.properties and prop in props:
+                del props[prop]
+        node.tags[:] = self.tags
+        node.service_configs = self.service_configs
+        if self.state is not None:
+            node._state = self.state
+        node._description = self.description
+        node._fingerprint = None
+        node.owner.merkle.touch(node)
+        node.dirty = self.dirty
+
+
+class Transaction:
+    """一連の変更です。"""
+    repo: Repository
+    records: dict[Node, NodeRecord]
+    """変更されたNodeの変更前の内容"""
+    added: list[Node]
+    """追加されたNode"""
+    removed: list[tuple[Node, list[tuple[Property, Node]]]]
+    """削除されたNodeと、そのNodeを参照していたプロパティとNode"""
+    modified: dict[Node, None]
+    """:meth:`.Repository.modified` が呼ばれたNode"""
+    changes: dict[Node, set[Field] | None]
+    committing: bool
+
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.records = {}
+        self.added = []
+        self.removed = []
+        self.modified = {}
+        self.changes = {k: None if v is None else set(v) for k, v in repo.changes.items()}
+        self.committing = False
+
+    def record(self, node: Node) -> None:
+        """Nodeが変更される前に呼ばれます。"""
+        if node not in self.records:
+            self.records[node] = NodeRecord(node)
+
+    def remove(self, node: Node) -> None:
+        """Nodeが削除される前に呼ばれます。"""
+        self.record(node)
+        self.removed.append((node, self.repo.refs.referrers(node)))
+
+    def nodes(self) -> list[Node]:
+        """変更されたNodeを返します。"""
+        ret = dict(self.modified)
+        ret.update((n, None) for n in self.added)
+        ret.update((n, None) for n in self.records)
+        return list(ret)
+
+    def rollback(self) -> None:
+        """変更を取り消します。追加されたNodeは削除され、削除されたNodeは元に戻ります。"""
+        repo = self.repo
+        added = set(self.added)
+        removed = {n: refs for n, refs in self.removed}
+        for node in reversed(self.added):
+            if node in removed:
+                del removed[node]
+            else:
+                repo.discard_node(node)
+        for node in removed:
+            # 削除したときに行が解放されているので、割り当て直す
+            node.id = node.type.store.alloc(node)
+            node._properties = PropertyView(node.type.store, node.id)
+            repo.nodes.add(node)
+            repo.merkle.add(node)
+        for node, rec in self.records.items():
+            if node not in added:
+                rec.restore(node)
+        repo.refs.build((prop, node, source) for node, refs in removed.items() for prop, source in refs)
+        repo.changes = self.changes
+        repo.writer.discard(*added, *removed, *(n for n, rec in self.records.items() if not rec.dirty))
+        repo.writer.add(*removed)
@@ -0,0 +1,188 @@
+"""
+状態遷移の条件を解析し、変更のあったNodeについて必要な遷移だけを調べます。
+
+遷移の条件が読み取る値を :data:`Field` として求めておきます。
+Nodeが変更されると、変更された :data:`Field` が :attr:`.Repository.changes` に記録されます。
+自動遷移を調べるときは、記録された変更から、条件の値が変わりうるNodeと遷移だけを調べます。
+条件が他のNodeを参照している場合は、参照を逆にたどって、影響を受けるNodeを求めます。
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterable, Mapping
+from typing import TYPE_CHECKING, cast
+
+from .nodetype import Property
+from .query import ApplyExpr, Executor, Expression, LogicalExpr, NameExpr, Props, RelExpr, StateExpr
+
+if TYPE_CHECKING:
+    from .node import Node
+    from .repository import Repository
+    from .state import State, Transition
+
+type Field = str | Property | tuple[bool, Property]
+"""Nodeの値の種類です。
+
+* ``"state"``: 状態
+* ``"tags"``: タグ
+* :class:`.Property`: プロパティの値
+* ``(True, prop)``: propによって参照しているNode
+"""
+
+type Hop = tuple[bool, Property]
+type Dependency = tuple[tuple[Hop, ...], Field]
+"""条件が読み取る値です。Nodeからプロパティをたどった先のNodeの :data:`Field` を表します。"""
+
+
+def dependencies(expr: Expression) -> set[Dependency]:
+    """条件が読み取る値を返します。"""
+    ret: set[Dependency] = set()
+    _dependencies(expr, (), ret)
+    return ret
+
+
+def _dependencies(expr: Expression, prefix: tuple[Hop, ...], out: set[Dependency]) -> None:
+    if isinstance(expr, LogicalExpr):
+        for x in expr.args:
+            _dependencies(x, prefix, out)
+    elif isinstance(expr, StateExpr):
+        out.add((prefix, "state"))
+    elif isinstance(expr, NameExpr):
+        # 名前はNode、状態、タグのいずれかに解決される
+        out.add((prefix, "state"))
+        out.add((prefix, "tags"))
+    elif isinstance(expr, RelExpr):
+        _paths(expr.props, prefix, out)
+    elif isinstance(expr, ApplyExpr):
+        for path in _paths(expr.props, prefix, out):
+            _dependencies(expr.condition, path, out)
+
+
+def _paths(props: Props, prefix: tuple[Hop, ...], out: set[Dependency]) -> list[tuple[Hop, ...]]:
+    paths = [prefix]
+    for rev, p in props.props:
+        plist = [p] if isinstance(p, Property) else list(p.values())
+        newpaths: list[tuple[Hop, ...]] = []
+        for path in paths:
+            for prop in plist:
+                out.add((path, (True, prop) if rev else prop))
+                newpaths.append(path + ((rev, prop),))
+        paths = newpaths
+    return paths
+
+
+def referrers(node: Node, hops: tuple[Hop, ...]) -> list[Node]:
+    """hopsをたどるとnodeに達するNodeを返します。"""
+    nodes = [node]
+    for rev, prop in reversed(hops):
+        nxt: list[Node] = []
+        for n in nodes:
+            if rev:
+                if n.type is not prop.owner:
+                    continue
+                val = n.properties.get(prop)
+                if val is None:
+                    continue
+                if prop.list:
+                    nxt.extend(cast(list["Node"], val))
+                else:
+                    nxt.append(cast("Node", val))
+            else:
+                nxt.extend(n.referrers(prop))
+        nodes = nxt
+    return nodes
+
+
+class CompiledTransition:
+    """条件をExecutorにした遷移です。"""
+    __slots__ = ("transition", "executor", "dependencies")
+    transition: Transition
+    executor: Executor
+    dependencies: set[Dependency]
+
+    def __init__(self, transition: Transition, repo: Repository):
+        self.transition = transition
+        self.executor = transition.condition.apply(repo.query_interface)
+        self.dependencies = dependencies(transition.condition.expr)
+
+    def match(self, node: Node) -> bool:
+        return self.executor.match(node)
+
+
+type Candidates = dict[Node, set[CompiledTransition] | None]
+
+
+class TransitionTable:
+    """Repositoryの遷移を、状態ごとにまとめて変換したものです。
+
+    RepositoryのNodeTypeや状態が変わるまで使い回されます。
+    """
+    transitions: dict[State, dict[State, CompiledTransition]]
+    """遷移元と遷移先の状態ごとの遷移"""
+    auto: dict[State, list[CompiledTransition]]
+    """遷移元の状態ごとの自動遷移"""
+    readers: dict[Field, list[tuple[CompiledTransition, tuple[Hop, ...]]]]
+    """値を読み取る自動遷移と、その値に達するまでのプロパティ"""
+    fields: set[Field]
+    """自動遷移が読み取る値"""
+
+    def __init__(self, repo: Repository):
+        self.transitions = {}
+        self.auto = {}
+        self.readers = {}
+        for state in repo.states.values():
+            trs: dict[State, CompiledTransition] = {}
+            for tostate, tr in state.transitions.items():
+                ct = CompiledTransition(tr, repo)
+                trs[tostate] = ct
+                if tr.auto:
+                    self.auto.setdefault(state, []).append(ct)
+                    for hops, field in ct.dependencies:
+                        self.readers.setdefault(field, []).append((ct, hops))
+            self.transitions[state] = trs
+        self.fields = set(self.readers)
+        if self.auto:
+            # 状態が変わったNodeは、新しい状態の自動遷移をすべて調べる
+            self.fields.add("state")
+
+    def candidates(self, changes: Mapping[Node, set[Field] | None]) -> Candidates:
+        """変更から、調べるべきNodeと自動遷移を求めます。
+
+        変更された値がNoneのNodeは、すべての値が変わったものとして扱います。
+        結果の遷移がNoneのNodeは、すべての自動遷移を調べます。
+        """
+        ret: Candidates = {}
+        for node, fields in changes.items():
+            if fields is None or "state" in fields:
+                ret[node] = None
+            if fields is None:
+                readers: Iterable[tuple[CompiledTransition, tuple[Hop, ...]]] = (
+                    x for lst in self.readers.values() for x in lst)
+            else:
+                readers = (x for f in fields for x in self.readers.get(f, ()))
+            for ct, hops in readers:
+                for n in referrers(node, hops) if hops else (node,):
+                    if n.state is not ct.transition.fromstate:
+                        continue
+                    if n in ret:
+                        trs = ret[n]
+                        if trs is not None:
+                            trs.add(ct)
+                    else:
+                        ret[n] = {ct}
+        return ret
+
+    def next_state(self, node: Node, transitions: set[CompiledTransition] | None = None) -> State | None:
+        """自動遷移の条件を満たした遷移先を返します。
+
+        transitionsを指定した場合は、その中の遷移だけを調べます。
+        """
+        for ct in self.auto.get(node.state, ()):
+            if (transitions is None or ct in transitions) and ct.match(node):
+                return ct.transition.tostate
+        return None
+
+    def can_transit(self, node: Node, state: State) -> bool:
+        """nodeがstateに遷移できるかどうかを返します。"""
+        ct = self.transitions.get(node.state, {}).get(state)
+        return ct is not None and ct.match(node)
@@ -0,0 +1,235 @@
+"""
+ファイルの変更を監視する仕組みを提供します。
+
+Linuxではinotifyを使い、使えない環境ではファイルの更新時刻を定期的に調べます。
+:class:`RepositoryWatcher` は、変更されたファイルを :meth:`.Repository.reload` に渡して、
+変更のあった:class:`.Node`だけを読み込み直します。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .repository import Repository
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher(ABC):
+    """ディレクトリ以下のファイルの変更を監視します。"""
+
+    root: Path
+    delay: float
+    """変更をまとめるために待つ時間(秒)"""
+
+    def __init__(self, root: Path, delay: float = 0.1):
+        self.root = root
+        self.delay = delay
+
+    @abstractmethod
+    def changes(self) -> AsyncIterator[set[Path]]:
+        """変更のあったファイルの集合を、変更があるたびに返します。"""
+        ...
+
+    def close(self) -> None:
+        """監視を終了します。"""
+        pass
+
+
+class PollingWatcher(Watcher):
+    """ファイルの更新時刻を定期的に比較して変更を検出します。"""
+
+    interval: float
+    _files: dict[str, tuple[int, int]]
+
+    def __init__(self, root: Path, interval: float = 1.0, delay: float = 0.1):
+        super().__init__(root, delay)
+        self.interval = interval
+        self._files = self._scan()
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        ret: dict[str, tuple[int, int]] = {}
+        dirs = [str(self.root)]
+        while dirs:
+            try:
+                it = os.scandir(dirs.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        else:
+                            st = entry.stat()
+                            ret[entry.path] = (st.st_mtime_ns, st.st_size)
+                    except OSError:
+                        pass
+        return ret
+
+    async def changes(self) -> AsyncIterator[set[Path]]:
+        while True:
+            await asyncio.sleep(self.interval)
+            files = self._scan()
+            old = self._files
+            self._files = files
+            changed = {p for p, v in files.items() if old.get(p) != v}
+            changed.update(old.keys() - files.keys())
+            if changed:
+                yield {Path(x) for x in changed}
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_IN_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher(Watcher):
+    """inotifyを使ってファイルの変更を検出します。
+
+    Linux以外の環境では、作成時に :class:`OSError` を送出します。
+    """
+
+    _fd: int
+    _dirs: dict[int, Path]
+    _pending: set[Path]
+    _event: asyncio.Event | None = None
+
+    def __init__(self, root: Path, delay: float = 0.1):
+        super().__init__(root, delay)
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is not available on this platform.")
+        libname = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._fd = fd
+        self._dirs = {}
+        self._pending = set()
+        self._add_tree(root)
+
+    def _add_watch(self, dir: Path) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir), _IN_MASK)
+        if wd >= 0:
+            self._dirs[wd] = dir
+
+    def _add_tree(self, dir: Path) -> None:
+        self._add_watch(dir)
+        for p, dirs, files in os.walk(dir):
+            for d in dirs:
+                self._add_watch(Path(p) / d)
+            if dir != self.root:
+                self._pending.update(Path(p) / f for f in files)
+
+    def _read(self) -> None:
+        try:
+            buf = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed; rescanning %s", self.root)
+                for p, _, files in os.walk(self.root):
+                    self._pending.update(Path(p) / f for f in files)
+                continue
+            dir = self._dirs.get(wd)
+            if dir is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._dirs[wd]
+                continue
+            path = dir / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+            else:
+                self._pending.add(path)
+        if self._pending and self._event is not None:
+            self._event.set()
+
+    async def changes(self) -> AsyncIterator[set[Path]]:
+        loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        loop.add_reader(self._fd, self._read)
+        try:
+            while True:
+                await self._event.wait()
+                await asyncio.sleep(self.delay)
+                self._read()
+                self._event.clear()
+                changed = self._pending
+                self._pending = set()
+                if changed:
+                    yield changed
+        finally:
+            loop.remove_reader(self._fd)
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def create_watcher(root: Path, interval: float = 1.0) -> Watcher:
+    """利用できる最適な :class:`Watcher` を作成します。"""
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError) as e:
+        logger.info("inotify is not available (%s); using polling watcher.", e)
+        return PollingWatcher(root, interval)
+
+
+class RepositoryWatcher:
+    """:class:`.Repository` の設定ディレクトリを監視し、変更を反映します。"""
+
+    repo: Repository
+    watcher: Watcher
+    lock: asyncio.Lock | None
+    """指定した場合は、このロックを取ってから変更を反映します"""
+
+    def __init__(self, repo: Repository, watcher: Watcher | None = None, lock: asyncio.Lock | None = None):
+        self.repo = repo
+        if watcher is None:
+            watcher = create_watcher(repo.config_dir.resolve())
+        self.watcher = watcher
+        self.lock = lock
+
+    async def run(self) -> None:
+        """監視を開始します。キャンセルされるまで終了しません。"""
+        try:
+            async for files in self.watcher.changes():
+                try:
+                    if self.lock is None:
+                        await self.repo.reload(*files)
+                    else:
+                        async with self.lock:
+                            await self.repo.reload(*files)
+                except Exception:
+                    logger.exception("failed to reload %s", ", ".join(map(str, files)))
+        finally:
+            self.watcher.close()
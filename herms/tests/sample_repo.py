@@ -1,9 +1,11 @@
 
+from pathlib import Path
 from typing import cast
 from herms import Node, Repository
 from herms.config import JsonObject
 from herms.node import NodeConfig
 import pytest
+import yaml
 
 
 @pytest.fixture
@@ -77,3 +79,39 @@ def add_nodes(repo:Repository,config:dict[str,dict[str,NodeConfig]]):
             node=repo.node(name,type)
             assert node is not None
             node.configure(cast(JsonObject,cfg))
+
+FILE_REPO_CONFIG={
+    "types":{
+        "type1":{
+            "properties":{
+                "ref":{"type":"type2"},
+                "val":{"type":"int"}
+            }
+        },
+        "type2":{
+            "properties":{
+                "num":{"type":"int"}
+            }
+        }
+    },
+    "states":{
+        "s1":{},
+        "s2":{}
+    }
+}
+
+def write(path:Path,data:object):
+    path.parent.mkdir(parents=True,exist_ok=True)
+    with open(path,"w") as f:
+        yaml.safe_dump(data,f)
+
+@pytest.fixture
+def filerepo(tmp_path:Path):
+    config_dir=tmp_path / ".repository"
+    write(config_dir / "config.yaml",FILE_REPO_CONFIG)
+    write(config_dir / "type1" / "n11.yaml",{"state":"s1","properties":{"ref":"n21","val":1}})
+    write(config_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":10}})
+    write(config_dir / "type2" / "n22" / "type2.yaml",{"state":"s1","properties":{"num":20}})
+    repo=Repository()
+    repo.configure(str(config_dir))
+    yield repo
@@ -0,0 +1,67 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from herms import CliApp, Repository, handler
+from .sample_repo import FILE_REPO_CONFIG, filerepo, write
+
+_=filerepo
+
+
+@pytest.mark.parametrize("format,expected",[
+    ("jsonl",'{"name": "n11", "val": 1, "ref.num": 10, "~ref": []}\n'
+             '{"name": "n21", "val": null, "ref.num": null, "~ref": ["n11"]}\n'),
+    ("json",'[{"name": "n11", "val": 1, "ref.num": 10, "~ref": []},'
+            '{"name": "n21", "val": null, "ref.num": null, "~ref": ["n11"]}]\n'),
+    ("csv","name,val,ref.num,~ref\nn11,1,10,\nn21,,,n11\n"),
+    ("yaml","- name: n11\n  val: 1\n  ref.num: 10\n  ~ref: []\n"
+            "- name: n21\n  val: null\n  ref.num: null\n  ~ref:\n  - n11\n"),
+])
+def test_list(filerepo:Repository,tmp_path:Path,monkeypatch:pytest.MonkeyPatch,capsys:pytest.CaptureFixture[str],
+              format:str,expected:str):
+    monkeypatch.setattr(handler,"_functions",[])
+    app=CliApp()
+    app.configure({"repository":str(tmp_path / ".repository"),
+                   "args":["list","-f",format,"-p","val","-p","ref.num","-p","~ref","n11","|","n21"]})
+    app.run()
+    assert capsys.readouterr().out==expected
+
+    app.args=["list","-f",format,"num>100"]
+    app.run()
+    assert capsys.readouterr().out==("[]\n" if format in ("json","yaml") else "")
+
+def test_relocate_abort(filerepo:Repository,tmp_path:Path,monkeypatch:pytest.MonkeyPatch,
+                        capsys:pytest.CaptureFixture[str]):
+    monkeypatch.setattr(handler,"_functions",[])
+    a,b=tmp_path / "a",tmp_path / "b"
+    a.mkdir()
+    b.mkdir()
+    # 移動先があって続きを実行できない移動
+    mover=filerepo.mover
+    mover.path.parent.mkdir(parents=True,exist_ok=True)
+    mover.path.write_text(json.dumps({"moves":[[str(a),str(b)]],"deps":[[]]})+"\n")
+    app=CliApp()
+    app.configure({"repository":str(tmp_path / ".repository"),"args":["relocate","--abort","-f","json"]})
+    app.run()
+    assert json.loads(capsys.readouterr().out)==[[str(a),str(b)]]
+    assert not mover.path.exists()
+    app.args=["relocate","--resume"]
+    with pytest.raises(ValueError):
+        app.run()
+
+def test_diff(filerepo:Repository,tmp_path:Path,monkeypatch:pytest.MonkeyPatch,capsys:pytest.CaptureFixture[str]):
+    monkeypatch.setattr(handler,"_functions",[])
+    config=dict(FILE_REPO_CONFIG)
+    config["services"]={"remote":{"type":"herms.module.sync:SyncService","target":"tcp://127.0.0.1:1"}}
+    write(tmp_path / ".repository" / "config.yaml",config)
+    other_dir=tmp_path / "other" / ".repository"
+    write(other_dir / "config.yaml",FILE_REPO_CONFIG)
+    write(other_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":10}})
+    app=CliApp()
+    app.configure({"repository":str(tmp_path / ".repository"),"args":["diff","-f","json",str(other_dir)]})
+    app.run()
+    assert json.loads(capsys.readouterr().out)=={"added":[],"removed":["type1:n11","type2:n22"],"changed":[]}
+    app.args=["diff","remote"]
+    with pytest.raises(ValueError,match="remote"):
+        app.run()
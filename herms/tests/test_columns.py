@@ -0,0 +1,48 @@
+import sys
+
+from herms import Repository
+from herms.columns import ArrayColumn, ObjectColumn, StringColumn
+from .sample_repo import filerepo
+
+_=filerepo
+
+def test_node_store(filerepo:Repository):
+    type1=filerepo.types["type1"]
+    type2=filerepo.types["type2"]
+    val=type1.properties["val"]
+    ref=type1.properties["ref"]
+    assert isinstance(type1.store.columns[val],ArrayColumn)
+    assert isinstance(type1.store.columns[ref],ObjectColumn)
+    assert not hasattr(filerepo.node_or_error("n11"),"__dict__")
+
+    n11=filerepo.node_or_error("n11")
+    assert n11.properties[val]==1
+    assert dict(n11.properties)=={ref:filerepo.node_or_error("n21"),val:1}
+    n11.set_prop(val,None)
+    assert val not in n11.properties
+    # 整数でない値はオブジェクトの列に切り替わる
+    n11.set_prop(val,"x")
+    assert isinstance(type1.store.columns[val],ObjectColumn)
+    assert n11.properties[val]=="x"
+
+    n22=filerepo.node_or_error("n22")
+    row=n22.id
+    filerepo.remove_node(n22)
+    assert not type2.store.columns[type2.properties["num"]].has(row)
+    assert type2.store.alloc(n22)==row
+
+def test_string_column():
+    col=StringColumn(1)
+    col.set(0,"".join(["a","b"]))
+    assert col.get(0) is sys.intern("ab")
+
+def test_reference_index(filerepo:Repository):
+    ref=filerepo.types["type1"].properties["ref"]
+    n11=filerepo.node_or_error("n11")
+    n21=filerepo.node_or_error("n21")
+    n22=filerepo.node_or_error("n22")
+    n11.set_prop(ref,n22)
+    assert n21.referrers(ref)==[]
+    assert not filerepo.refs.referenced(n21)
+    assert n22.referrers(ref)==[n11]
+    assert [x.name for x in filerepo.query("type2 & ~ref{type1}").items()]==["n22"]
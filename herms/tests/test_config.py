@@ -0,0 +1,28 @@
+from pathlib import Path
+
+from herms.config import DirectorySnapshot
+
+
+def test_directory_snapshot(tmp_path:Path):
+    (tmp_path / "a.yaml").write_text("{}")
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "b.json").write_text("{}")
+    snapshot=DirectorySnapshot()
+
+    assert snapshot.entries(tmp_path)=={"a.yaml":False,"b":True}
+    assert snapshot.is_dir(tmp_path / "b")
+    assert snapshot.is_file(tmp_path / "a.yaml")
+    assert snapshot.config_file_of(tmp_path / "a")==tmp_path / "a.yaml"
+    assert snapshot.config_file_of(tmp_path / "b" / "b")==tmp_path / "b" / "b.json"
+    assert snapshot.config_file_of(tmp_path / "c") is None
+    assert snapshot.entries(tmp_path / "missing")=={}
+
+    # the snapshot is not updated until told so
+    (tmp_path / "c.yml").write_text("{}")
+    assert snapshot.config_file_of(tmp_path / "c") is None
+    snapshot.add(tmp_path / "c.yml")
+    assert snapshot.config_file_of(tmp_path / "c")==tmp_path / "c.yml"
+    snapshot.remove(tmp_path / "a.yaml")
+    assert not snapshot.exists(tmp_path / "a.yaml")
+    snapshot.forget(tmp_path)
+    assert snapshot.exists(tmp_path / "a.yaml")
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from herms import CliApp, client, handler
+from herms.client import request
+from herms.daemon import Daemon
+from .sample_repo import FILE_REPO_CONFIG, write
+
+
+def test_daemon(tmp_path:Path,monkeypatch:pytest.MonkeyPatch,capsys:pytest.CaptureFixture[str]):
+    monkeypatch.setattr(handler,"_functions",[])
+    config_dir=tmp_path / ".repository"
+    write(config_dir / "config.yaml",FILE_REPO_CONFIG)
+    write(config_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":10}})
+    app=CliApp()
+    app.configure({"repository":str(config_dir)})
+    sock=tmp_path / "herms.sock"
+
+    async def _():
+        async with app.repository.run():
+            daemon=Daemon(app,sock)
+            task=asyncio.create_task(daemon.serve())
+            while not sock.exists():
+                await asyncio.sleep(0.01)
+            assert await asyncio.to_thread(request,sock,{"argv":["list","-f","json"]})==0
+            # Repositoryは読み込んだまま使われる
+            write(config_dir / "type2" / "n22.yaml",{"state":"s1","properties":{"num":20}})
+            await app.repository.reload(config_dir / "type2" / "n22.yaml")
+            assert await asyncio.to_thread(request,sock,{"argv":["list","-f","json"]})==0
+            assert await asyncio.to_thread(request,sock,{"argv":["nosuchcommand"]})==2
+            # クライアントで指定したログのレベルで、ログもクライアントに送られる
+            argv=["storage","export","sqlite","export.db"]
+            assert await asyncio.to_thread(request,sock,{"argv":argv,"loglevel":logging.INFO})==0
+            assert await asyncio.to_thread(request,sock,{"argv":argv})==0
+            assert await asyncio.to_thread(request,sock,{"stop":True})==0
+            await task
+        assert not sock.exists()
+        assert request(sock,{"argv":["list"]}) is None
+    asyncio.run(_())
+    out,err=capsys.readouterr()
+    assert out=='["n21"]\n["n21","n22"]\n'
+    assert "invalid choice" in err
+    assert err.count("2 nodes copied.")==1
+
+def test_client_loglevel(monkeypatch:pytest.MonkeyPatch):
+    sent:list[dict[str,Any]]=[]
+    def _request(path:Path,msg:dict[str,Any]):
+        sent.append(msg)
+        return 0
+    monkeypatch.setattr(client,"request",_request)
+    assert client.main(["list"])==0
+    assert client.main(["-v","list"])==0
+    assert client.main(["-D","list"])==0
+    assert sent==[{"argv":["list"]},{"argv":["list"],"loglevel":logging.INFO},{"argv":["list"],"loglevel":logging.DEBUG}]
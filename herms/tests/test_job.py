@@ -0,0 +1,119 @@
+import asyncio
+import contextvars
+
+import pytest
+
+from herms.job import Job, JobRunner
+
+
+def test_priority():
+    async def main():
+        runner=JobRunner(workers=1)
+        order:list[str]=[]
+        gate=asyncio.Event()
+        async def first(job:Job[None]):
+            await gate.wait()
+        def make(name:str):
+            async def f(job:Job[None]):
+                order.append(name)
+            return f
+        runner.submit(first,"first")
+        await asyncio.sleep(0)
+        runner.submit(make("low"),"low",priority=10)
+        runner.submit(make("high"),"high",priority=-10)
+        runner.submit(make("mid"),"mid")
+        gate.set()
+        await runner.join()
+        await runner.close()
+        return order
+    assert asyncio.run(main())==["high","mid","low"]
+
+def test_cancel():
+    async def main():
+        runner=JobRunner(workers=1)
+        started=asyncio.Event()
+        async def forever(job:Job[None]):
+            started.set()
+            await asyncio.Event().wait()
+        async def quick(job:Job[int]):
+            return 1
+        running=runner.submit(forever,"running")
+        pending=runner.submit(quick,"pending")
+        await started.wait()
+        assert pending.cancel()
+        assert running.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await running
+        # ワーカーは止まらずに次のジョブを実行する
+        assert await runner.run(quick,"after")==1
+        await runner.close()
+        return running,pending
+    running,pending=asyncio.run(main())
+    assert running.state=="cancelled"
+    assert pending.state=="cancelled"
+    assert not pending.cancel()
+
+def test_failed():
+    async def main():
+        runner=JobRunner()
+        async def bad(job:Job[None]):
+            raise ValueError("bad")
+        job=runner.submit(bad,"bad")
+        await runner.join()
+        with pytest.raises(ValueError):
+            await job
+        await runner.close()
+        return runner
+    runner=asyncio.run(main())
+    assert [x.name for x in runner.failed()]==["bad"]
+    assert isinstance(runner.failed()[0].error,ValueError)
+
+def test_progress_and_nested():
+    async def main():
+        runner=JobRunner(workers=1)
+        events:list[tuple[str,str,float]]=[]
+        runner.listeners.append(lambda job:events.append((job.name,job.state,job.progress)))
+        async def child(job:Job[str]):
+            job.report(0.5,"half")
+            return job.parent.name if job.parent else ""
+        async def parent(job:Job[str]):
+            # ワーカーが1つでも、子のジョブはその場で実行される
+            return await runner.run(child,"child")
+        ret=await runner.run(parent,"parent")
+        await runner.close()
+        return ret,events
+    ret,events=asyncio.run(main())
+    assert ret=="parent"
+    assert ("child","running",0.5) in events
+    assert events[-1]==("parent","done",1.0)
+
+def test_context_and_waiter_cancel():
+    var:contextvars.ContextVar[str]=contextvars.ContextVar("test_job_var",default="none")
+    async def main():
+        runner=JobRunner(workers=1)
+        async def read(job:Job[str]):
+            return var.get()
+        async def submitter(value:str):
+            var.set(value)
+            return await runner.run(read,value)
+        # 各ジョブは、投入したタスクのコンテキストで実行される
+        assert await asyncio.gather(submitter("a"),submitter("b"))==["a","b"]
+
+        started=asyncio.Event()
+        stopped=asyncio.Event()
+        async def forever(job:Job[None]):
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                stopped.set()
+        caller=asyncio.create_task(runner.run(forever,"forever"))
+        await started.wait()
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        # 待っていたタスクが取り消されると、ジョブも止まる
+        await stopped.wait()
+        assert runner.history[0].state=="cancelled"
+        await runner.close()
+    asyncio.run(main())
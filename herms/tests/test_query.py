@@ -1,5 +1,9 @@
 from herms import Repository
-from herms.query import Query,QuerySelector
+from herms import repository_query
+from typing import cast
+from herms import Tag
+from herms.query import Guard,Query,QuerySelector
+from herms.repository_query import AndExecutor, RelExecutor, VectorAndExecutor, VectorRelExecutor
 from .sample_repo import add_nodes, repo
 import pytest
 
@@ -137,6 +141,36 @@ def test_query_logical(data:Repository):
     q=Query("type2 & !(num>11 & num<=13) | type3",data)
     assert [x.name for x in data.query(q).items()]==["n21","n25","n31","n32"]
 
+def test_query_vector(data:Repository):
+    pytest.importorskip("numpy")
+    assert isinstance(data.query("num>11"),VectorRelExecutor)
+    assert isinstance(data.query("text=text1"),AndExecutor)
+    ex=data.query("num>11 & num<=13")
+    assert isinstance(ex,AndExecutor) and isinstance(ex.first,VectorAndExecutor)
+    assert [x.name for x in ex.items()]==["n22","n23","n24"]
+    assert ex.len()==3
+    assert [x.name for x in data.query("num=10,14").items()]==["n21","n25"]
+    assert [x.name for x in data.query("num!=12").items()]==["n21","n24","n25"]
+
+    # 値が変わると、同じExecutorでも求め直される
+    big=data.query("num>13")
+    assert [x.name for x in big.items()]==["n25"]
+    data.node_or_error("n24").set_prop(data.types["type2"].properties["num"],14)
+    assert [x.name for x in big.items()]==["n24","n25"]
+    assert big.len()==2
+    data.node_or_error("n24").set_prop(data.types["type2"].properties["num"],13)
+
+    # 数値でない値が入った列はNodeごとの比較になる
+    data.node_or_error("n25").set_prop(data.types["type2"].properties["num"],"x")
+    assert [x.name for x in data.query("num=10,13").items()]==["n21","n24"]
+
+def test_query_scalar(data:Repository,monkeypatch:pytest.MonkeyPatch):
+    monkeypatch.setattr(repository_query,"np",None)
+    ex=Query("num>11 & num<=13",data).apply(data.query_interface)
+    assert isinstance(ex,AndExecutor) and not ex.first.iterable
+    assert all(type(x) is RelExecutor for x in [ex.first,*ex.args])
+    assert [x.name for x in data.query("num>11 & num<=13").items()]==["n22","n23","n24"]
+
 def test_query_selector(data:Repository):
     qs=QuerySelector(data,{"type1":"thisisType1","num>11 & num<=13":"num"},"None")
     f=qs.apply(data.query_interface)
@@ -150,4 +184,37 @@ def test_query_selector(data:Repository):
     for name,value in result.items():
         n=data.node(name,None)
         assert n is not None
-        assert f(n)==value
\ No newline at end of file
+        assert f(n)==value
+def test_query_selector_dispatch(data:Repository):
+    qs=QuerySelector(data,{"tag2 & num>12":"big","tag2":"tag2","s1 & type1":"s1","type2":"type2"},"None")
+    f=qs.apply(data.query_interface)
+    assert Query("tag2",data).apply(data.query_interface).guard()==Guard("tag",data.tag("tag2"),True)
+    assert Query("s1 & type1",data).apply(data.query_interface).guard()==Guard("type",data.types["type1"],False)
+    assert Query("num>12",data).apply(data.query_interface).guard() is None
+    result={
+        "n11":"s1",
+        "n12":"s1",
+        "n21":"type2",
+        "n22":"tag2",
+        "n31":"tag2",
+        "n32":"None",
+    }
+    for name,value in result.items():
+        assert f(data.node_or_error(name))==value
+
+    # タグや値が変わると、結果も変わる
+    n21=data.node_or_error("n21")
+    n21.add_tag(cast(Tag,data.tag("tag2")))
+    assert f(n21)=="tag2"
+    n22=data.node_or_error("n22")
+    n22.set_prop(data.types["type2"].properties["num"],13)
+    assert f(n22)=="big"
+
+def test_query_selector_base():
+    repo=Repository()
+    repo.configure({"types":{"base1":{},"derived":{"base":"base1"},"other":{}},"states":{"s1":{}}})
+    add_nodes(repo,{"base1":{"b1":{"state":"s1"}},"derived":{"d1":{"state":"s1"}},"other":{"o1":{"state":"s1"}}})
+    assert list(repo.types["derived"].ancestors())==[repo.types["derived"],repo.types["base1"]]
+    f=QuerySelector(repo,{"base1":"base"},"None").apply(repo.query_interface)
+    assert f(repo.node_or_error("d1"))=="base"
+    assert f(repo.node_or_error("o1"))=="None"
@@ -0,0 +1,443 @@
+import asyncio
+from collections.abc import Iterable
+from pathlib import Path
+from typing import cast
+
+import pytest
+
+from herms import Node, Repository, Service, handler
+from herms.datatype import ReferenceResolver
+from herms.mover import Move, MoveError, MovePlan, Mover
+from herms.offload import NodeData
+from herms.transition import CompiledTransition
+from herms.watcher import PollingWatcher, RepositoryWatcher, Watcher
+from .sample_repo import FILE_REPO_CONFIG, filerepo, write
+
+_=filerepo
+
+
+def test_load(filerepo:Repository):
+    n11=filerepo.node_or_error("n11")
+    n21=filerepo.node_or_error("n21")
+    ref=filerepo.types["type1"].properties["ref"]
+    assert n11.properties[ref]==n21
+    assert n21.referrers(ref)==[n11]
+    assert filerepo.node_or_error("n22").state.name=="s1"
+    assert not filerepo.refs.referenced(filerepo.node_or_error("n22"))
+
+def test_reference_resolver(filerepo:Repository):
+    resolver=ReferenceResolver(filerepo)
+    type1=filerepo.types["type1"]
+    resolver.collect(type1,{"properties":{"ref":"n22"},"tags":["t1"]})
+    resolver.collect(type1,{"properties":{"ref":"type2:n21"}})
+    resolver.resolve()
+    assert resolver.node("n22",type1.properties["ref"].type)==filerepo.node_or_error("n22")
+    assert resolver.node("type2:n21",type1.properties["ref"].type)==filerepo.node_or_error("n21")
+    assert resolver.node_tag("t1")==filerepo.tag("t1")
+
+def test_node_of_file(filerepo:Repository):
+    storage=filerepo.storage
+    assert storage.node_of_file(filerepo.config_dir / "type1" / "n11.yaml")==("type1","n11")
+    assert storage.node_of_file(filerepo.config_dir / "type2" / "n22" / "type2.yaml")==("type2","n22")
+    assert storage.node_of_file(filerepo.config_dir / "config.yaml") is None
+    assert storage.node_of_file(filerepo.config_dir / "type2" / "n22" / "other.yaml") is None
+
+def test_reload(filerepo:Repository):
+    config_dir=filerepo.config_dir
+    n11=filerepo.node_or_error("n11")
+    n21=filerepo.node_or_error("n21")
+    n22=filerepo.node_or_error("n22")
+    ref=filerepo.types["type1"].properties["ref"]
+
+    write(config_dir / "type1" / "n11.yaml",{"state":"s2","properties":{"ref":"n22","val":2}})
+    changed=asyncio.run(filerepo.reload(config_dir / "type1" / "n11.yaml", config_dir / "type2" / "n21.yaml"))
+    assert changed=={n11}
+    assert n11.state.name=="s2"
+    assert n11.properties[ref]==n22
+    assert n11 not in n21.referrers(ref)
+    assert n22.referrers(ref)==[n11]
+
+    # the file written back by modified() is not reloaded again
+    assert asyncio.run(filerepo.reload(config_dir / "type1" / "n11.yaml"))==set()
+
+def test_reload_add_remove(filerepo:Repository):
+    config_dir=filerepo.config_dir
+    write(config_dir / "type2" / "n23.yaml",{"state":"s1","properties":{"num":30}})
+    (config_dir / "type2" / "n21.yaml").unlink()
+    changed=asyncio.run(filerepo.reload(config_dir / "type2" / "n23.yaml", config_dir / "type2" / "n21.yaml"))
+    assert [x.name for x in changed]==["n23"]
+    assert filerepo.node("n21",None) is None
+    assert filerepo.node_or_error("n23").name=="n23"
+
+def test_polling_watcher(tmp_path:Path):
+    write(tmp_path / "a.yaml",{})
+    watcher=PollingWatcher(tmp_path,interval=0.01)
+
+    async def _():
+        it=watcher.changes()
+        write(tmp_path / "sub" / "b.yaml",{"x":1})
+        return await anext(it)
+    changed=asyncio.run(_())
+    assert changed=={tmp_path / "sub" / "b.yaml"}
+
+def test_watcher_lock(filerepo:Repository):
+    path=filerepo.config_dir / "type2" / "n22.yaml"
+    class OneShot(Watcher):
+        changed:asyncio.Event
+        async def changes(self):
+            self.changed.set()
+            yield {path}
+            await asyncio.Event().wait()
+
+    async def _():
+        lock=asyncio.Lock()
+        oneshot=OneShot(filerepo.config_dir)
+        oneshot.changed=asyncio.Event()
+        reloaded=asyncio.Event()
+        reload=filerepo.reload
+        async def _reload(*files:Path):
+            await reload(*files)
+            reloaded.set()
+        filerepo.reload=_reload  # type: ignore[method-assign]
+        watcher=RepositoryWatcher(filerepo,oneshot,lock=lock)
+        async with lock:
+            write(path,{"state":"s2"})
+            task=asyncio.create_task(watcher.run())
+            # 変更を受け取った監視は、ロックを待って止まる
+            await oneshot.changed.wait()
+            await asyncio.sleep(0)
+            assert not reloaded.is_set()
+            assert filerepo.node_or_error("n22").state.name=="s1"
+        await reloaded.wait()
+        assert filerepo.node_or_error("n22").state.name=="s2"
+        task.cancel()
+    asyncio.run(_())
+
+def test_dirty(filerepo:Repository):
+    n11=filerepo.node_or_error("n11")
+    n22=filerepo.node_or_error("n22")
+    assert not n11.dirty
+    n11.set_prop(filerepo.types["type1"].properties["ref"],n22)
+    assert n11.dirty
+    n11.dirty=False
+    n11.state=filerepo.states["s2"]
+    assert n11.dirty
+    n11.dirty=False
+    n11.description="desc"
+    assert n11.dirty
+    n11.dirty=False
+    n11.add_tag(filerepo.tag_or_create("t1",None))
+    assert n11.dirty
+
+def test_write_behind(filerepo:Repository):
+    n11=filerepo.node_or_error("n11")
+    n21=filerepo.node_or_error("n21")
+    saved:list[str]=[]
+    prepare=filerepo.storage.prepare
+    def _prepare(docs,keys):
+        saved.extend(name for _,name,_ in docs)
+        return prepare(docs,keys)
+    filerepo.storage.prepare=_prepare
+
+    async def _():
+        async with filerepo._cycle():
+            n11.description="first"
+            filerepo.save_nodes(n11,n21)
+            n11.description="second"
+            filerepo.save_nodes(n11)
+            assert saved==[]
+        await filerepo.flush()
+    asyncio.run(_())
+    assert saved==["n11"]
+    assert not n11.dirty
+    file=filerepo.config_dir / "type1" / "n11.yaml"
+    assert "second" in file.read_text()
+    assert [p.name for p in file.parent.iterdir()]==["n11.yaml"]
+
+class RecordService(Service):
+    log:list[str]=[]
+    async def update(self,*nodes:Node,intensive:bool=False)->Iterable[Node]:
+        self.log.append("start "+self.name)
+        await asyncio.sleep(0)
+        self.log.append("end "+self.name)
+        return ()
+
+class SlowService(RecordService):
+    async def update(self,*nodes:Node,intensive:bool=False)->Iterable[Node]:
+        await asyncio.Event().wait()
+        return ()
+
+class SlowInitService(RecordService):
+    cancelled:asyncio.Event
+    async def init(self)->None:
+        self.log.append("start init")
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            self.cancelled.set()
+            raise
+        self.log.append("end init")
+
+def test_service_scheduler(tmp_path:Path,monkeypatch:pytest.MonkeyPatch):
+    # test_handlerで登録された解決できない使用者を除く
+    monkeypatch.setattr(handler,"_functions",[])
+    config=dict(FILE_REPO_CONFIG)
+    config["config_path"]=str(tmp_path)
+    config["services"]={
+        "a":{"type":"tests.test_repository:RecordService"},
+        "b":{"type":"tests.test_repository:RecordService","after":["c"]},
+        "c":{"type":"tests.test_repository:RecordService"},
+    }
+    repo=Repository()
+    repo.configure(config)
+    assert [[s.name for s in level] for level in repo.scheduler.levels]==[["a","c"],["b"]]
+    RecordService.log=[]
+    asyncio.run(repo.update())
+    assert RecordService.log==["start a","start c","end a","end c","start b","end b"]
+
+    config["services"]={"a":{"type":"tests.test_repository:SlowService","timeout":0.01}}
+    repo=Repository()
+    repo.configure(config)
+    with pytest.raises(TimeoutError):
+        asyncio.run(repo.update())
+
+    # タイムアウトしたサービスの処理は止まる
+    config["services"]={"a":{"type":"tests.test_repository:SlowInitService","timeout":0.01}}
+    repo=Repository()
+    repo.configure(config)
+    RecordService.log=[]
+    async def _init():
+        SlowInitService.cancelled=asyncio.Event()
+        with pytest.raises(TimeoutError):
+            await repo.init()
+        await SlowInitService.cancelled.wait()
+    asyncio.run(_init())
+    assert RecordService.log==["start init"]
+
+    config["services"]={
+        "a":{"type":"tests.test_repository:RecordService","after":["b"]},
+        "b":{"type":"tests.test_repository:RecordService","after":["a"]},
+    }
+    with pytest.raises(ValueError):
+        Repository().configure(config)
+
+def test_auto_transition(tmp_path:Path):
+    config_dir=tmp_path / ".repository"
+    config=dict(FILE_REPO_CONFIG)
+    config["states"]={
+        "s1":{"transitions":{"s2":"val>2","s3":"~ref{val>5}"}},
+        "s2":{},
+        "s3":{}
+    }
+    write(config_dir / "config.yaml",config)
+    write(config_dir / "type1" / "n11.yaml",{"state":"s1","properties":{"ref":"n21","val":1}})
+    write(config_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":10}})
+    write(config_dir / "type2" / "n22.yaml",{"state":"s1","properties":{"num":20}})
+    repo=Repository()
+    repo.configure(str(config_dir))
+    n11=repo.node_or_error("n11")
+    n21=repo.node_or_error("n21")
+    val=repo.types["type1"].properties["val"]
+    ref=repo.types["type1"].properties["ref"]
+    assert repo.transitions.fields=={val,(True,ref),"state"}
+
+    n11.description="not tracked"
+    assert repo.changes=={}
+    n11.set_prop(val,3)
+    assert asyncio.run(repo.modified(n11))=={n11}
+    assert n11.state.name=="s2"
+    assert n21.state.name=="s1"
+
+    # n11の変更は、n11を参照で読むn21の遷移だけを調べる
+    n11.set_prop(val,6)
+    candidates=repo.transitions.candidates(repo.changes)
+    assert list(candidates)==[n21]
+    assert [ct.transition.tostate.name for ct in cast(set[CompiledTransition],candidates[n21])]==["s3"]
+    asyncio.run(repo.modified(n11))
+    assert n21.state.name=="s3"
+    assert repo.node_or_error("n22").state.name=="s1"
+    assert repo.changes=={}
+
+def test_transaction(filerepo:Repository,monkeypatch:pytest.MonkeyPatch):
+    n11=filerepo.node_or_error("n11")
+    n21=filerepo.node_or_error("n21")
+    n22=filerepo.node_or_error("n22")
+    ref=filerepo.types["type1"].properties["ref"]
+    val=filerepo.types["type1"].properties["val"]
+    file=filerepo.config_dir / "type1" / "n11.yaml"
+    text=file.read_text()
+
+    async def fail():
+        async with filerepo.transaction():
+            n11.set_prop(ref,n22)
+            n11.set_prop(val,5)
+            n11.state=filerepo.states["s2"]
+            n23=Node(filerepo.types["type2"])
+            n23.name="n23"
+            filerepo.add_node(n23)
+            assert await filerepo.modified(n11)==set()
+            raise RuntimeError()
+    with pytest.raises(RuntimeError):
+        asyncio.run(fail())
+    assert n11.properties[ref]==n21
+    assert n11.properties[val]==1
+    assert n11.state.name=="s1"
+    assert not n11.dirty
+    assert n21.referrers(ref)==[n11]
+    assert not filerepo.refs.referenced(n22)
+    assert filerepo.node("n23",None) is None
+    asyncio.run(filerepo.flush())
+    assert file.read_text()==text
+
+    # 削除も取り消され、ファイルは残る
+    n21_file=filerepo.config_dir / "type2" / "n21.yaml"
+    async def fail_remove():
+        async with filerepo.transaction():
+            filerepo.remove_node(n21)
+            assert filerepo.node("n21",None) is None
+            raise RuntimeError()
+    with pytest.raises(RuntimeError):
+        asyncio.run(fail_remove())
+    asyncio.run(filerepo.flush())
+    assert n21_file.is_file()
+    assert filerepo.node("n21",None) is n21
+    assert n21.properties[filerepo.types["type2"].properties["num"]]==10
+    assert n21.referrers(ref)==[n11]
+    assert n11.properties[ref]==n21
+
+    flushes:list[int]=[]
+    flush=filerepo.writer.flush
+    def _flush():
+        flushes.append(len(filerepo.writer._pending))
+        flush()
+    monkeypatch.setattr(filerepo.writer,"flush",_flush)
+    async def ok():
+        async with filerepo.transaction():
+            n11.set_prop(val,2)
+            await filerepo.modified(n11)
+            n22.state=filerepo.states["s2"]
+            await filerepo.modified(n22)
+        await filerepo.flush()
+    asyncio.run(ok())
+    assert flushes[0]==2
+    assert "s2" in (filerepo.config_dir / "type2" / "n22" / "type2.yaml").read_text()
+
+def _node_key(data:NodeData)->str:
+    return f"{data.type}:{data.name}:{data.doc['state']}"
+
+def test_map_nodes(filerepo:Repository):
+    nodes=sorted(filerepo.nodes.iterate(),key=lambda x:x.name)
+    async def _():
+        try:
+            return await filerepo.processes.map_nodes(_node_key,nodes,chunksize=2)
+        finally:
+            filerepo.processes.close()
+    assert asyncio.run(_())==[f"{x.type.name}:{x.name}:{x.state.name}" for x in nodes]
+
+def test_diff(filerepo:Repository):
+    other=Repository()
+    other.configure(str(filerepo.config_dir))
+    assert not filerepo.diff(other)
+    assert filerepo.merkle.root()==other.merkle.root()
+
+    num=other.types["type2"].properties["num"]
+    other.node_or_error("n21").set_prop(num,11)
+    other.remove_node(other.node_or_error("n22"))
+    node=Node(other.types["type1"])
+    node.name="n12"
+    other.add_node(node)
+    node.configure({"state":"s1"})
+    d=filerepo.diff(other)
+    assert d.added==[("type1","n12")]
+    assert d.removed==[("type2","n22")]
+    assert d.changed==[("type2","n21")]
+    assert d.buckets==3
+
+    other.node_or_error("n21").set_prop(num,10)
+    assert filerepo.diff(other).changed==[]
+
+def test_relocate(filerepo:Repository,tmp_path:Path):
+    for name in ("n11","n21","n22"):
+        write(tmp_path / name / "data.yaml",{"name":name})
+    filerepo.node_path.add_dict({"type2":"{type}/{node}"},filerepo)
+    plan=asyncio.run(filerepo.relocate(dry_run=True))
+    assert sorted((s.name,str(d.relative_to(tmp_path))) for s,d in plan.moves)==[("n21","type2/n21"),("n22","type2/n22")]
+    assert filerepo.node_or_error("n21").node_path==tmp_path / "n21"
+
+    asyncio.run(filerepo.relocate())
+    for name,path in (("n11","n11"),("n21","type2/n21"),("n22","type2/n22")):
+        assert (tmp_path / path / "data.yaml").exists()
+        assert filerepo.node_or_error(name).node_path==tmp_path / path
+    assert not (tmp_path / "n21").exists()
+    assert not filerepo.mover.path.exists()
+
+def test_interrupted_move(filerepo:Repository,tmp_path:Path,monkeypatch:pytest.MonkeyPatch):
+    a,b=tmp_path / "a",tmp_path / "b"
+    write(a / "data.yaml",{"name":"a"})
+    def fail(self:Mover,i:int,move:Move,copied:bool):
+        raise OSError("interrupted")
+    with monkeypatch.context() as m:
+        m.setattr(Mover,"_move",fail)
+        with pytest.raises(OSError):
+            asyncio.run(filerepo.mover.run(MovePlan([(a,b)])))
+    # 移動先ができてしまい、続きを実行できない
+    write(b / "data.yaml",{"name":"b"})
+    with pytest.raises(MoveError):
+        asyncio.run(filerepo.mover.resume())
+    # 起動は妨げない
+    asyncio.run(filerepo.init())
+    assert filerepo.mover.path.exists()
+
+    # 読むだけのRepositoryは、移動を再開しない
+    def resume(self:Mover):
+        raise AssertionError("resumed")
+    other=Repository()
+    other.configure(str(filerepo.config_dir),read_only=True)
+    with monkeypatch.context() as m:
+        m.setattr(Mover,"resume",resume)
+        asyncio.run(other.init())
+
+    plan=filerepo.mover.abort()
+    assert plan is not None and plan.moves==[(a,b)]
+    assert not filerepo.mover.path.exists()
+    assert filerepo.mover.abort() is None
+    assert (a / "data.yaml").exists() and (b / "data.yaml").exists()
+
+def test_move_plan(tmp_path:Path,monkeypatch:pytest.MonkeyPatch):
+    a,b,c=tmp_path / "a",tmp_path / "b",tmp_path / "c"
+    for x in (a,b,c):
+        write(x / "sub" / "data.yaml",{"name":x.name})
+    with pytest.raises(MoveError):
+        MovePlan([(a,tmp_path / "d"),(b,tmp_path / "d")])
+    with pytest.raises(MoveError):
+        MovePlan([(a,c)])
+    with pytest.raises(MoveError):
+        MovePlan([(a,a / "x")])
+    # 親の移動に含まれる移動は省く
+    assert MovePlan([(a,tmp_path / "d"),(a / "sub",tmp_path / "d" / "sub")]).moves==[(a,tmp_path / "d")]
+
+    # 循環する移動は一時的な名前を経由する
+    plan=MovePlan([(a,b),(b,c),(c,a),(a / "sub",tmp_path / "e")])
+    assert len(plan)==5
+    mover=Mover(tmp_path / "moves.jsonl",workers=2)
+
+    # 途中で中断しても、続きから実行できる
+    orig=Mover._move
+    def fail(self:Mover,i:int,move:Move,copied:bool):
+        if move.dest==tmp_path / "e":
+            raise OSError("interrupted")
+        orig(self,i,move,copied)
+    monkeypatch.setattr(Mover,"_move",fail)
+    with pytest.raises(OSError):
+        asyncio.run(mover.run(plan))
+    assert mover.path.exists()
+    monkeypatch.setattr(Mover,"_move",orig)
+    with pytest.raises(MoveError):
+        asyncio.run(mover.run(MovePlan([(tmp_path / "e",tmp_path / "f")])))
+    assert asyncio.run(mover.resume()) is not None
+    assert asyncio.run(mover.resume()) is None
+    assert (tmp_path / "e" / "data.yaml").exists()
+    assert sorted(x.name for x in tmp_path.iterdir())==["a","b","c","e"]
+    assert not (b / "sub").exists()
+    assert (c / "sub" / "data.yaml").read_text()=="name: b\n"
+    assert (a / "sub" / "data.yaml").read_text()=="name: c\n"
@@ -0,0 +1,233 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from herms import Repository, filelock
+from herms.changefeed import ChangeFeed
+from herms.config import DirectorySnapshot
+from herms.journal import Journal
+from herms.storage import FileStorage, SqliteStorage, copy_nodes, create_storage
+from .sample_repo import FILE_REPO_CONFIG, filerepo, write
+
+_=filerepo
+
+def test_create_storage(filerepo:Repository):
+    assert isinstance(filerepo.storage,FileStorage)
+    storage=create_storage(filerepo,{"type":"sqlite","path":"data.db"})
+    assert isinstance(storage,SqliteStorage)
+    assert storage.path==filerepo.config_dir / "data.db"
+    assert isinstance(create_storage(filerepo,"herms.storage.SqliteStorage"),SqliteStorage)
+    with pytest.raises(ValueError):
+        create_storage(filerepo,"herms.storage.WriteBuffer")
+
+def test_file_storage_prepare(filerepo:Repository):
+    storage=filerepo.storage
+    assert isinstance(storage,FileStorage)
+    write_files=storage.prepare([("type3","n31",{"state":"s1"})],[("type2","n22")])
+    # スナップショットは先に更新され、ファイルは返された関数で書き込まれる
+    assert storage.node_file("type3","n31")==filerepo.config_dir / "type3" / "n31.yaml"
+    assert storage.load_node("type2","n22") is None
+    assert not (filerepo.config_dir / "type3").exists()
+    filerepo.snapshot=DirectorySnapshot()
+    write_files()
+    assert storage.load_node("type3","n31")=={"state":"s1"}
+    assert not (filerepo.config_dir / "type2" / "n22" / "type2.yaml").exists()
+
+def test_sqlite_roundtrip(filerepo:Repository):
+    storage=create_storage(filerepo,"sqlite")
+    assert copy_nodes(filerepo.storage,storage)==3
+    docs={(t,n):d for t,n,d in storage.load()}
+    assert docs[("type1","n11")]["properties"]=={"ref":"n21","val":1}
+    assert storage.load_node("type2","n22")=={"state":"s1","properties":{"num":20}}
+    assert storage.load_node("type2","n99") is None
+
+    conn=sqlite3.connect(storage.path)
+    assert conn.execute("SELECT name FROM node_props WHERE prop='num' AND value>15").fetchall()==[("n22",)]
+    assert conn.execute("SELECT count(*) FROM nodes WHERE state='s1'").fetchone()==(3,)
+    conn.close()
+
+    storage.delete([("type2","n22")])
+    assert storage.load_node("type2","n22") is None
+    storage.close()
+
+def test_sqlite_repository(tmp_path):
+    config_dir=tmp_path / ".repository"
+    config=dict(FILE_REPO_CONFIG)
+    config["storage"]="sqlite"
+    write(config_dir / "config.yaml",config)
+    repo=Repository()
+    repo.configure(str(config_dir))
+    storage=repo.storage
+    assert isinstance(storage,SqliteStorage)
+    storage.save([("type2","n21",{"state":"s1","properties":{"num":10}}),
+                  ("type1","n11",{"state":"s1","properties":{"ref":"n21"}})])
+
+    repo=Repository()
+    repo.configure(str(config_dir))
+    n11=repo.node_or_error("n11")
+    assert n11.properties[repo.types["type1"].properties["ref"]]==repo.node_or_error("n21")
+
+    repo.save_nodes(n11)
+    files=FileStorage(repo)
+    copy_nodes(repo.storage,files)
+    assert (config_dir / "type1" / "n11.yaml").is_file()
+    repo.storage.close()
+
+@pytest.fixture
+def journalrepo(filerepo:Repository):
+    config=dict(FILE_REPO_CONFIG)
+    config["journal"]=True
+    write(filerepo.config_dir / "config.yaml",config)
+    repo=Repository()
+    repo.configure(str(filerepo.config_dir))
+    yield repo
+
+def test_journal(journalrepo:Repository):
+    filerepo=journalrepo
+    journal=filerepo.journal
+    assert journal is not None
+    n11=filerepo.node_or_error("n11")
+    val=filerepo.types["type1"].properties["val"]
+    file=filerepo.config_dir / "type1" / "n11.yaml"
+    text=file.read_text()
+
+    n11.set_prop(val,5)
+    filerepo.save_nodes(n11)
+    # ジャーナルに追記されるだけで、ファイルはまだ書き換えられない。フィードにも記録されない
+    assert file.read_text()==text
+    assert ("type1","n11") not in filerepo.feed.revisions
+    assert [(r["name"],r["doc"]["properties"]["val"]) for r in journal.records()]==[("n11",5)]
+    filerepo.remove_node(filerepo.node_or_error("n21"))
+    assert (filerepo.config_dir / "type2" / "n21.yaml").is_file()
+
+    # 他のプロセスは、ジャーナルを書き換えずに内容だけを反映する
+    other=Repository()
+    other.configure(str(filerepo.config_dir))
+    assert other.journal is not None and not other.journal.owner
+    assert other.node_or_error("n11").properties[val]==5
+    assert other.node("n21",None) is None
+    assert file.read_text()==text
+    assert len(journal.records())==2
+
+    # 書き込む前に終了した場合、次に読み込むときにジャーナルから復元される
+    journal.close()
+    ro=Repository()
+    ro.configure(str(filerepo.config_dir),read_only=True)
+    assert ro.journal is not None and not ro.journal.owner
+    assert len(journal.records())==2
+    repo=Repository()
+    repo.configure(str(filerepo.config_dir))
+    assert repo.node_or_error("n11").properties[val]==5
+    assert repo.node("n21",None) is None
+    assert not (filerepo.config_dir / "type2" / "n21.yaml").exists()
+    assert Journal(journal.path).records()==[]
+    assert repo.feed.since(0)==[(("type1","n11"),False),(("type2","n21"),True)]
+
+    n11=repo.node_or_error("n11")
+    n11.set_prop(val,6)
+    repo.save_nodes(n11)
+    asyncio.run(repo.flush())
+    assert "6" in file.read_text()
+    assert repo.feed.since(2)==[(("type1","n11"),False)]
+    assert repo.journal is not None and repo.journal.records()==[]
+    repo.storage.close()
+
+def test_checkpoint_failure(journalrepo:Repository,monkeypatch:pytest.MonkeyPatch):
+    filerepo=journalrepo
+    journal=filerepo.journal
+    assert journal is not None
+    n11=filerepo.node_or_error("n11")
+    val=filerepo.types["type1"].properties["val"]
+    file=filerepo.config_dir / "type1" / "n11.yaml"
+    prepare=filerepo.storage.prepare
+    def _fail(docs,keys):
+        def write():
+            raise OSError("disk full")
+        return write
+    monkeypatch.setattr(filerepo.storage,"prepare",_fail)
+    n11.set_prop(val,5)
+    filerepo.save_nodes(n11)
+    asyncio.run(filerepo.flush())
+    # 書き込めなかった変更はジャーナルに残る
+    assert [r["name"] for r in journal.records()]==["n11"]
+
+    monkeypatch.setattr(filerepo.storage,"prepare",prepare)
+    n21=filerepo.node_or_error("n21")
+    n21.set_prop(filerepo.types["type2"].properties["num"],11)
+    filerepo.save_nodes(n21)
+    asyncio.run(filerepo.flush())
+    assert "5" in file.read_text()
+    assert journal.records()==[]
+
+def test_journal_config(filerepo:Repository,tmp_path):
+    # ジャーナルは指定した場合だけ使う
+    assert filerepo.journal is None
+    config=dict(FILE_REPO_CONFIG)
+    config["config_path"]=str(tmp_path)
+    config["storage"]="sqlite"
+    config["journal"]=True
+    repo=Repository()
+    repo.configure(config)
+    assert repo.journal is not None
+
+def test_checkpoint_cycle(journalrepo:Repository):
+    repo=journalrepo
+    n11=repo.node_or_error("n11")
+    val=repo.types["type1"].properties["val"]
+    file=repo.config_dir / "type1" / "n11.yaml"
+
+    async def _():
+        async with repo._cycle():
+            n11.set_prop(val,5)
+            repo.save_nodes(n11)
+        # 一連の処理が終わると、ジャーナルの変更もストレージに書き込まれる
+        await asyncio.gather(*(asyncio.wrap_future(f) for f in list(repo.writer._futures)))
+    asyncio.run(_())
+    assert "5" in file.read_text()
+    assert repo.feed.revisions[("type1","n11")]>0
+    assert repo.journal is not None and repo.journal.records()==[]
+
+def test_change_feed(tmp_path):
+    path=tmp_path / ChangeFeed.FILE
+    feed=ChangeFeed(path)
+    feed.COMPACT_SIZE=4
+    feed.record([(("t","a"),False),(("t","b"),False)])
+    reader=ChangeFeed(path)
+    assert reader.since(0)==[(("t","a"),False),(("t","b"),False)]
+    feed.record([(("t","a"),False)])
+    feed.record([(("t","b"),True)])
+    assert reader.load()==[("t","a"),("t","b")]
+    assert reader.since(2)==[(("t","a"),False),(("t","b"),True)]
+    # 書き直された後も、最初から読み込み直す
+    feed.record([(("t","a"),False)])
+    assert len(path.read_text().splitlines())==2
+    assert reader.load()==[("t","b"),("t","a")]
+    assert reader.revision==feed.revision==5
+    assert reader.since(4)==[(("t","a"),False)]
+    assert reader.deleted=={("t","b")}
+
+def test_change_feed_writers(tmp_path):
+    path=tmp_path / ChangeFeed.FILE
+    # 2つのプロセスが同じファイルに記録する
+    a=ChangeFeed(path)
+    b=ChangeFeed(path)
+    assert a.record([(("t","a"),False)])==1
+    assert b.record([(("t","b"),False)])==2
+    assert a.record([(("t","c"),False)])==3
+    assert a.since(0)==[(("t","a"),False),(("t","b"),False),(("t","c"),False)]
+    assert b.load()==[("t","c")]
+    reader=ChangeFeed(path)
+    assert reader.revision==3
+    assert reader.since(1)==[(("t","b"),False),(("t","c"),False)]
+    a.close()
+    b.close()
+
+def test_filelock(tmp_path):
+    path=tmp_path / "x.lock"
+    with path.open("ab") as a, path.open("ab") as b:
+        assert filelock.lock(a)
+        assert not filelock.lock(b,blocking=False)
+        filelock.unlock(a)
+        assert filelock.lock(b,blocking=False)
+        filelock.unlock(b)
@@ -0,0 +1,292 @@
+import asyncio
+import struct
+import zlib
+from collections.abc import Iterable
+from pathlib import Path
+
+import pytest
+
+from herms import Node, Query, Repository, handler
+from herms.module.sync import Importer, SyncService
+from .sample_repo import FILE_REPO_CONFIG, write
+
+
+@pytest.fixture
+def syncrepo(tmp_path:Path,monkeypatch:pytest.MonkeyPatch):
+    # test_handlerで登録された解決できない使用者を除く
+    monkeypatch.setattr(handler,"_functions",[])
+    target_dir=tmp_path / "target" / ".repository"
+    write(target_dir / "config.yaml",FILE_REPO_CONFIG)
+    write(target_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":10}})
+    write(target_dir / "type2" / "n22.yaml",{"state":"s1","properties":{"num":20}})
+    config=dict(FILE_REPO_CONFIG)
+    config["config_path"]=str(tmp_path / "local")
+    config["services"]={"sync":{"type":"herms.module.sync:SyncService","target":str(target_dir)}}
+    repo=Repository()
+    repo.configure(config)
+    yield repo
+
+def test_incremental_sync(syncrepo:Repository,monkeypatch:pytest.MonkeyPatch):
+    sync=syncrepo.services["sync"]
+    assert isinstance(sync,SyncService)
+    asyncio.run(syncrepo.update())
+    assert sorted(x.name for x in syncrepo.nodes.iterate())==["n21","n22"]
+    assert sync.watermark()==sync.target.feed.revision
+
+    # 同期元を別のRepositoryで変更する
+    other=Repository()
+    other.configure(str(sync.target.config_dir))
+    node=Node(other.types["type2"])
+    node.name="n23"
+    other.add_node(node)
+    node.configure({"state":"s1","properties":{"num":30}})
+    other.save_nodes(node)
+    asyncio.run(other.flush())
+    assert other.revision(node)>0
+
+    seen:list[str]=[]
+    orig=sync.matching
+    def matching(nodes:Iterable[Node]|None=None):
+        for batch in orig(nodes):
+            seen.extend(x.name for x in batch)
+            yield batch
+    monkeypatch.setattr(sync,"matching",matching)
+    asyncio.run(syncrepo.update())
+    assert seen==["n23"]
+    num=syncrepo.types["type2"].properties["num"]
+    assert syncrepo.node_or_error("n23").properties[num]==30
+
+    seen.clear()
+    asyncio.run(syncrepo.update())
+    assert seen==[]
+    asyncio.run(syncrepo.update(intensive=True))
+    assert sorted(seen)==["n21","n22","n23"]
+
+def test_merge(syncrepo:Repository):
+    sync=syncrepo.services["sync"]
+    assert isinstance(sync,SyncService)
+    asyncio.run(syncrepo.update())
+    target=sync.target
+    n21=syncrepo.node_or_error("n21")
+    remote=target.node_or_error("n21")
+    assert n21.fingerprint()==remote.fingerprint()
+    assert not sync._merge(remote,n21)
+
+    num=target.types["type2"].properties["num"]
+    remote.set_prop(num,11)
+    remote.add_tag(target.tag_or_create("t1",None))
+    assert n21.fingerprint()!=remote.fingerprint()
+    # 同期元はストレージから読み込み直される
+    target.save_nodes(remote)
+    asyncio.run(target.flush())
+    assert asyncio.run(sync.update(n21))=={n21}
+    remote=target.node_or_error("n21")
+    assert n21.properties[syncrepo.types["type2"].properties["num"]]==11
+    assert [x.name for x in n21.tags]==["t1"]
+    assert n21.fingerprint()==remote.fingerprint()
+
+def test_importer(syncrepo:Repository):
+    sync=syncrepo.services["sync"]
+    assert isinstance(sync,SyncService)
+    asyncio.run(syncrepo.update())
+    target=sync.target
+    imp=Importer(syncrepo)
+    text="x"*100
+    data={"a":[text,1],"b":(text,None)}
+    ret=imp(data)
+    assert ret==data and ret is not data and ret["a"] is not data["a"]
+    assert ret["a"][0] is text and ret["b"] is data["b"]
+
+    remote=target.node_or_error("n21")
+    local=imp(remote)
+    assert local is syncrepo.node_or_error("n21")
+    assert imp(remote) is local
+    assert imp(remote.type) is syncrepo.types["type2"]
+    assert len(imp.table)==2
+
+def test_update_nodes(syncrepo:Repository):
+    sync=syncrepo.services["sync"]
+    assert isinstance(sync,SyncService)
+    asyncio.run(syncrepo.update())
+    # 同期元にないNodeは変更しない
+    node=Node(syncrepo.types["type2"])
+    node.name="local"
+    syncrepo.add_node(node)
+    node.configure({"state":"s1","properties":{"num":1}})
+    n21=syncrepo.node_or_error("n21")
+    num=syncrepo.types["type2"].properties["num"]
+    n21.set_prop(num,11)
+    # 同期元のファイルの変更も読み込み直す
+    write(sync.target.config_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":12}})
+    watermark=sync.watermark()
+    assert set(asyncio.run(sync.update(node,n21)))=={n21}
+    assert n21.properties[num]==12
+    assert node.properties[num]==1
+    assert sync.watermark()==watermark
+
+    # 条件に合わないNodeは同期しない
+    sync.condition=Query("num>15",sync.target)
+    n21.set_prop(num,11)
+    assert not asyncio.run(sync.update(n21))
+    assert n21.properties[num]==11
+
+def test_condition(syncrepo:Repository):
+    sync=syncrepo.services["sync"]
+    assert isinstance(sync,SyncService)
+    sync.condition=Query("num>15",sync.target)
+    # 条件は同期元のクエリとして実行される
+    assert sync.target.query(sync.condition).iterable
+    assert [[x.name for x in batch] for batch in sync.matching()]==[["n22"]]
+    asyncio.run(syncrepo.update())
+    assert [x.name for x in syncrepo.nodes.iterate()]==["n22"]
+
+@pytest.mark.parametrize("other",[99,10])
+def test_multiple_targets(tmp_path:Path,monkeypatch:pytest.MonkeyPatch,other:int):
+    monkeypatch.setattr(handler,"_functions",[])
+    services={}
+    for name,num in (("a",10),("b",other)):
+        target_dir=tmp_path / name / ".repository"
+        write(target_dir / "config.yaml",FILE_REPO_CONFIG)
+        write(target_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":num}})
+        write(target_dir / "type2" / f"n{name}.yaml",{"state":"s1","properties":{"num":num}})
+        services[name]={"type":"herms.module.sync:SyncService","target":str(target_dir)}
+    config=dict(FILE_REPO_CONFIG)
+    config["config_path"]=str(tmp_path / "local")
+    config["services"]=services
+    repo=Repository()
+    repo.configure(config)
+    syncs=[repo.services["a"],repo.services["b"]]
+    assert all(isinstance(s,SyncService) and s._target is None for s in syncs)
+
+    async def _():
+        await repo.init()
+        await repo.update()
+    asyncio.run(_())
+    assert sorted(x.name for x in repo.nodes.iterate())==["n21","na","nb"]
+    conflicts=[c for s in syncs if isinstance(s,SyncService) for c in s.conflicts]
+    # 同じ内容の場合は衝突にならない
+    assert [(n.name,) for n,_ in conflicts]==([("n21",)] if other!=10 else [])
+    for s in syncs:
+        assert isinstance(s,SyncService) and s.stats is not None
+        assert s.stats.nodes==2
+        assert s.stats.conflicts==len(s.conflicts)
+
+def test_same_content(tmp_path:Path,monkeypatch:pytest.MonkeyPatch):
+    monkeypatch.setattr(handler,"_functions",[])
+    services={}
+    for name in ("a","b"):
+        target_dir=tmp_path / name / ".repository"
+        write(target_dir / "config.yaml",FILE_REPO_CONFIG)
+        write(target_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":10}})
+        services[name]={"type":"herms.module.sync:SyncService","target":str(target_dir)}
+    write(tmp_path / "a" / ".repository" / "type2" / "n22.yaml",{"state":"s1","properties":{"num":20}})
+    config=dict(FILE_REPO_CONFIG)
+    config["config_path"]=str(tmp_path / "local")
+    config["services"]=services
+    repo=Repository()
+    repo.configure(config)
+    a,b=repo.services["a"],repo.services["b"]
+    assert isinstance(a,SyncService) and isinstance(b,SyncService)
+    monkeypatch.setattr(SyncService,"BATCH_SIZE",1)
+
+    def batches(s:SyncService,*names:str):
+        return [[s.target.node_or_error(x)] for x in names]
+
+    async def _():
+        async with repo._cycle():
+            # aが作ったn21を複製する前に、bが内容の反映に進む
+            return await asyncio.gather(a._sync(batches(a,"n21","n22")),b._sync(batches(b,"n21")))
+    (modified,_),(theirs,_)=asyncio.run(_())
+    n21=repo.node_or_error("n21")
+    assert n21 in modified and not theirs
+    assert n21.state.name=="s1"
+    assert not a.conflicts and not b.conflicts
+
+@pytest.mark.parametrize("scheme",["tcp","unix"])
+def test_remote_sync(tmp_path:Path,monkeypatch:pytest.MonkeyPatch,scheme:str):
+    from herms.module.sync.protocol import SyncServer
+    monkeypatch.setattr(handler,"_functions",[])
+    target_dir=tmp_path / "target" / ".repository"
+    write(target_dir / "config.yaml",FILE_REPO_CONFIG)
+    write(target_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":10}})
+    write(target_dir / "type1" / "n11.yaml",{"state":"s1","properties":{"ref":"n21","val":1}})
+    target=Repository()
+    target.configure(str(target_dir))
+
+    async def _():
+        server=SyncServer(target)
+        await server.start("tcp://127.0.0.1:0" if scheme=="tcp" else f"unix://{tmp_path}/sync.sock")
+        config=dict(FILE_REPO_CONFIG)
+        config["config_path"]=str(tmp_path / "local")
+        config["services"]={"sync":{"type":"herms.module.sync:SyncService","target":server.addresses()[0]}}
+        repo=Repository()
+        repo.configure(config)
+        sync=repo.services["sync"]
+        assert isinstance(sync,SyncService) and sync.remote is not None
+        await repo.init()
+        await repo.update()
+        n11=repo.node_or_error("n11")
+        assert n11.properties[repo.types["type1"].properties["ref"]] is repo.node_or_error("n21")
+        assert server.sent==2
+
+        num=target.types["type2"].properties["num"]
+        target.node_or_error("n21").set_prop(num,11)
+        target.save_nodes(target.node_or_error("n21"))
+        await repo.update()
+        assert repo.node_or_error("n21").properties[repo.types["type2"].properties["num"]]==11
+        assert server.sent==3
+
+        # すべて調べ直しても、内容の同じNodeは送らない
+        await repo.update(intensive=True)
+        assert server.sent==3
+        assert sync.remote.received==3
+        await repo.close()
+        await server.close()
+    asyncio.run(_())
+
+def test_protocol_limits(monkeypatch:pytest.MonkeyPatch):
+    from herms.module.sync import protocol
+    monkeypatch.setattr(protocol,"MAX_MESSAGE",1000)
+
+    async def read(data:bytes):
+        reader=asyncio.StreamReader()
+        reader.feed_data(struct.pack(">I",len(data))+data)
+        reader.feed_eof()
+        return await protocol.receive(reader)
+    assert asyncio.run(read(zlib.compress(b'{"op":"end"}')))=={"op":"end"}
+    # 圧縮すると小さくても、展開すると上限を超えるメッセージ
+    bomb=zlib.compress(b'"'+b"x"*10000+b'"')
+    assert len(bomb)<1000
+    with pytest.raises(protocol.ProtocolError):
+        asyncio.run(read(bomb))
+    with pytest.raises(protocol.ProtocolError):
+        asyncio.run(read(zlib.compress(b"{}")[:-2]))
+
+def test_remote_token(tmp_path:Path,monkeypatch:pytest.MonkeyPatch):
+    from herms.module.sync.protocol import TOKEN_ENV, ProtocolError, RemoteTarget, SyncServer
+    monkeypatch.setattr(handler,"_functions",[])
+    monkeypatch.delenv(TOKEN_ENV,raising=False)
+    target_dir=tmp_path / "target" / ".repository"
+    write(target_dir / "config.yaml",FILE_REPO_CONFIG)
+    write(target_dir / "type2" / "n21.yaml",{"state":"s1","properties":{"num":10}})
+    target=Repository()
+    target.configure(str(target_dir))
+
+    async def _():
+        # localhost以外で待ち受けるにはトークンが必要
+        with pytest.raises(ValueError):
+            await SyncServer(target).start("tcp://0.0.0.0:0")
+        server=SyncServer(target,"secret")
+        await server.start("tcp://:0")
+        address=server.addresses()[0]
+        assert address.startswith("tcp://127.0.0.1:")
+        for token in (None,"wrong"):
+            client=RemoteTarget(address,token)
+            with pytest.raises(ProtocolError):
+                await client.pull(None,"",lambda key:None)
+        client=RemoteTarget(address,"secret")
+        revision,docs=await client.pull(None,"",lambda key:None)
+        assert [name for _,name,_ in docs]==["n21"]
+        await client.close()
+        await server.close()
+    asyncio.run(_())